@@ -0,0 +1,261 @@
+"""In-memory stand-in for a boto bucket.
+Implements just enough of the boto api for the code paths that read and write
+objects, and counts the requests that would hit S3.
+Also has the zfs and command fakes the backup and restore tests share.
+"""
+from collections import Counter
+import datetime
+import email.utils
+import hashlib
+import threading
+import time
+
+import boto.exception
+
+from z3.snap import CommandExecutor, S3SnapshotManager, ZFSSnapshotManager
+
+
+class MemoryKey(object):
+    def __init__(self, bucket, name, metadata=None, size=None, etag=None, last_modified=None,
+                 storage_class='STANDARD'):
+        self.bucket = bucket
+        self.name = name
+        self.key = name
+        self.metadata = metadata
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.storage_class = storage_class
+
+    def set_contents_from_string(self, data, headers=None):
+        self.etag = self.bucket.put(self.name, data, headers=headers)
+
+    def get_contents_as_string(self):
+        self.bucket.requests['GET'] += 1
+        obj = self.bucket.objects.get(self.name)
+        if obj is None:
+            raise boto.exception.S3ResponseError(404, 'Not Found')
+        self.etag = obj['etag']
+        return obj['data']
+
+    def get_contents_to_file(self, fp):
+        fp.write(self.get_contents_as_string())
+
+
+class MemoryPrefix(object):
+    """What boto lists for the common prefixes of a delimited listing"""
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+
+class MemoryBucket(object):
+    def __init__(self, name='memory-bucket'):
+        self.name = name
+        self.objects = {}
+        self.requests = Counter()
+        self.protected = set()  # names that can't be deleted with delete_keys
+        self._lock = threading.Lock()  # conditional requests check and write at once
+
+    def _check_conditions(self, name, headers):
+        """If-None-Match: * and If-Match: etag, like S3 for PUT and DELETE"""
+        headers = headers or {}
+        obj = self.objects.get(name)
+        if headers.get('If-None-Match') == '*' and obj is not None:
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
+        if 'If-Match' in headers:
+            if obj is None:
+                raise boto.exception.S3ResponseError(404, 'Not Found')
+            if obj['etag'] != headers['If-Match']:
+                raise boto.exception.S3ResponseError(412, 'Precondition Failed')
+
+    def put(self, name, data=b'', metadata=None, headers=None, last_modified=None):
+        """Stores an object; metadata can be given directly or as x-amz-meta- headers.
+        last_modified is a unix timestamp, defaults to now. Returns the etag.
+        """
+        self.requests['PUT'] += 1
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        metadata = dict(metadata or {})
+        for header, value in (headers or {}).items():
+            if header.startswith('x-amz-meta-'):
+                metadata[header[len('x-amz-meta-'):]] = value
+        obj = {
+            'data': data,
+            'metadata': metadata,
+            'etag': '"{}"'.format(hashlib.md5(data).hexdigest()),
+            'last_modified': time.time() if last_modified is None else last_modified,
+            'storage_class': (headers or {}).get('x-amz-storage-class', 'STANDARD'),
+        }
+        with self._lock:
+            self._check_conditions(name, headers)
+            self.objects[name] = obj
+        return obj['etag']
+
+    def _key(self, name):
+        obj = self.objects[name]
+        # HEAD returns Last-Modified as an http date
+        return MemoryKey(self, name, metadata=dict(obj['metadata']),
+                         size=len(obj['data']), etag=obj['etag'],
+                         last_modified=email.utils.formatdate(obj['last_modified'], usegmt=True),
+                         storage_class=obj['storage_class'])
+
+    def list(self, prefix='', delimiter='', marker='', *a, **kwa):
+        self.requests['LIST'] += 1
+        common_prefixes = set()
+        for name in sorted(self.objects):
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if common not in common_prefixes:
+                    common_prefixes.add(common)
+                    yield MemoryPrefix(self, common)
+                continue
+            key = self._key(name)
+            key.metadata = None  # listings don't include metadata
+            key.last_modified = datetime.datetime.utcfromtimestamp(
+                self.objects[name]['last_modified']).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            yield key
+
+    def get_key(self, name):
+        self.requests['HEAD'] += 1
+        if name not in self.objects:
+            return None
+        return self._key(name)
+
+    def new_key(self, name):
+        return MemoryKey(self, name)
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name, storage_class='STANDARD'):
+        """Like boto, the copy is STANDARD unless told otherwise"""
+        self.requests['COPY'] += 1
+        obj = self.objects[src_key_name]
+        self.put(new_key_name, obj['data'], metadata=obj['metadata'],
+                 headers={'x-amz-storage-class': storage_class})
+        self.requests['PUT'] -= 1
+
+    def initiate_multipart_upload(self, name, metadata=None, headers=None):
+        self.requests['POST'] += 1
+        return MemoryMultipartCopy(self, name, metadata, headers)
+
+    def delete_key(self, name, headers=None):
+        self.requests['DELETE'] += 1
+        with self._lock:
+            self._check_conditions(name, headers)
+            self.objects.pop(name, None)
+
+    def delete_keys(self, names, quiet=False):
+        """DeleteObjects; names listed in `protected` fail with AccessDenied"""
+        self.requests['DELETE_MULTI'] += 1
+        assert len(names) <= 1000, "DeleteObjects takes at most 1000 keys"
+        result = MemoryDeleteResult()
+        for name in names:
+            if name in self.protected:
+                result.errors.append(MemoryDeleted(name, 'AccessDenied', 'Access Denied'))
+            else:
+                self.objects.pop(name, None)
+                result.deleted.append(MemoryDeleted(name))
+        return result
+
+
+class MemoryDeleted(object):
+    """A deleted key or an error in the result of DeleteObjects"""
+    def __init__(self, key, code=None, message=None):
+        self.key = key
+        self.code = code
+        self.message = message
+
+
+class MemoryDeleteResult(object):
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+
+class MemoryMultipartCopy(object):
+    """Multipart upload made of parts copied from other keys"""
+    def __init__(self, bucket, name, metadata, headers=None):
+        self.bucket = bucket
+        self.name = name
+        self.headers = headers
+        self.metadata = metadata
+        self.parts = {}
+        self.canceled = False
+
+    def copy_part_from_key(self, src_bucket_name, src_key_name, part_num, start, end):
+        self.bucket.requests['COPY'] += 1
+        self.parts[part_num] = self.bucket.objects[src_key_name]['data'][start:end + 1]
+
+    def complete_upload(self):
+        self.bucket.requests['POST'] += 1
+        data = b''.join(self.parts[part_num] for part_num in sorted(self.parts))
+        self.bucket.put(self.name, data, metadata=self.metadata, headers=self.headers)
+        self.bucket.requests['PUT'] -= 1
+
+    def cancel_upload(self):
+        self.canceled = True
+
+
+def zfs_line(name, used='0', refer='0', written='0', guid=None, compressratio=None):
+    """A line of `zfs list` output for the snapshot name, the properties left as None
+    aren't listed
+    """
+    values = [name, used, refer, '-', written, guid, compressratio]
+    while values[-1] is None:
+        values.pop()
+    return '\t'.join(values) + '\n'
+
+
+class FakeZFSManager(ZFSSnapshotManager):
+    """Lists the snapshots in lines instead of running zfs list, lines can also be a
+    function returning them on every listing
+    """
+    def __init__(self, fs_name, snapshot_prefix, lines='', **kwa):
+        super(FakeZFSManager, self).__init__(fs_name, snapshot_prefix, **kwa)
+        self._lines = lines
+
+    def _list_snapshots(self):
+        return self._lines() if callable(self._lines) else self._lines
+
+
+class FakeCommandExecutor(CommandExecutor):
+    """Records the commands instead of running them, dry-run sends report size bytes
+    unless estimates has another size for the command
+    """
+    def __init__(self, estimates=None, size=1234, **kwa):
+        super(FakeCommandExecutor, self).__init__(**kwa)
+        self.commands = []
+        self.estimates = estimates or {}
+        self.size = size
+
+    def shell(self, cmd, dry_run=None, capture=None):  # pylint: disable=arguments-differ
+        self.commands.append(cmd)
+        return "\nsize {}".format(self.estimates.get(cmd, self.size))
+
+    def run_pipeline(self, cmd, **kwa):
+        return self.shell(cmd)
+
+
+def snapshot_bucket():
+    """A full backup of pool/fs@snap_1 and 2 incrementals on top of it"""
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'full', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_2', b'incr2', metadata={'parent': 'pool/fs@snap_1'})
+    bucket.put('z3/pool/fs@snap_3', b'incr3', metadata={'parent': 'pool/fs@snap_2'})
+    bucket.requests.clear()
+    return bucket
+
+
+# what s3_manager(snapshot_bucket()) lists
+BUCKET_SNAPSHOTS = [
+    ('pool/fs@snap_1', True, 4), ('pool/fs@snap_2', True, 5), ('pool/fs@snap_3', True, 5)]
+
+
+def s3_manager(bucket, snapshot_prefix='pool/fs@snap_', **kwa):
+    return S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix=snapshot_prefix, **kwa)
+
+
+def listed(s3_mgr):
+    return [(s.name, s.is_healthy, s.size) for s in s3_mgr.list()]
@@ -0,0 +1,156 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from z3.agent import Agent, AgentRunning, StatusServer, read_status
+from z3.snap import SoftError, latest_snapshots
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeZFS(object):
+    def __init__(self):
+        self.latest = {'pool/a': 'pool/a@daily-1', 'pool/b': 'pool/b@daily-1'}
+        self.polls = 0
+
+    def __call__(self):
+        self.polls += 1
+        return dict(self.latest)
+
+
+class FakeBackups(object):
+    def __init__(self, zfs):
+        self.zfs = zfs
+        self.runs = []
+        self.failing = set()
+
+    def __call__(self, dataset):
+        self.runs.append(dataset)
+        if dataset in self.failing:
+            raise SoftError("S3 is down")
+        return [{'snap_name': self.zfs.latest[dataset], 'size': 10, 'uploaded': 7}]
+
+
+@pytest.fixture
+def agent():
+    zfs = FakeZFS()
+    backups = FakeBackups(zfs)
+    return Agent(['pool/a', 'pool/b'], poll=zfs, backup=backups, retry_delay=300,
+                 clock=Clock())
+
+
+def test_backs_up_new_snapshots(agent):
+    zfs, backups = agent.poll, agent.backup
+    assert agent.tick() == ['pool/a', 'pool/b']  # unknown on start, every dataset is checked
+    agent.wait()
+    assert agent.tick() == []  # nothing new, S3 isn't asked
+    zfs.latest['pool/b'] = 'pool/b@daily-2'
+    assert agent.tick() == ['pool/b']
+    agent.wait()
+    assert sorted(backups.runs) == ['pool/a', 'pool/b', 'pool/b']
+    status = agent.status()['datasets']['pool/b']
+    assert status['backed_up'] == 'pool/b@daily-2'
+    assert (status['uploads'], status['bytes']) == (2, 14)
+
+
+def test_one_backup_per_dataset_at_a_time(agent):
+    release = threading.Event()
+    backup = agent.backup
+
+    def slow_backup(dataset):
+        uploaded = backup(dataset)  # the snapshots there are when it starts
+        release.wait()
+        return uploaded
+    agent.backup = slow_backup
+    assert agent.tick() == ['pool/a', 'pool/b']
+    agent.poll.latest['pool/a'] = 'pool/a@daily-2'
+    assert agent.tick() == []  # still running
+    release.set()
+    agent.wait()
+    assert agent.tick() == ['pool/a']
+    agent.wait()
+
+
+def test_failed_backups_are_retried_later(agent):
+    agent.backup.failing.add('pool/a')
+    agent.tick()
+    agent.wait()
+    status = agent.status()['datasets']['pool/a']
+    assert status['last_error'] == "S3 is down" and status['backed_up'] is None
+    assert agent.tick() == []
+    agent.backup.failing.clear()
+    agent.clock.now += 300
+    assert agent.tick() == ['pool/a']
+    agent.wait()
+    assert agent.status()['datasets']['pool/a']['last_error'] is None
+
+
+def test_run_until_stopped(agent):
+    agent.interval = 0.01
+    thread = threading.Thread(target=agent.run)
+    thread.start()
+    while agent.poll.polls < 3:
+        time.sleep(0.01)
+    agent.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert sorted(agent.backup.runs) == ['pool/a', 'pool/b']
+
+
+def test_status_socket(agent, tmpdir):
+    path = str(tmpdir.join('agent.sock'))
+    server = StatusServer(path, agent).start()
+    try:
+        agent.tick()
+        agent.wait()
+        status = read_status(path)
+    finally:
+        server.close()
+    assert status['polls'] == 1
+    assert status['datasets']['pool/a']['backed_up'] == 'pool/a@daily-1'
+
+
+def test_status_socket_of_a_running_agent(agent, tmpdir):
+    path = str(tmpdir.join('agent.sock'))
+    server = StatusServer(path, agent).start()
+    try:
+        with pytest.raises(AgentRunning):
+            StatusServer(path, agent)
+        assert read_status(path)['polls'] == 0  # still answering
+    finally:
+        server.close()
+    # the socket of an agent that died is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    StatusServer(path, agent).start().close()
+
+
+def test_status_socket_directory_is_created(agent, tmpdir):
+    path = str(tmpdir.join('run', 'z3', 'agent.sock'))
+    server = StatusServer(path, agent).start()
+    try:
+        assert read_status(path)['polls'] == 0
+    finally:
+        server.close()
+
+
+def test_latest_snapshots(monkeypatch):
+    listed = []
+
+    def fake_stream_lines(argv):
+        listed.append(argv)
+        return iter(['pool/a@zfs-auto-snap:daily-1', 'pool/a@zfs-auto-snap:hourly-2',
+                     'pool/a@zfs-auto-snap:daily-2', 'pool/b@zfs-auto-snap:hourly-1'])
+    monkeypatch.setattr('z3.snap.stream_lines', fake_stream_lines)
+    assert latest_snapshots(['pool/a', 'pool/b']) == {'pool/a': 'pool/a@zfs-auto-snap:daily-2'}
+    assert listed == [['zfs', 'list', '-H', '-t', 'snapshot', '-d', '1', '-s', 'createtxg',
+                       '-o', 'name', 'pool/a', 'pool/b']]
@@ -0,0 +1,213 @@
+# pylint: disable=redefined-outer-name
+import functools
+
+import pytest
+
+from z3 import snap
+from z3.config import OnionDict
+from z3.scheduler import Scheduler
+from z3.snap import configured_datasets, plan_backups
+
+from _tests.fakes import FakeCommandExecutor, FakeZFSManager, MemoryBucket, zfs_line
+
+
+LOCAL = {
+    # name, written
+    'pool/big': [('daily-1', '1G'), ('daily-2', '2.5G'), ('daily-3', '1G')],
+    'pool/small': [('daily-1', '1G'), ('daily-2', '10M'), ('daily-3', '20M')],
+    'pool/done': [('daily-1', '1G')],
+    'pool/empty': [],
+}
+
+
+def local_zfs(fs_name, snapshot_prefix, **kwa):
+    """Lists the snapshots of fs_name in LOCAL"""
+    def lines():
+        return ''.join(zfs_line('{}@{}'.format(fs_name, name), written=written)
+                       for name, written in LOCAL[fs_name])
+    return FakeZFSManager(fs_name, snapshot_prefix, lines=lines, **kwa)
+
+
+@pytest.fixture
+def config(monkeypatch):
+    cfg = OnionDict([{'SNAPSHOT_PREFIX': 'daily-', 'COMPRESSOR': 'pigz1'}], sections={
+        'fs:pool/big': {'COMPRESSOR': 'none'},
+        'fs:pool/small': {},
+        'other': {},
+    })
+    monkeypatch.setattr(snap, 'get_config', lambda: cfg)
+    return cfg
+
+
+@pytest.fixture
+def bucket():
+    bucket = MemoryBucket()
+    for dataset in ('pool/big', 'pool/small', 'pool/done'):
+        bucket.put('z3/{}@daily-1'.format(dataset), b'full', metadata={'isfull': 'true'})
+    return bucket
+
+
+def test_configured_datasets(config):
+    assert configured_datasets() == ['pool/big', 'pool/small']
+
+
+def test_plan_backups(config, bucket):
+    cmd = FakeCommandExecutor()
+    jobs, up_to_date, errors = plan_backups(
+        bucket, 'z3/', sorted(LOCAL), command_executor=cmd, upload_concurrency=8,
+        make_zfs_manager=local_zfs)
+    assert [(job.name, job.cost) for job in Scheduler.order(jobs)] == [
+        ('pool/big', 3.5 * 1024 ** 3), ('pool/small', 30 * 1024 ** 2)]
+    assert up_to_date == ['pool/done']
+    assert list(errors) == ['pool/empty']
+    results = Scheduler(concurrency=2).run(jobs)
+    assert all(result.success for result in results)
+    pputs = sorted(command for command in cmd.commands if 'pput' in command)
+    # every dataset keeps its own settings, the upload workers are shared
+    assert pputs == [
+        "zfs send -i 'pool/big@daily-1' 'pool/big@daily-2' | "
+        "pput --quiet --concurrency 8 --estimated 1234 --meta size=1234 "
+        "--meta parent=pool/big@daily-1 z3/pool/big@daily-2",
+        "zfs send -i 'pool/big@daily-2' 'pool/big@daily-3' | "
+        "pput --quiet --concurrency 8 --estimated 1234 --meta size=1234 "
+        "--meta parent=pool/big@daily-2 z3/pool/big@daily-3",
+        "zfs send -i 'pool/small@daily-1' 'pool/small@daily-2' | pigz -1 --blocksize 4096 | "
+        "pput --quiet --concurrency 8 --estimated 1234 --meta size=1234 "
+        "--meta parent=pool/small@daily-1 --meta compressor=pigz1 z3/pool/small@daily-2",
+        "zfs send -i 'pool/small@daily-2' 'pool/small@daily-3' | pigz -1 --blocksize 4096 | "
+        "pput --quiet --concurrency 8 --estimated 1234 --meta size=1234 "
+        "--meta parent=pool/small@daily-2 --meta compressor=pigz1 z3/pool/small@daily-3",
+    ]
+
+
+class UploadingCommandExecutor(FakeCommandExecutor):
+    """Stores what pput would upload in the bucket"""
+    def __init__(self, bucket):
+        super(UploadingCommandExecutor, self).__init__()
+        self.bucket = bucket
+
+    def shell(self, cmd, dry_run=None, capture=None):
+        if 'pput' in cmd:
+            args = cmd.split()
+            metadata = dict(args[index + 1].split('=', 1)
+                            for index, arg in enumerate(args) if arg == '--meta')
+            self.bucket.put(args[-1], b'incr', metadata=metadata)
+        return super(UploadingCommandExecutor, self).shell(cmd, dry_run, capture)
+
+
+def test_agent_backups(config, bucket, monkeypatch):
+    backups = snap.AgentBackups(
+        bucket, 'z3/', UploadingCommandExecutor(bucket), upload_concurrency=1,
+        make_pair_manager=functools.partial(
+            snap._dataset_pair_manager, zfs_manager=local_zfs))
+    assert [meta['snap_name'] for meta in backups('pool/small')] == [
+        'pool/small@daily-2', 'pool/small@daily-3']
+    monkeypatch.setitem(LOCAL, 'pool/small', LOCAL['pool/small'] + [('daily-4', '5M')])
+    bucket.requests.clear()
+    assert [meta['snap_name'] for meta in backups('pool/small')] == ['pool/small@daily-4']
+    # the backups in S3 were listed once, the uploads were added to them
+    assert bucket.requests['LIST'] == 0
+
+
+@pytest.mark.parametrize("parallel_uploads, expected", [(None, 2), (4, 4)])
+def test_parallel_uploads(monkeypatch, bucket, parallel_uploads, expected):
+    cfg = OnionDict([{'SNAPSHOT_PREFIX': 'daily-'}],
+                    sections={'fs:pool/big': {'PARALLEL_UPLOADS': '2'}})
+    monkeypatch.setattr(snap, 'get_config', lambda: cfg)
+    pair_manager = snap._dataset_pair_manager(
+        bucket, 'z3/', 'pool/big', snap._compressors(), None,
+        parallel_uploads=parallel_uploads, zfs_manager=local_zfs)
+    assert pair_manager.parallel_uploads == expected
+
+
+def test_single_backup_bandwidth_limit(config, bucket, monkeypatch, capsys):
+    executors = []
+
+    def command_executor(**kwa):
+        executors.append(FakeCommandExecutor(**kwa))
+        return executors[-1]
+    monkeypatch.setattr(snap, 'CommandExecutor', command_executor)
+    monkeypatch.setattr(snap, '_dataset_pair_manager', functools.partial(
+        snap._dataset_pair_manager, zfs_manager=local_zfs))
+    monkeypatch.setattr(snap, '_uploader', lambda bucket: None)
+    snap.do_backup(bucket, 'z3/', 'pool/small', 'daily-', full=False, snapshot=None,
+                   compressor='none', dry=False, parseable=True, bwlimit='1M')
+    assert executors[0].rate_limit == 1024 ** 2
+    assert capsys.readouterr()[0].splitlines() == [
+        'pool/small@daily-2\x001234', 'pool/small@daily-3\x001234']
+
+
+def test_single_backup_inherits_settings(bucket, monkeypatch):
+    cfg = OnionDict([{'SNAPSHOT_PREFIX': 'daily-'}],
+                    sections={'fs:pool/big': {'SEND_FLAGS': '-c'}})
+    monkeypatch.setattr(snap, 'get_config', lambda: cfg)
+    monkeypatch.setitem(LOCAL, 'pool/big/a', [('daily-1', '1G'), ('daily-2', '1M')])
+    bucket.put('z3/pool/big/a@daily-1', b'full', metadata={'isfull': 'true'})
+    cmd = FakeCommandExecutor()
+    monkeypatch.setattr(snap, 'CommandExecutor', lambda **kwa: cmd)
+    monkeypatch.setattr(snap, '_dataset_pair_manager', functools.partial(
+        snap._dataset_pair_manager, zfs_manager=local_zfs))
+    monkeypatch.setattr(snap, '_uploader', lambda bucket: None)
+    snap.do_backup(bucket, 'z3/', 'pool/big/a', 'daily-', full=False, snapshot=None,
+                   compressor='none', dry=False, parseable=True)
+    assert [command.split(' | ')[0] for command in cmd.commands if 'pput' in command] == [
+        "zfs send -c -i 'pool/big/a@daily-1' 'pool/big/a@daily-2'"]
+
+
+def test_plan_full_backups(config, bucket):
+    jobs, up_to_date, _ = plan_backups(
+        bucket, 'z3/', ['pool/done'], full=True, make_zfs_manager=local_zfs)
+    assert [job.name for job in jobs] == ['pool/done'] and up_to_date == []
+
+
+def test_descendants_inherit_settings(config):
+    assert snap._with_descendants(
+        ['pool/big'], ['pool', 'pool/big', 'pool/big/a', 'pool/big/a/b', 'pool/bigger']) == [
+            'pool/big', 'pool/big/a', 'pool/big/a/b']
+    assert snap._fs_section('pool/big/a/b') == 'fs:pool/big'
+    assert snap._fs_section('pool/other') == 'fs:pool/other'
+
+
+def test_restores_inherit_settings(monkeypatch):
+    cfg = OnionDict([{'SNAPSHOT_PREFIX': 'daily-'}],
+                    sections={'fs:pool/big': {'SNAPSHOT_PREFIX': 'weekly-'}})
+    monkeypatch.setattr(snap, 'get_config', lambda: cfg)
+    monkeypatch.setattr(snap, 'stream_lines', lambda argv: iter([]))
+    bucket = MemoryBucket()
+    for name in ('daily-1', 'weekly-1'):
+        bucket.put('z3/pool/big/a@' + name, b'full', metadata={'isfull': 'true'})
+    jobs, errors = snap.plan_restores(bucket, 'z3/', ['pool/big/a'])
+    assert [job.name for job in jobs] == ['pool/big/a@weekly-1'] and errors == {}
+
+
+def test_replication_stream(config, bucket):
+    cmd = FakeCommandExecutor()
+    jobs, _, _ = plan_backups(bucket, 'z3/', ['pool/small'], command_executor=cmd,
+                              replicate=True, make_zfs_manager=local_zfs)
+    Scheduler().run(jobs)
+    # -R streams include the descendants, their size can't be read from the properties
+    assert sorted(cmd.commands[:2]) == [
+        "zfs send -nvP -R -i 'pool/small@daily-1' 'pool/small@daily-2'",
+        "zfs send -nvP -R -i 'pool/small@daily-2' 'pool/small@daily-3'"]
+    assert cmd.commands[2] == (
+        "zfs send -R -i 'pool/small@daily-1' 'pool/small@daily-2' | pigz -1 --blocksize 4096 | "
+        "pput --quiet --estimated 1234 --meta size=1234 --meta parent=pool/small@daily-1 "
+        "--meta compressor=pigz1 --meta replicate=true z3/pool/small@daily-2")
+
+
+def test_restore_replication_stream(config, monkeypatch):
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/small@daily-1', b'full', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/small@daily-2', b'incr', metadata={
+        'parent': 'pool/small@daily-1', 'replicate': 'true'})
+    cmd = FakeCommandExecutor()
+    monkeypatch.setitem(LOCAL, 'pool/restored', [])
+    pair_manager = snap.PairManager(
+        snap.S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/small@'),
+        local_zfs(fs_name='pool/restored', snapshot_prefix='daily-'),
+        command_executor=cmd)
+    pair_manager.restore('pool/small@daily-2')
+    # the replication stream is received into the dataset, the children are created
+    assert cmd.commands == [
+        "z3_get z3/pool/small@daily-1 | zfs recv pool/small@daily-1",
+        "z3_get z3/pool/small@daily-2 | zfs recv pool/small"]
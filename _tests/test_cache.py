@@ -0,0 +1,121 @@
+# pylint: disable=redefined-outer-name,protected-access
+import pytest
+
+from z3.cache import MetadataCache, open_cache
+from z3.snap import PairManager
+
+from _tests.fakes import (
+    BUCKET_SNAPSHOTS, FakeCommandExecutor, FakeZFSManager, listed, s3_manager, snapshot_bucket)
+
+
+@pytest.fixture
+def bucket():
+    return snapshot_bucket()
+
+
+@pytest.fixture
+def cache_path(tmpdir):
+    return str(tmpdir.join('metadata.sqlite'))
+
+
+def manager(bucket, cache_path, validate_every=3600, catalog=False):
+    cache = MetadataCache(cache_path, bucket.name, 'z3/', validate_every=validate_every)
+    return s3_manager(bucket, cache=cache, catalog=catalog)
+
+
+def test_first_run_fills_the_cache(bucket, cache_path):
+    assert listed(manager(bucket, cache_path)) == BUCKET_SNAPSHOTS
+    assert bucket.requests == {'LIST': 1, 'HEAD': 3}
+    cache = MetadataCache(cache_path, bucket.name, 'z3/')
+    assert sorted(cache.etags('pool/fs@')) == ['pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3']
+    assert cache.get(['pool/fs@snap_2'])['pool/fs@snap_2']['metadata'] == {
+        'parent': 'pool/fs@snap_1'}
+
+
+def test_cached_run_lists_only_new_keys(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    bucket.requests.clear()
+    listed_after = []
+    original_list = bucket.list
+
+    def spy_list(prefix='', delimiter='', marker=''):
+        listed_after.append(marker)
+        return original_list(prefix, delimiter, marker)
+    bucket.list = spy_list
+    assert listed(manager(bucket, cache_path)) == BUCKET_SNAPSHOTS + [('pool/fs@snap_4', True, 5)]
+    assert listed_after == ['z3/pool/fs@snap_3']
+    assert bucket.requests == {'LIST': 1, 'HEAD': 1}
+
+
+def test_validation_evicts_deleted_and_refreshes_changed(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    bucket.delete_key('z3/pool/fs@snap_2')
+    bucket.put('z3/pool/fs@snap_3', b'full3', metadata={'isfull': 'true'})
+    bucket.requests.clear()
+    s3_mgr = manager(bucket, cache_path, validate_every=0)
+    assert listed(s3_mgr) == [('pool/fs@snap_1', True, 4), ('pool/fs@snap_3', True, 5)]
+    assert s3_mgr.get('pool/fs@snap_3').is_full
+    assert bucket.requests == {'LIST': 1, 'HEAD': 1}
+    assert sorted(s3_mgr.cache.etags('pool/fs@')) == ['pool/fs@snap_1', 'pool/fs@snap_3']
+
+
+def test_deleted_keys_are_kept_until_validation(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    bucket.delete_key('z3/pool/fs@snap_3')
+    assert listed(manager(bucket, cache_path)) == BUCKET_SNAPSHOTS
+    assert listed(manager(bucket, cache_path, validate_every=0)) == BUCKET_SNAPSHOTS[:2]
+
+
+def test_restore_skips_keys_deleted_since_cached(bucket, cache_path):
+    bucket.put('z3/pool/fs@snap_3~snap_1', b'cumulative3', metadata={'parent': 'pool/fs@snap_1'})
+    manager(bucket, cache_path).list()
+    bucket.delete_key('z3/pool/fs@snap_2')  # pruned by another host
+    pair_manager = PairManager(manager(bucket, cache_path), FakeZFSManager('pool/fs', 'snap_'),
+                               command_executor=FakeCommandExecutor())
+    pair_manager.restore('pool/fs@snap_3')
+    assert [command.split(' | ')[0] for command in pair_manager._cmd.commands] == [
+        'z3_get z3/pool/fs@snap_1', 'z3_get z3/pool/fs@snap_3~snap_1']
+    assert 'pool/fs@snap_2' not in MetadataCache(cache_path, bucket.name, 'z3/').etags('pool/')
+
+
+def test_record_upload(bucket, cache_path):
+    s3_mgr = manager(bucket, cache_path)
+    s3_mgr.list()
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    s3_mgr.record_upload('pool/fs@snap_4')
+    bucket.requests.clear()
+    assert listed(manager(bucket, cache_path))[-1] == ('pool/fs@snap_4', True, 5)
+    assert bucket.requests == {'LIST': 1}
+
+
+def test_cache_feeds_the_catalog(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    bucket.requests.clear()
+    assert listed(manager(bucket, cache_path, catalog=True)) == BUCKET_SNAPSHOTS
+    # the catalog didn't exist, it was written from the cache
+    assert bucket.requests['HEAD'] == 0
+    assert 'z3/.z3/catalog/pool/fs.json' in bucket.objects
+
+
+def test_cache_is_per_bucket_and_prefix(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    other = MetadataCache(cache_path, 'other-bucket', 'z3/')
+    assert other.etags('pool/fs@') == {}
+    other = MetadataCache(cache_path, bucket.name, 'z4/')
+    assert other.etags('pool/fs@') == {}
+
+
+def test_like_prefix_is_escaped(bucket, cache_path):
+    manager(bucket, cache_path).list()
+    cache = MetadataCache(cache_path, bucket.name, 'z3/')
+    # _ is a LIKE wildcard
+    assert cache.etags('pool/fs@snap%') == {}
+    assert len(cache.etags('pool/fs@snap_')) == 3
+
+
+def test_open_cache_failure(tmpdir):
+    not_a_dir = tmpdir.join('file')
+    not_a_dir.write('spam')
+    assert open_cache(str(not_a_dir), 'bucket', 'z3/') is None
+    assert open_cache(str(tmpdir.join('new', 'dir')), 'bucket', 'z3/') is not None
@@ -0,0 +1,132 @@
+# pylint: disable=redefined-outer-name,protected-access
+import json
+
+import pytest
+
+from z3.catalog import SnapshotCatalog
+
+from _tests.fakes import BUCKET_SNAPSHOTS, listed, s3_manager, snapshot_bucket
+
+
+CATALOG_KEY = 'z3/.z3/catalog/pool/fs.json'
+
+
+@pytest.fixture
+def bucket():
+    bucket = snapshot_bucket()
+    bucket.put('z3/pool/other@snap_1', b'full', metadata={'isfull': 'true'})
+    bucket.requests.clear()
+    return bucket
+
+
+def manager(bucket, catalog=True, **kwa):
+    return s3_manager(bucket, catalog=catalog, **kwa)
+
+
+def test_without_catalog(bucket):
+    assert listed(manager(bucket, catalog=False)) == BUCKET_SNAPSHOTS
+    assert bucket.requests['HEAD'] == 3
+    assert CATALOG_KEY not in bucket.objects
+
+
+def test_catalog_is_built_when_missing(bucket):
+    assert listed(manager(bucket)) == BUCKET_SNAPSHOTS
+    assert bucket.requests['HEAD'] == 3
+    catalog = json.loads(bucket.objects[CATALOG_KEY]['data'].decode('utf8'))
+    assert sorted(catalog['snapshots']) == ['pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3']
+    assert catalog['snapshots']['pool/fs@snap_2']['metadata'] == {'parent': 'pool/fs@snap_1'}
+
+
+def test_catalog_replaces_heads(bucket):
+    manager(bucket).list()
+    bucket.requests.clear()
+    assert listed(manager(bucket)) == BUCKET_SNAPSHOTS
+    assert bucket.requests == {'LIST': 1, 'GET': 1}
+
+
+def test_catalog_picks_up_new_keys(bucket):
+    manager(bucket).list()
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    bucket.requests.clear()
+    assert listed(manager(bucket))[-1] == ('pool/fs@snap_4', True, 5)
+    assert bucket.requests['HEAD'] == 1
+    assert bucket.requests['PUT'] == 1  # the fixed catalog
+
+
+def test_catalog_drops_stale_and_refreshes_changed(bucket):
+    manager(bucket).list()
+    bucket.delete_key('z3/pool/fs@snap_3')
+    bucket.put('z3/pool/fs@snap_2', b'full2', metadata={'isfull': 'true'})
+    bucket.requests.clear()
+    s3_mgr = manager(bucket)
+    assert listed(s3_mgr) == [('pool/fs@snap_1', True, 4), ('pool/fs@snap_2', True, 5)]
+    assert s3_mgr.get('pool/fs@snap_2').is_full
+    assert bucket.requests['HEAD'] == 1
+    assert 'pool/fs@snap_3' not in s3_mgr.catalog.entries
+
+
+def test_catalog_keeps_other_prefixes(bucket):
+    manager(bucket, snapshot_prefix='pool/fs@').list()
+    bucket.put('z3/pool/fs@other_1', b'full', metadata={'isfull': 'true'})
+    manager(bucket, snapshot_prefix='pool/fs@other_').list()
+    # listing snap_ only must not drop other_ entries and the other way around
+    s3_mgr = manager(bucket, snapshot_prefix='pool/fs@snap_')
+    s3_mgr.list()
+    assert sorted(s3_mgr.catalog.entries) == [
+        'pool/fs@other_1', 'pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3']
+
+
+def test_check_catalog(bucket):
+    s3_mgr = manager(bucket, snapshot_prefix='pool/fs@')
+    assert s3_mgr.check_catalog() == (False, {
+        'missing': ['pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3'],
+        'changed': [], 'stale': []})
+    s3_mgr.list()
+    assert s3_mgr.check_catalog() == (True, {'missing': [], 'changed': [], 'stale': []})
+    bucket.delete_key('z3/pool/fs@snap_1')
+    bucket.put('z3/pool/fs@snap_3', b'changed', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    assert s3_mgr.check_catalog() == (True, {
+        'missing': ['pool/fs@snap_4'],
+        'changed': ['pool/fs@snap_3'],
+        'stale': ['pool/fs@snap_1']})
+
+
+def test_rebuild_catalog(bucket):
+    s3_mgr = manager(bucket, snapshot_prefix='pool/fs@')
+    s3_mgr.list()
+    s3_mgr.catalog.entries['pool/fs@snap_2']['metadata'] = {'isfull': 'bogus'}
+    s3_mgr.catalog.entries['pool/fs@snap_9'] = {'metadata': {}, 'size': 1, 'etag': None}
+    s3_mgr.catalog.save()
+    bucket.requests.clear()
+    s3_mgr.rebuild_catalog()
+    assert bucket.requests['HEAD'] == 3
+    catalog = SnapshotCatalog(bucket, 'z3/', 'pool/fs')
+    assert catalog.load()
+    assert sorted(catalog.entries) == ['pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3']
+    assert catalog.entries['pool/fs@snap_2']['metadata'] == {'parent': 'pool/fs@snap_1'}
+
+
+def test_record_upload(bucket):
+    s3_mgr = manager(bucket)
+    s3_mgr.list()
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    s3_mgr.record_upload('pool/fs@snap_4')
+    bucket.requests.clear()
+    assert listed(manager(bucket))[-1] == ('pool/fs@snap_4', True, 5)
+    assert bucket.requests['HEAD'] == 0
+
+
+def test_record_upload_without_catalog(bucket):
+    manager(bucket, catalog=False).record_upload('pool/fs@snap_4')
+    assert bucket.requests == {}
+
+
+def test_record_upload_in_memory(bucket):
+    s3_mgr = manager(bucket, catalog=False)
+    assert listed(s3_mgr) == BUCKET_SNAPSHOTS
+    bucket.put('z3/pool/fs@snap_4', b'incr4', metadata={'parent': 'pool/fs@snap_3'})
+    bucket.requests.clear()
+    s3_mgr.record_upload('pool/fs@snap_4')
+    assert listed(s3_mgr)[-1] == ('pool/fs@snap_4', True, 5)
+    assert bucket.requests == {'HEAD': 1}  # not listed again
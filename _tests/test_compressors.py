@@ -0,0 +1,190 @@
+import pytest
+
+from z3.cache import open_cache
+from z3.compressors import (
+    AUTO, Compressor, CompressorError, CompressorRegistry, CompressorSelector, Trial, run_trial)
+from z3.config import OnionDict
+from z3.snap import PairManager, SoftError
+
+from _tests.fakes import FakeCommandExecutor, FakeZFSManager, MemoryBucket, s3_manager, zfs_line
+
+
+CONFIG = OnionDict([{'GPG_RECIPIENT': 'backups@example.com'}], sections={
+    'compressor:zstd-long': {
+        'COMPRESS_CMD': 'zstd -3 --long=27 -T{threads}', 'DECOMPRESS_CMD': 'zstd -d --long=27',
+        'COMPRESSOR_THREADS': '8'},
+    'compressor:xz': {'COMPRESSOR_THREADS': '2'},  # only changes the threads
+    'fs:pool/fs': {'COMPRESSOR': 'zstd-long'},
+})
+
+
+@pytest.mark.parametrize('name, compress, decompress', [
+    ('pigz1', 'pigz -1 --blocksize 4096', 'pigz -d'),
+    ('zstd3', 'zstd -3 -T0 -q', 'zstd -d -q'),
+    ('lz4', 'lz4 -1 -q -c', 'lz4 -d -q -c'),
+    ('xz', 'xz -6 -T0 -q -c', 'xz -d -T0 -q -c'),
+    ('gpg', 'gpg -e -r z3_backup', 'gpg -d'),
+])
+def test_builtin(name, compress, decompress):
+    compressor = CompressorRegistry().get(name)
+    assert (compressor.compress, compressor.decompress) == (compress, decompress)
+
+
+def test_from_config():
+    registry = CompressorRegistry.from_config(CONFIG)
+    assert registry.names()[-1] == 'zstd-long'
+    assert registry.get('zstd-long').compress == 'zstd -3 --long=27 -T8'
+    assert registry.get('xz').compress == 'xz -6 -T2 -q -c'
+    assert registry.get('zstd3').compress == 'zstd -3 -T0 -q'
+    assert registry.get('gpg').compress == 'gpg -e -r backups@example.com'
+    assert CompressorRegistry.from_config(
+        CONFIG, gpg_recipient='ops').get('gpg').compress == 'gpg -e -r ops'
+    assert registry.get('none') is None and registry.get(None) is None
+
+
+def test_errors():
+    with pytest.raises(CompressorError):
+        CompressorRegistry().get('bzip2')
+    with pytest.raises(CompressorError) as excinfo:
+        CompressorRegistry.from_config(OnionDict([{}], sections={
+            'compressor:half': {'COMPRESS_CMD': 'bzip2'}}))
+    assert 'DECOMPRESS_CMD' in str(excinfo.value)
+
+
+def pair_manager(bucket, lines='', **kwa):
+    return PairManager(
+        s3_manager(bucket), FakeZFSManager('pool/fs', 'snap_', lines=lines),
+        command_executor=FakeCommandExecutor(),
+        compressors=CompressorRegistry.from_config(CONFIG), **kwa)
+
+
+SNAP_1 = zfs_line('pool/fs@snap_1', refer='1M', written='1M', guid='g1', compressratio='1.00x')
+
+
+def test_restore_uses_recorded_compressor():
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'x', metadata={'isfull': 'true', 'compressor': 'zstd-long'})
+    bucket.put('z3/pool/fs@snap_2', b'x', metadata={'parent': 'pool/fs@snap_1',
+                                                    'compressor': 'pigz1'})
+    manager = pair_manager(bucket)
+    manager.restore('pool/fs@snap_2')
+    assert manager._cmd.commands == [
+        "z3_get z3/pool/fs@snap_1 | zstd -d --long=27 | zfs recv pool/fs@snap_1",
+        "z3_get z3/pool/fs@snap_2 | pigz -d | zfs recv pool/fs@snap_2",
+    ]
+
+
+def test_restore_unknown_compressor():
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'x', metadata={'isfull': 'true', 'compressor': 'brotli'})
+    with pytest.raises(SoftError) as excinfo:
+        pair_manager(bucket).restore('pool/fs@snap_1')
+    assert '[compressor:brotli]' in str(excinfo.value)
+
+
+# zstd3 squeezes the sample to a third at 50M/s, lz4 to a half at 400M/s
+TRIALS = {'zstd3': (1 / 3.0, 50e6), 'lz4': (0.5, 400e6), 'pigz1': (0.4, 20e6)}
+
+
+def fake_trial(compressor, sample):
+    if compressor.name not in TRIALS:
+        return None  # not installed
+    return Trial(compressor.name, *TRIALS[compressor.name])
+
+
+def selector(**kwa):
+    return CompressorSelector(CompressorRegistry(), trial=fake_trial, **kwa)
+
+
+@pytest.mark.parametrize('bandwidth, expected', [
+    (5e6, 'zstd3'),  # the upload is slow, the smallest stream that compresses fast enough
+    (100e6, 'lz4'),  # zstd3 would hold the upload back
+    (1e9, 'none'),  # compressing at all would
+])
+def test_pick(bandwidth, expected):
+    assert selector(bandwidth=bandwidth).pick(b'x') == expected
+
+
+def test_pick_incompressible():
+    registry = CompressorRegistry([Compressor('media', 'cat', 'cat')])
+    assert CompressorSelector(
+        registry, candidates=('none', 'media'), bandwidth=5e6,
+        trial=lambda compressor, sample: Trial('media', 1.01, 500e6)).pick(b'x') == 'none'
+
+
+def test_bandwidth_limit():
+    assert selector(bandwidth=1e9, rate_limit=5e6).pick(b'x') == 'zstd3'
+
+
+def test_run_trial():
+    trial = run_trial(Compressor('cat', 'cat', 'cat'), b'x' * 1024)
+    assert trial.name == 'cat' and trial.ratio == 1.0 and trial.rate > 0
+    assert run_trial(Compressor('missing', 'z3-no-such-command', 'cat'), b'x') is None
+
+
+def test_choice_is_cached(tmpdir):
+    samples = []
+
+    def read_sample(size):
+        samples.append(size)
+        return b'x'
+    cache = open_cache(str(tmpdir), 'bucket', 'z3/')
+    assert selector(bandwidth=5e6, cache=cache).choose('pool/fs', read_sample) == 'zstd3'
+    assert selector(bandwidth=1e9, cache=cache).choose('pool/fs', read_sample) == 'zstd3'
+    assert len(samples) == 1
+    assert selector(bandwidth=1e9, cache=cache, reevaluate_every=0).choose(
+        'pool/fs', read_sample) == 'none'
+    assert len(samples) == 2
+
+
+class FakeStage(object):
+    def __init__(self, size):
+        self.bytes = size
+
+
+class FakePipeline(object):
+    def __init__(self, size, duration, upload_bound):
+        self.stages = [FakeStage(size * 2), FakeStage(size)]
+        self.duration = duration
+        self.bottleneck = self.stages[1 if upload_bound else 0]
+
+
+def test_observe_upload_rate(tmpdir):
+    cache = open_cache(str(tmpdir), 'bucket', 'z3/')
+    sel = selector(cache=cache)
+    sel.observe(FakePipeline(1024, 1, upload_bound=True))  # too small to tell
+    assert cache.upload_rate() is None
+    sel.observe(FakePipeline(200 * 1024 ** 2, 10, upload_bound=True))
+    assert sel.upload_rate() == 20 * 1024 ** 2
+    # the compressor held the upload back, it could have gone faster
+    sel.observe(FakePipeline(100 * 1024 ** 2, 10, upload_bound=False))
+    assert sel.upload_rate() == 20 * 1024 ** 2
+    sel.observe(FakePipeline(100 * 1024 ** 2, 10, upload_bound=True))
+    assert sel.upload_rate() == 10 * 1024 ** 2
+
+
+def test_auto_backup_records_the_pick(monkeypatch):
+    manager = pair_manager(MemoryBucket(), SNAP_1, compressor=AUTO,
+                           selector=selector(bandwidth=5e6))
+    monkeypatch.setattr(manager, '_read_sample', lambda size: b'x')
+    manager.backup_full()
+    assert manager._cmd.commands == [
+        "zfs send 'pool/fs@snap_1' | zstd -3 -T0 -q | pput --quiet --estimated 1048576 "
+        "--meta size=1048576 --meta isfull=true --meta compressor=zstd3 z3/pool/fs@snap_1"]
+
+
+def test_auto_dry_run_reads_no_sample(monkeypatch):
+    manager = pair_manager(MemoryBucket(), SNAP_1, compressor=AUTO,
+                           selector=selector(candidates=('lz4', 'none')))
+
+    def read_sample(size):
+        raise AssertionError("a dry run started a send")
+    monkeypatch.setattr(manager, '_read_sample', read_sample)
+    manager.backup_full(dry_run=True)
+    assert '--meta compressor=lz4' in manager._cmd.commands[0]
+    assert manager._picked is None  # a real backup still makes its pick
+
+
+def test_auto_skipped_for_compressed_sends():
+    manager = pair_manager(MemoryBucket(), compressor=AUTO, send_flags=('-c',))
+    assert manager._stream_compressor is None
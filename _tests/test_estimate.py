@@ -0,0 +1,77 @@
+# pylint: disable=redefined-outer-name
+import pytest
+
+from z3.cache import open_cache
+from z3.estimate import SendSizeEstimator, compress_ratio
+
+from _tests.fakes import FakeZFSManager
+
+
+# hourly-1 isn't backed up but daily-2's written is relative to it
+LISTING = (
+    'pool/fs@daily-1\t1M\t10M\t-\t10M\tg1\t2.00x\n'
+    'pool/fs@daily-2\t1M\t11M\t-\t2M\tg2\t2.00x\n'
+    'pool/fs@hourly-1\t1M\t11M\t-\t1M\tg3\t2.00x\n'
+    'pool/fs@daily-3\t1M\t12M\t-\t1M\tg4\t1.50x\n'
+    'pool/fs@daily-4\t1M\t12M\t-\t1M\tg5\t-\n'
+)
+
+
+class DryRuns(object):
+    def __init__(self):
+        self.measured = []
+
+    def __call__(self, parent, z_snap):
+        self.measured.append((parent and parent.name, z_snap.name))
+        return 1234
+
+
+@pytest.fixture
+def snapshots():
+    zfs = FakeZFSManager(fs_name='pool/fs', snapshot_prefix='daily-', lines=LISTING)
+    return dict((z_snap.name.split('@')[1], z_snap) for z_snap in zfs.list())
+
+
+@pytest.mark.parametrize('value, expected', [('1.50x', 1.5), ('1.00', 1.0), ('-', None),
+                                             (None, None)])
+def test_compress_ratio(value, expected):
+    assert compress_ratio(value) == expected
+
+
+def test_sizes_from_properties(snapshots):
+    dry_runs = DryRuns()
+    estimator = SendSizeEstimator(dry_runs)
+    assert snapshots['daily-3'].previous == 'pool/fs@hourly-1'
+    assert estimator.estimate_many([
+        (None, snapshots['daily-1']),
+        (snapshots['daily-1'], snapshots['daily-2']),
+        (snapshots['daily-2'], snapshots['daily-3']),  # skips hourly-1
+        (snapshots['daily-3'], snapshots['daily-4']),  # no compression ratio
+    ]) == [20 * 1024 ** 2, 4 * 1024 ** 2, 1234, 1234]
+    assert sorted(dry_runs.measured) == [
+        ('pool/fs@daily-2', 'pool/fs@daily-3'), ('pool/fs@daily-3', 'pool/fs@daily-4')]
+
+
+def test_compressed_sends(snapshots):
+    estimator = SendSizeEstimator(DryRuns(), send_flags='-L -c ')
+    assert estimator.estimate(None, snapshots['daily-1']) == 10 * 1024 ** 2  # as stored
+
+
+def test_replication_streams_are_measured(snapshots):
+    dry_runs = DryRuns()
+    estimator = SendSizeEstimator(dry_runs, send_flags='-R ')
+    assert estimator.estimate(None, snapshots['daily-1']) == 1234
+    assert dry_runs.measured == [(None, 'pool/fs@daily-1')]
+
+
+def test_measured_once_across_runs(snapshots, tmpdir):
+    pair = (snapshots['daily-2'], snapshots['daily-3'])
+    for _ in range(2):
+        dry_runs = DryRuns()
+        cache = open_cache(str(tmpdir), 'bucket', 'z3/')
+        assert SendSizeEstimator(dry_runs, cache=cache).estimate(*pair) == 1234
+    assert dry_runs.measured == []
+    # the same pair sent as a replication stream is a different stream
+    dry_runs = DryRuns()
+    SendSizeEstimator(dry_runs, cache=cache, send_flags='-R ').estimate(*pair)
+    assert dry_runs.measured == [('pool/fs@daily-2', 'pool/fs@daily-3')]
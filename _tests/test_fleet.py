@@ -0,0 +1,83 @@
+# pylint: disable=redefined-outer-name
+import json
+
+import pytest
+
+from z3 import fleet
+from z3.snap import S3SnapshotManager, fleet_status
+
+from _tests.fakes import MemoryBucket
+
+
+NOW = 1462060800  # 2016-05-01
+HOUR = 3600
+
+
+@pytest.fixture
+def bucket():
+    bucket = MemoryBucket()
+
+    def put(name, metadata, hours_ago):
+        bucket.put('z3/' + name, b'data', metadata=metadata, last_modified=NOW - hours_ago * HOUR)
+    # backed up every day
+    put('pool/ok@d1', {'isfull': 'true'}, 50)
+    put('pool/ok@d2', {'parent': 'pool/ok@d1'}, 26)
+    put('pool/ok@d3', {'parent': 'pool/ok@d2'}, 2)
+    # no backups for 3 days
+    put('pool/stale@d1', {'isfull': 'true'}, 72)
+    # an old broken chain and a new full backup
+    put('pool/ok/child@d1', {'parent': 'pool/ok/child@d0'}, 50)
+    put('pool/ok/child@d2', {'isfull': 'true'}, 1)
+    # the latest backup can't be restored
+    put('tank@d1', {'isfull': 'true'}, 50)
+    put('tank@d3', {'parent': 'tank@d2'}, 1)
+    return bucket
+
+
+def manager(bucket, dataset):
+    return S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix=dataset + '@')
+
+
+def test_fleet_status(bucket):
+    statuses = fleet.fleet_status(
+        fleet.discover_datasets(bucket, 'z3/'),
+        make_manager=lambda dataset: manager(bucket, dataset),
+        max_age=lambda dataset: 26 * HOUR, now=NOW)
+    assert [(s.dataset, s.snapshots, s.latest, s.chain_length, s.broken, s.status)
+            for s in statuses] == [
+                ('pool/ok', 3, 'd3', 2, 0, fleet.OK),
+                ('pool/ok/child', 2, 'd2', 0, 1, fleet.OK),
+                ('pool/stale', 1, 'd1', 0, 0, fleet.STALE),
+                ('tank', 2, 'd3', None, 1, fleet.BROKEN),
+    ]
+    assert statuses[0].latest_age == pytest.approx(2 * HOUR)
+
+
+def test_failing_dataset(bucket):
+    def make_manager(dataset):
+        if dataset == 'tank':
+            raise IOError('access denied')
+        return manager(bucket, dataset)
+    statuses = fleet.fleet_status(['pool/ok', 'tank'], make_manager,
+                                  max_age=lambda dataset: 26 * HOUR, now=NOW)
+    assert [(s.dataset, s.status, s.error) for s in statuses] == [
+        ('pool/ok', fleet.OK, None), ('tank', fleet.ERROR, 'access denied')]
+
+
+def test_json_report(bucket, capsys):
+    assert fleet_status(bucket, 'z3/', patterns=['pool/*'], max_age_hours=26, as_json=True,
+                        now=NOW) == 1  # pool/stale
+    report = json.loads(capsys.readouterr()[0])
+    assert [(entry['dataset'], entry['status']) for entry in report] == [
+        ('pool/ok', 'ok'), ('pool/ok/child', 'ok'), ('pool/stale', 'stale')]
+
+
+def test_table_report(bucket, capsys):
+    assert fleet_status(bucket, 'z3/', patterns=['pool/ok*'], max_age_hours=26,
+                        now=NOW) is None
+    out = capsys.readouterr()[0]
+    assert out.splitlines() == [
+        "DATASET       | SNAPSHOTS | LATEST | AGE   | CHAIN | BROKEN | STATUS",
+        "pool/ok       |         3 | d3     | 2h00m |     2 |      0 | ok    ",
+        "pool/ok/child |         2 | d2     | 1h00m |     0 |      1 | ok    ",
+    ]
@@ -0,0 +1,96 @@
+import sys
+
+import pytest
+
+from z3.health import (analyze_indexed, classify, health_at, Health, CYCLE, MISSING_PARENT,
+                       NO_PARENT, PARENT_BROKEN, REASONS)
+
+
+NODES = {
+    # name: (is_full, parent, size)
+    'full': (True, None, 100),
+    'a': (False, 'full', 10),
+    'b': (False, 'a', 20),
+    'orphan': (False, 'expired', 10),
+    'orphan_child': (False, 'orphan', 10),
+    'no_parent': (False, None, 10),
+    'cycle_1': (False, 'cycle_2', 10),
+    'cycle_2': (False, 'cycle_1', 10),
+    'into_cycle': (False, 'cycle_1', 10),
+    'into_cycle_child': (False, 'into_cycle', 10),
+    'self_cycle': (False, 'self_cycle', 10),
+    'full_2': (True, 'b', 50),  # parent metadata is ignored for full backups
+}
+
+
+def analyze(nodes):
+    """Runs analyze_indexed over a dict of name -> (is_full, parent, size), returns
+    name -> Health
+    """
+    names = list(nodes)
+    index = dict((name, position) for position, name in enumerate(names))
+    reasons, depths, chain_sizes = analyze_indexed(
+        [nodes[name][0] for name in names],
+        [index.get(nodes[name][1], NO_PARENT) for name in names],
+        [nodes[name][2] for name in names])
+    return dict((name, health_at(reasons, depths, chain_sizes, position))
+                for position, name in enumerate(names))
+
+
+@pytest.mark.parametrize("name, expected", [
+    ('full', Health(None, 0, 100)),
+    ('a', Health(None, 1, 110)),
+    ('b', Health(None, 2, 130)),
+    ('full_2', Health(None, 0, 50)),
+    ('orphan', Health(MISSING_PARENT, None, None)),
+    ('orphan_child', Health(PARENT_BROKEN, None, None)),
+    ('no_parent', Health(MISSING_PARENT, None, None)),
+    ('cycle_1', Health(CYCLE, None, None)),
+    ('cycle_2', Health(CYCLE, None, None)),
+    ('into_cycle', Health(CYCLE, None, None)),
+    ('into_cycle_child', Health(CYCLE, None, None)),
+    ('self_cycle', Health(CYCLE, None, None)),
+])
+def test_analyze(name, expected):
+    assert analyze(NODES)[name] == expected
+
+
+@pytest.mark.parametrize("start", sorted(NODES))
+def test_analyze_order_independent(start):
+    # the result must not depend on where the walk starts
+    nodes = dict([(start, NODES[start])] + list(NODES.items()))
+    assert analyze(nodes) == analyze(NODES)
+
+
+def test_long_chain():
+    length = sys.getrecursionlimit() * 5
+    nodes = {'snap_0': (True, None, 1)}
+    for index in range(1, length):
+        nodes['snap_{}'.format(index)] = (False, 'snap_{}'.format(index - 1), 1)
+    result = analyze(nodes)
+    assert result['snap_{}'.format(length - 1)] == Health(None, length - 1, length)
+
+
+def test_long_broken_chain():
+    length = sys.getrecursionlimit() * 5
+    nodes = {'snap_0': (False, 'gone', 1)}
+    for index in range(1, length):
+        nodes['snap_{}'.format(index)] = (False, 'snap_{}'.format(index - 1), 1)
+    result = analyze(nodes)
+    assert result['snap_0'].reason == MISSING_PARENT
+    assert result['snap_{}'.format(length - 1)].reason == PARENT_BROKEN
+
+
+def test_analyze_indexed():
+    # full <- a <- b, an orphan and a self cycle
+    reasons, depths, chain_sizes = analyze_indexed(
+        [True, False, False, False, False], [NO_PARENT, 0, 1, NO_PARENT, 4],
+        [100, 10, None, 5, 5])
+    assert [REASONS[code] for code in reasons] == [None, None, None, MISSING_PARENT, CYCLE]
+    assert list(depths)[:3] == [0, 1, 2] and list(chain_sizes)[:3] == [100, 110, 110]
+
+
+def test_classify_alternate():
+    assert classify(False, Health(None, 3, 300), 5) == Health(None, 4, 305)
+    assert classify(False, None, 5) == Health(MISSING_PARENT, None, None)
+    assert classify(True, None, 5) == Health(None, 0, 5)
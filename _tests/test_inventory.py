@@ -0,0 +1,160 @@
+# pylint: disable=redefined-outer-name
+import gzip
+import json
+import os
+
+import pytest
+
+from z3.inventory import Inventory, InventoryError, open_inventory
+from z3.snap import S3SnapshotManager
+
+from _tests.fakes import MemoryBucket
+
+
+
+SCHEMA = "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag"
+CONFIG_FOLDER = 'inventory/memory-bucket/daily'
+
+
+def csv_report(rows):
+    lines = ''.join(
+        '"memory-bucket","{}","","{}","{}","4","2016-05-01T00:00:00.000Z","{}"\n'.format(
+            key.replace('@', '%40').replace(' ', '+'), is_latest, is_delete_marker, etag)
+        for key, etag, is_latest, is_delete_marker in rows)
+    return gzip.compress(lines.encode('utf8'))
+
+
+def manifest(data_keys, file_format='CSV'):
+    return {
+        'sourceBucket': 'memory-bucket',
+        'destinationBucket': 'arn:aws:s3:::memory-bucket',
+        'fileFormat': file_format,
+        'fileSchema': SCHEMA,
+        'creationTimestamp': '1462060800000',
+        'files': [{'key': key} for key in data_keys],
+    }
+
+
+@pytest.fixture
+def bucket():
+    """A bucket with an inventory report listing 2 snapshots and a third snapshot
+    uploaded since the report was taken.
+    """
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'full', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_2', b'incr', metadata={'parent': 'pool/fs@snap_1'})
+    rows = [
+        ('z3/pool/fs@snap_1', bucket.objects['z3/pool/fs@snap_1']['etag'].strip('"'), 'true',
+         'false'),
+        ('z3/pool/fs@snap_2', bucket.objects['z3/pool/fs@snap_2']['etag'].strip('"'), 'true',
+         'false'),
+        ('z3/pool/fs@snap_0', 'old-version', 'false', 'false'),
+        ('z3/pool/fs@snap_0', 'deleted', 'true', 'true'),
+        ('z3/pool/other@snap_1', 'other', 'true', 'false'),
+        ('unrelated key', 'unrelated', 'true', 'false'),
+    ]
+    bucket.put(CONFIG_FOLDER + '/data/part-0.csv.gz', csv_report(rows[:3]))
+    bucket.put(CONFIG_FOLDER + '/data/part-1.csv.gz', csv_report(rows[3:]))
+    bucket.put(CONFIG_FOLDER + '/2016-04-30T00-00Z/manifest.json', b'{"stale": true}')
+    bucket.put(CONFIG_FOLDER + '/2016-05-01T00-00Z/manifest.json', json.dumps(manifest(
+        [CONFIG_FOLDER + '/data/part-0.csv.gz', CONFIG_FOLDER + '/data/part-1.csv.gz'])))
+    bucket.put('z3/pool/fs@snap_3', b'incr', metadata={'parent': 'pool/fs@snap_2'})
+    bucket.requests.clear()
+    return bucket
+
+
+def test_csv_report(bucket):
+    inventory = open_inventory('s3://memory-bucket/' + CONFIG_FOLDER, bucket, prefix='z3/')
+    assert inventory.created.isoformat() == '2016-05-01T00:00:00'
+    assert inventory.keys('z3/pool/fs@') == {
+        'z3/pool/fs@snap_1': bucket.objects['z3/pool/fs@snap_1']['etag'],
+        'z3/pool/fs@snap_2': bucket.objects['z3/pool/fs@snap_2']['etag'],
+    }
+    assert list(inventory.keys('z3/')) == [
+        'z3/pool/fs@snap_1', 'z3/pool/fs@snap_2', 'z3/pool/other@snap_1']
+    with pytest.raises(AssertionError):
+        inventory.keys('unrelated')
+
+
+def test_local_report(bucket, tmpdir):
+    for key_name, obj in bucket.objects.items():
+        if key_name.startswith(CONFIG_FOLDER):
+            path = tmpdir.join(key_name[len(CONFIG_FOLDER):])
+            path.write_binary(obj['data'], ensure=True)
+    inventory = open_inventory(str(tmpdir), bucket, prefix='z3/pool/')
+    assert sorted(inventory.keys()) == [
+        'z3/pool/fs@snap_1', 'z3/pool/fs@snap_2', 'z3/pool/other@snap_1']
+
+
+def test_report_without_etags(bucket):
+    schema = "Bucket, Key, Size"
+    lines = '"memory-bucket","z3/pool/fs%40snap_1","4"\n"memory-bucket","z3/pool/fs%40snap_2","4"\n'
+    bucket.put('inventory/no-etag/part-0.csv.gz', gzip.compress(lines.encode('utf8')))
+    bucket.put('inventory/no-etag/manifest.json', json.dumps(dict(
+        manifest(['inventory/no-etag/part-0.csv.gz']), fileSchema=schema)))
+    inventory = open_inventory('s3://memory-bucket/inventory/no-etag/manifest.json', bucket,
+                               prefix='z3/')
+    assert inventory.keys('z3/pool/fs@') == {'z3/pool/fs@snap_1': None, 'z3/pool/fs@snap_2': None}
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_',
+                               inventory=inventory)
+    assert [s.name for s in s3_mgr.list()] == [
+        'pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs@snap_3']
+
+
+@pytest.mark.parametrize("catalog", [False, True])
+def test_keys_deleted_since_the_report(bucket, catalog):
+    inventory = open_inventory('s3://memory-bucket/' + CONFIG_FOLDER, bucket, prefix='z3/')
+    bucket.delete_key('z3/pool/fs@snap_2')  # eg. pruned
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_',
+                               inventory=inventory, catalog=catalog)
+    assert [(s.name, s.reason_broken) for s in s3_mgr.list()] == [
+        ('pool/fs@snap_1', None), ('pool/fs@snap_3', 'missing parent')]
+
+
+def test_wrong_bucket(bucket):
+    other = dict(manifest([]), sourceBucket='other-bucket')
+    bucket.put('inventory/other-bucket/daily/2016-05-01T00-00Z/manifest.json', json.dumps(other))
+    with pytest.raises(InventoryError):
+        open_inventory('s3://memory-bucket/inventory/other-bucket/daily', bucket)
+
+
+@pytest.mark.parametrize("file_format", ['Parquet', 'ORC'])
+def test_arrow_report(tmpdir, file_format):
+    pyarrow = pytest.importorskip('pyarrow')
+    table = pyarrow.table({
+        'bucket': ['memory-bucket'] * 2,
+        'key': ['z3/pool/fs@snap_1', 'z3/pool/fs@snap_2'],
+        'size': [4, 4],
+        'e_tag': ['etag1', 'etag2'],
+        'is_delete_marker': [False, True],
+    })
+    path = str(tmpdir.join('part-0'))
+    if file_format == 'ORC':
+        from pyarrow import orc
+        orc.write_table(table, path)
+    else:
+        from pyarrow import parquet
+        parquet.write_table(table, path)
+
+    def open_file(key):
+        return open(os.path.join(str(tmpdir), key), 'rb')
+    inventory = Inventory(manifest(['part-0'], file_format=file_format), open_file)
+    assert inventory.keys('z3/') == {'z3/pool/fs@snap_1': '"etag1"'}
+
+
+def test_manager_lists_keys_added_since_the_report(bucket):
+    inventory = open_inventory('s3://memory-bucket/' + CONFIG_FOLDER, bucket, prefix='z3/')
+    bucket.requests.clear()
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_',
+                               inventory=inventory)
+    listed = []
+    original_list = bucket.list
+
+    def spy(prefix='', delimiter='', marker='', *a, **kwa):
+        keys = list(original_list(prefix, delimiter, marker, *a, **kwa))
+        listed.extend(key.name for key in keys)
+        return keys
+    bucket.list = spy
+    assert [(s.name, s.is_healthy) for s in s3_mgr.list()] == [
+        ('pool/fs@snap_1', True), ('pool/fs@snap_2', True), ('pool/fs@snap_3', True)]
+    assert listed == ['z3/pool/fs@snap_3']
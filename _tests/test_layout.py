@@ -0,0 +1,104 @@
+# pylint: disable=redefined-outer-name
+import pytest
+
+from z3 import layout
+from z3.scheduler import Scheduler
+from z3.snap import S3SnapshotManager, list_s3_datasets, migrate_layout
+
+from _tests.fakes import MemoryBucket
+
+
+SHARD = layout.shard_prefix('pool/fs')
+
+
+@pytest.fixture
+def bucket():
+    """pool/fs has 2 backups in the flat layout and one in the sharded layout"""
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'full', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_2', b'incr', metadata={'parent': 'pool/fs@snap_1'})
+    bucket.put('z3/' + SHARD + 'pool/fs@snap_3', b'incr', metadata={'parent': 'pool/fs@snap_2'})
+    bucket.requests.clear()
+    return bucket
+
+
+def test_shard_prefix():
+    assert layout.shard_prefix('pool/fs') == SHARD
+    assert len(SHARD) == 3 and SHARD.endswith('/')
+    assert layout.unshard(SHARD + 'pool/fs@snap_1') == 'pool/fs@snap_1'
+    assert layout.unshard('pool/fs@snap_1') == 'pool/fs@snap_1'
+    # a pool named like a shard, but not the shard of its dataset
+    other = ('00' if layout.shard_prefix('fs') != '00/' else '01') + '/fs'
+    assert layout.unshard(other + '@snap_1') == other + '@snap_1'
+
+
+def test_manager_reads_both_layouts(bucket):
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@',
+                               sharded=True)
+    assert [(s.name, s.key, s.is_healthy) for s in s3_mgr.list()] == [
+        ('pool/fs@snap_1', 'pool/fs@snap_1', True),
+        ('pool/fs@snap_2', 'pool/fs@snap_2', True),
+        ('pool/fs@snap_3', SHARD + 'pool/fs@snap_3', True),
+    ]
+    assert s3_mgr.upload_key('pool/fs@snap_4') == SHARD + 'pool/fs@snap_4'
+    flat = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@')
+    assert flat.upload_key('pool/fs@snap_4') == 'pool/fs@snap_4'
+
+
+def test_discover_sharded_datasets(bucket):
+    assert list_s3_datasets(bucket, 'z3/') == ['pool/fs']
+
+
+def test_migration(bucket):
+    jobs = layout.migration_jobs(bucket, 'z3/', 'pool/fs')
+    assert sorted(job.name for job in jobs) == ['z3/pool/fs@snap_1', 'z3/pool/fs@snap_2']
+    assert all(result.success for result in Scheduler(concurrency=2).run(jobs))
+    assert bucket.objects['z3/' + SHARD + 'pool/fs@snap_2']['metadata'] == {
+        'parent': 'pool/fs@snap_1'}
+    # a key in both layouts is only read once, from the sharded layout
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@',
+                               sharded=True)
+    assert [s.key for s in s3_mgr.objects()] == [
+        SHARD + 'pool/fs@snap_1', SHARD + 'pool/fs@snap_2', SHARD + 'pool/fs@snap_3']
+    # copied keys aren't copied again
+    assert layout.migration_jobs(bucket, 'z3/', 'pool/fs') == []
+
+
+def test_migrate_and_delete(bucket, capsys):
+    assert migrate_layout(bucket, 'z3/', dry=True) is None
+    assert bucket.requests['COPY'] == 0
+    assert "would migrate 2 keys" in capsys.readouterr()[0]
+    assert migrate_layout(bucket, 'z3/', patterns=['pool/*'], delete=True) is None
+    assert sorted(bucket.objects) == [
+        'z3/' + SHARD + 'pool/fs@snap_1', 'z3/' + SHARD + 'pool/fs@snap_2',
+        'z3/' + SHARD + 'pool/fs@snap_3']
+
+
+def test_multipart_copy(bucket, monkeypatch):
+    monkeypatch.setattr(layout, 'COPY_LIMIT', 2)
+    bucket.put('z3/big', b'0123456789', metadata={'isfull': 'true'})
+    layout.copy_key(bucket, 'z3/big', 'z3/big-copy', 10, part_size=3)
+    assert bucket.objects['z3/big-copy']['data'] == b'0123456789'
+    assert bucket.objects['z3/big-copy']['metadata'] == {'isfull': 'true'}
+    assert bucket.requests['COPY'] == 4  # parts of 3, 3, 3 and 1 bytes
+
+
+@pytest.mark.parametrize('copy_limit', [1024, 2])  # single copy and multipart copy
+def test_copy_keeps_storage_class(bucket, monkeypatch, copy_limit):
+    monkeypatch.setattr(layout, 'COPY_LIMIT', copy_limit)
+    bucket.put('z3/pool/fs@snap_2', b'incr', metadata={'parent': 'pool/fs@snap_1'},
+               headers={'x-amz-storage-class': 'STANDARD_IA'})
+    assert all(result.success for result in Scheduler().run(
+        layout.migration_jobs(bucket, 'z3/', 'pool/fs')))
+    copied = bucket.get_key('z3/' + SHARD + 'pool/fs@snap_2')
+    assert copied.storage_class == 'STANDARD_IA'
+    assert bucket.get_key('z3/' + SHARD + 'pool/fs@snap_1').storage_class == 'STANDARD'
+    layout.copy_key(bucket, 'z3/pool/fs@snap_2', 'z3/copy', 4)  # reads it from the source
+    assert bucket.get_key('z3/copy').storage_class == 'STANDARD_IA'
+
+
+def test_incomplete_copy(bucket, monkeypatch):
+    monkeypatch.setattr(layout, 'copy_key', lambda *a, **kwa: None)
+    results = Scheduler().run(layout.migration_jobs(bucket, 'z3/', 'pool/fs', delete=True))
+    assert not any(result.success for result in results)
+    assert 'z3/pool/fs@snap_1' in bucket.objects  # nothing is deleted
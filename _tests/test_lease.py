@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+from z3.lease import CLAIM_PREFIX, SLOT_PREFIX, Coordinator, LeaseError, LeaseStore
+from z3.snap import PairManager
+
+from _tests.fakes import FakeCommandExecutor, FakeZFSManager, MemoryBucket, s3_manager, zfs_line
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def store(bucket, owner, clock):
+    return LeaseStore(bucket, 'z3/', owner=owner, duration=60, clock=clock)
+
+
+def test_only_one_owner(clock):
+    bucket = MemoryBucket()
+    host_a, host_b = store(bucket, 'a', clock), store(bucket, 'b', clock)
+    lease = host_a.acquire('pool/fs@snap_1')
+    assert lease is not None and host_b.acquire('pool/fs@snap_1') is None
+    # '@' is escaped, the lease doesn't look like a backup of a dataset
+    assert list(bucket.objects) == ['z3/.z3/leases/pool/fs%40snap_1']
+    assert host_b.read('pool/fs@snap_1')[0]['owner'] == 'a'
+    host_a.release(lease)
+    assert bucket.objects == {}
+    assert host_b.acquire('pool/fs@snap_1') is not None
+
+
+def test_expired_lease_is_taken_over(clock):
+    bucket = MemoryBucket()
+    host_a, host_b = store(bucket, 'a', clock), store(bucket, 'b', clock)
+    lease = host_a.acquire('slot')
+    clock.now += 30
+    assert host_a.renew(lease)
+    clock.now += 61  # host a died
+    taken = host_b.acquire('slot')
+    assert taken is not None
+    assert not host_a.renew(lease)
+    host_a.release(lease)  # late, it's not deleted under host b
+    assert host_b.read('slot')[0]['owner'] == 'b'
+    host_b.release(taken)
+    assert bucket.objects == {}
+
+
+def test_racing_hosts(clock):
+    bucket = MemoryBucket()
+    start, won = threading.Barrier(8), []
+
+    def race(owner):
+        start.wait()
+        if store(bucket, owner, clock).acquire('slot') is not None:
+            won.append(owner)
+    threads = [threading.Thread(target=race, args=(str(index),)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(won) == 1
+
+
+def test_claims_stop_at_the_first_taken(clock):
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_4', b'uploaded since')
+    other = store(bucket, 'other', clock).acquire(CLAIM_PREFIX + 'pool/fs@snap_3')
+    coordinator = Coordinator(store(bucket, 'me', clock))
+    keys = ['pool/fs@snap_2', 'pool/fs@snap_3']
+    with coordinator.claim(keys) as claimed:
+        assert claimed == ['pool/fs@snap_2']
+    with coordinator.claim(['pool/fs@snap_4']) as claimed:
+        assert claimed == []
+    assert sorted(bucket.objects) == [other.key_name, 'z3/pool/fs@snap_4']  # released
+    with Coordinator(store(bucket, 'me', clock), claims=False).claim(keys) as claimed:
+        assert claimed == keys
+
+
+def test_upload_slots(clock):
+    bucket = MemoryBucket()
+    waits = []
+
+    def coordinator(owner):
+        return Coordinator(store(bucket, owner, clock), claims=False, slots=2,
+                           slot_wait=50, poll=30, sleep=waits.append)
+    slot_a, slot_b = coordinator('a').acquire_slot(), coordinator('b').acquire_slot()
+    assert sorted([slot_a.name, slot_b.name]) == [SLOT_PREFIX + '0', SLOT_PREFIX + '1']
+    host_c = coordinator('c')
+
+    def sleep(seconds):
+        waits.append(seconds)
+        clock.now += 50
+    host_c.sleep = sleep
+    with pytest.raises(LeaseError):
+        host_c.acquire_slot()  # the slots would expire after 60s
+    assert len(waits) == 1
+    coordinator('a').release_slot(slot_a)
+    assert host_c.acquire_slot().name == slot_a.name
+    assert Coordinator(store(bucket, 'd', clock), slots=0).acquire_slot() is None
+
+
+def test_backup_skips_snapshots_claimed_elsewhere(clock):
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'x', metadata={'isfull': 'true'})
+    store(bucket, 'other', clock).acquire(CLAIM_PREFIX + 'pool/fs@snap_3')
+    coordinator = Coordinator(store(bucket, 'me', clock), slots=4)
+    lines = ''.join(zfs_line('pool/fs@snap_{}'.format(index), refer='1M', written='1M',
+                             guid='g{}'.format(index), compressratio='1.00x')
+                    for index in range(1, 4))
+    manager = PairManager(
+        s3_manager(bucket), FakeZFSManager('pool/fs', 'snap_', lines=lines),
+        command_executor=FakeCommandExecutor(), coordinator=coordinator)
+    uploaded = manager.backup_incremental()
+    assert [meta['snap_name'] for meta in uploaded] == ['pool/fs@snap_2']
+    assert [command.split()[-1] for command in manager._cmd.commands] == ['z3/pool/fs@snap_2']
+    # the claim and the slot are released
+    assert [name for name in bucket.objects if '.z3/' in name] == [
+        'z3/.z3/leases/claims/pool/fs%40snap_3']
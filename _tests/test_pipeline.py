@@ -0,0 +1,136 @@
+import io
+import shlex
+import sys
+import time
+
+import pytest
+
+from z3.pipeline import (
+    Pipeline, PipelineError, Progress, RateLimiter, Sink, split_pipeline)
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+# writes 4M, then exits with the status given as argument
+PRODUCER = python(
+    "import sys; sys.stdout.buffer.write(b'x' * (4 * 1024 * 1024)); sys.stdout.flush(); "
+    "sys.exit(int(sys.argv[1]))")
+# counts what it reads in to the file given as argument
+COUNTER = python(
+    "import sys; size = len(sys.stdin.buffer.read()); open(sys.argv[1], 'w').write(str(size))")
+SLOW = python(
+    "import sys, time\n"
+    "while True:\n"
+    "    chunk = sys.stdin.buffer.read(256 * 1024)\n"
+    "    if not chunk: break\n"
+    "    time.sleep(0.02)\n"
+    "    sys.stdout.buffer.write(chunk)\n")
+CAT = python("import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)")
+
+
+@pytest.mark.parametrize('cmd, expected', [
+    ("zfs send 'pool/fs@snap' | pigz -1 | pput --meta parent=pool/fs@a z3/pool/fs@snap",
+     [['zfs', 'send', 'pool/fs@snap'], ['pigz', '-1'],
+      ['pput', '--meta', 'parent=pool/fs@a', 'z3/pool/fs@snap']]),
+    ("zfs send -I a b | ssh host -C 'mbuffer -q | sudo zfs recv -d fs'",
+     [['zfs', 'send', '-I', 'a', 'b'], ['ssh', 'host', '-C', 'mbuffer -q | sudo zfs recv -d fs']]),
+    ("z3_get key|pigz -d", [['z3_get', 'key'], ['pigz', '-d']]),
+])
+def test_split_pipeline(cmd, expected):
+    assert split_pipeline(cmd) == expected
+
+
+def test_split_pipeline_empty_stage():
+    with pytest.raises(ValueError):
+        split_pipeline("zfs send | | pput")
+
+
+def test_relays_everything(tmpdir):
+    count = str(tmpdir.join('count'))
+    pipeline = Pipeline([PRODUCER + ['0'], CAT, COUNTER + [count]]).run()
+    assert open(count).read() == str(4 * 1024 * 1024)
+    assert [stage.bytes for stage in pipeline.stages] == [4 * 1024 * 1024] * 3
+
+
+def test_bottleneck(tmpdir):
+    pipeline = Pipeline([PRODUCER + ['0'], SLOW, COUNTER + [str(tmpdir.join('count'))]]).run()
+    assert pipeline.bottleneck is pipeline.stages[1]
+    assert pipeline.summary().endswith("bottleneck: {}".format(pipeline.stages[1].name))
+
+
+def test_every_status_is_checked(tmpdir):
+    """The first stage fails after writing everything, the rest are stopped before they
+    see the end of the stream and take a cut stream for a whole one.
+    """
+    count = tmpdir.join('count')
+    with pytest.raises(PipelineError) as excinfo:
+        Pipeline([PRODUCER + ['3'], CAT, COUNTER + [str(count)]]).run()
+    assert excinfo.value.returncode == 3
+    assert excinfo.value.cmd == " ".join(shlex.quote(arg) for arg in PRODUCER + ['3'])
+    assert not count.exists()
+
+
+def test_failing_consumer(tmpdir):
+    with pytest.raises(PipelineError) as excinfo:
+        Pipeline([PRODUCER + ['0'], python("import sys; sys.exit(2)")]).run()
+    assert excinfo.value.returncode == 2  # not the SIGPIPE of the producer
+
+
+def test_missing_command():
+    with pytest.raises(OSError):
+        Pipeline([PRODUCER + ['0'], ['z3-no-such-command']]).run()
+
+
+def test_rate_limit(tmpdir):
+    started = time.monotonic()
+    Pipeline([PRODUCER + ['0'], COUNTER + [str(tmpdir.join('count'))]],
+             limiter=RateLimiter(16 * 1024 * 1024)).run()
+    assert time.monotonic() - started >= 0.2  # 4M at 16M/s
+
+
+def test_progress(tmpdir):
+    out = io.StringIO()
+    Pipeline([PRODUCER + ['0'], COUNTER + [str(tmpdir.join('count'))]],
+             progress=Progress(estimated_size=8 * 1024 * 1024, out=out)).run()
+    assert out.getvalue().splitlines()[-1].split('\r')[-1].startswith(
+        "4.0 MiB at ") and out.getvalue().endswith("(50% of ~8.0 MiB)\n")
+
+
+class Reader(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.stopped = None
+
+    def __call__(self, stream, stopped):
+        size = len(stream.read())
+        self.stopped = stopped()
+        if self.fail:
+            raise ValueError("no space left")
+        return size
+
+
+def test_sink():
+    pipeline = Pipeline([PRODUCER + ['0'], CAT, Sink('reader', Reader())]).run()
+    assert pipeline.stages[-1].process.result == 4 * 1024 * 1024
+    assert [stage.name for stage in pipeline.stages][-1] == 'reader'
+
+
+def test_sink_sees_a_cut_stream():
+    reader = Reader()
+    with pytest.raises(PipelineError) as excinfo:
+        Pipeline([PRODUCER + ['3'], Sink('reader', reader)]).run()
+    assert excinfo.value.returncode == 3
+    assert reader.stopped is True
+
+
+def test_failing_sink():
+    with pytest.raises(PipelineError) as excinfo:
+        Pipeline([PRODUCER + ['0'], Sink('reader', Reader(fail=True))]).run()
+    assert str(excinfo.value) == "'reader' failed: no space left"
+
+
+def test_sink_only_last():
+    with pytest.raises(ValueError):
+        Pipeline([Sink('reader', Reader()), CAT])
@@ -0,0 +1,101 @@
+# pylint: disable=redefined-outer-name
+import pytest
+
+from z3.planner import RestorePlanner
+from z3.snap import S3SnapshotManager
+
+from _tests.fakes import FakeZFSManager, zfs_line
+
+
+class FakeKey(object):
+    def __init__(self, name, metadata=None, size=None):
+        self.name = name
+        self.key = name
+        self.metadata = metadata
+        self.size = size
+
+
+class FakeBucket(object):
+    """Holds a full backup, a chain of 5 dailies, a cumulative incremental for the last
+    daily and a daily with a missing parent.
+    """
+    def __init__(self, cumulative_size):
+        self.fake_data = {
+            "pool/fs@d0": ({'isfull': 'true'}, 1000),
+            "pool/fs@d1": ({'parent': 'pool/fs@d0'}, 100),
+            "pool/fs@d2": ({'parent': 'pool/fs@d1'}, 100),
+            "pool/fs@d3": ({'parent': 'pool/fs@d2'}, 100),
+            "pool/fs@d4": ({'parent': 'pool/fs@d3'}, 100),
+            "pool/fs@d5": ({'parent': 'pool/fs@d4'}, 100),
+            "pool/fs@d5~d0": ({'parent': 'pool/fs@d0'}, cumulative_size),
+            "pool/fs@d7": ({'parent': 'pool/fs@d6'}, 100),
+        }
+
+    def list(self, *a, **kwa):
+        return (FakeKey("z3/" + name) for name in self.fake_data)
+
+    def get_key(self, key):
+        metadata, size = self.fake_data[key[len("z3/"):]]
+        return FakeKey(key, metadata=metadata, size=size)
+
+
+def make_planner(cumulative_size, local=(), metric=RestorePlanner.BYTES):
+    s3_mgr = S3SnapshotManager(FakeBucket(cumulative_size), s3_prefix='z3/',
+                               snapshot_prefix='pool/fs@d')
+    lines = ''.join(zfs_line('pool/fs@' + name, refer='19K', written='19K') for name in local)
+    return RestorePlanner(s3_mgr, FakeZFSManager('pool/fs', 'd', lines=lines), metric=metric)
+
+
+def keys(plan):
+    return [s3_obj.key for s3_obj in plan] if plan is not None else None
+
+
+@pytest.mark.parametrize("cumulative_size, metric, expected", [
+    # the cumulative delta is cheaper than the 5 dailies
+    (150, RestorePlanner.BYTES, ['pool/fs@d0', 'pool/fs@d5~d0']),
+    # the dailies move fewer bytes...
+    (800, RestorePlanner.BYTES,
+     ['pool/fs@d0', 'pool/fs@d1', 'pool/fs@d2', 'pool/fs@d3', 'pool/fs@d4', 'pool/fs@d5']),
+    # ...but the cumulative delta applies fewer streams
+    (800, RestorePlanner.STREAMS, ['pool/fs@d0', 'pool/fs@d5~d0']),
+])
+def test_cheapest_chain(cumulative_size, metric, expected):
+    planner = make_planner(cumulative_size, metric=metric)
+    assert keys(planner.plan('pool/fs@d5')) == expected
+
+
+def test_local_snapshot_is_free():
+    planner = make_planner(150, local=['d0', 'd1', 'd2', 'd3', 'd4'])
+    assert keys(planner.plan('pool/fs@d5')) == ['pool/fs@d5']
+    assert planner.estimate('pool/fs@d5') == (100, 1)
+
+
+def test_local_target():
+    planner = make_planner(150, local=['d0', 'd1'])
+    assert planner.plan('pool/fs@d1') == []
+    assert planner.estimate('pool/fs@d1') == (0, 0)
+
+
+def test_unreachable():
+    planner = make_planner(150)
+    assert planner.plan('pool/fs@d7') is None
+    assert planner.estimate('pool/fs@d7') is None
+    assert planner.plan('pool/fs@nope') is None
+
+
+def test_estimate():
+    planner = make_planner(150)
+    assert planner.estimate('pool/fs@d3') == (1300, 4)
+    assert planner.estimate('pool/fs@d5') == (1150, 2)
+    # always (bytes, streams), whichever metric picked the chain
+    planner = make_planner(800, metric=RestorePlanner.STREAMS)
+    assert planner.estimate('pool/fs@d5') == (1800, 2)
+
+
+def test_alternates_are_not_listed():
+    s3_mgr = S3SnapshotManager(FakeBucket(150), s3_prefix='z3/', snapshot_prefix='pool/fs@d')
+    assert [s.key for s in s3_mgr.list()] == [
+        'pool/fs@d0', 'pool/fs@d1', 'pool/fs@d2', 'pool/fs@d3', 'pool/fs@d4', 'pool/fs@d5',
+        'pool/fs@d7']
+    assert sorted(s.key for s in s3_mgr.objects('pool/fs@d5')) == [
+        'pool/fs@d5', 'pool/fs@d5~d0']
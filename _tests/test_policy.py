@@ -0,0 +1,128 @@
+# pylint: disable=redefined-outer-name
+import time
+
+import pytest
+
+from z3.config import OnionDict
+from z3.policy import FullBackupPolicy
+from z3.snap import PairManager
+
+from _tests.fakes import FakeCommandExecutor, FakeZFSManager, MemoryBucket, s3_manager, zfs_line
+
+
+DAY = 24 * 3600
+
+
+def zfs_manager(snapshots, written=0, compressratio='-'):
+    lines = ''.join(zfs_line('pool/fs@' + name, written=str(written), guid='g' + name,
+                             compressratio=compressratio) for name in snapshots)
+    return FakeZFSManager('pool/fs', 'd', lines=lines)
+
+
+@pytest.fixture
+def bucket():
+    """A full backup of d0 uploaded 10 days ago and 2 incrementals on top of it"""
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@d0', b'f' * 1000, metadata={'isfull': 'true'},
+               last_modified=time.time() - 10 * DAY)
+    bucket.put('z3/pool/fs@d1', b'i' * 300, metadata={'parent': 'pool/fs@d0'})
+    bucket.put('z3/pool/fs@d2', b'i' * 300, metadata={'parent': 'pool/fs@d1'})
+    return bucket
+
+
+def backup(bucket, policy, estimates=None, local=('d0', 'd1', 'd2', 'd3', 'd4'), written=0,
+           compressratio='-'):
+    """Runs an incremental backup, returns the commands it ran"""
+    cmd = FakeCommandExecutor(estimates, size=100)
+    pair_manager = PairManager(
+        s3_manager(bucket, snapshot_prefix='pool/fs@d'),
+        zfs_manager(local, written, compressratio), command_executor=cmd,
+        full_policy=policy)
+    uploaded = pair_manager.backup_incremental(dry_run=True)
+    return uploaded, [command for command in cmd.commands if 'pput' in command]
+
+
+@pytest.mark.parametrize('policy, reason', [
+    (FullBackupPolicy(max_chain_length=4), None),
+    (FullBackupPolicy(max_chain_length=3), "chain of 4 incrementals is longer than 3"),
+    (FullBackupPolicy(max_incremental_ratio=0.5),
+     "incrementals are 0.60 times the size of the full backup"),
+    (FullBackupPolicy(max_incremental_ratio=1), None),
+    (FullBackupPolicy(max_full_age=7 * DAY), "full backup is 10.0 days old"),
+    (FullBackupPolicy(max_full_age=30 * DAY), None),
+])
+def test_thresholds(bucket, policy, reason):
+    uploaded, pputs = backup(bucket, policy)
+    assert [meta.get('reason') for meta in uploaded] == (
+        [reason] if reason else [None, None])
+    if reason:
+        assert len(pputs) == 1 and '--meta isfull=true' in pputs[0]
+        assert pputs[0].endswith('z3/pool/fs@d4')
+    else:
+        assert [pput.split()[-1] for pput in pputs] == ['z3/pool/fs@d3', 'z3/pool/fs@d4']
+
+
+def test_ratio_counts_pending_incrementals(bucket):
+    # 600 bytes uploaded and 2 x 150 written since, over 0.8 of the full backup
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_incremental_ratio=0.8), written=150)
+    assert uploaded[0]['reason'] == "incrementals are 0.90 times the size of the full backup"
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_incremental_ratio=0.95), written=150)
+    assert [meta['snap_name'] for meta in uploaded] == ['pool/fs@d3', 'pool/fs@d4']
+
+
+def test_ratio_compares_compressed_sizes(bucket):
+    # the 4000 byte stream of the full backup takes 1000 bytes in S3, the 2 pending
+    # streams of 150 bytes on disk x 2.00 compressratio shrink the same way: 150 bytes
+    bucket.put('z3/pool/fs@d0', b'f' * 1000, metadata={'isfull': 'true', 'size': '4000'})
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_incremental_ratio=0.8), written=150,
+                         compressratio='2.00x')
+    assert [meta['snap_name'] for meta in uploaded] == ['pool/fs@d3', 'pool/fs@d4']
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_incremental_ratio=0.7), written=150,
+                         compressratio='2.00x')
+    assert uploaded[0]['reason'] == "incrementals are 0.75 times the size of the full backup"
+
+
+def test_estimate_ratio(bucket):
+    estimates = {"zfs send -nvP -i 'pool/fs@d2' 'pool/fs@d4'": 800,
+                 "zfs send -nvP 'pool/fs@d4'": 1000}
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_estimate_ratio=0.75), estimates)
+    assert uploaded[0]['reason'] == "incremental send is 0.80 times the size of a full send"
+    uploaded, _ = backup(bucket, FullBackupPolicy(max_estimate_ratio=0.9), estimates)
+    assert [meta['snap_name'] for meta in uploaded] == ['pool/fs@d3', 'pool/fs@d4']
+
+
+def test_cheap_checks_first(bucket):
+    """The full backup's age isn't read and no dry-run send is made when the chain
+    is already too long.
+    """
+    bucket.requests.clear()
+    cmd = FakeCommandExecutor(size=100)
+    pair_manager = PairManager(
+        s3_manager(bucket, snapshot_prefix='pool/fs@d'),
+        zfs_manager(('d0', 'd1', 'd2', 'd3')), command_executor=cmd,
+        full_policy=FullBackupPolicy(max_chain_length=1, max_full_age=DAY,
+                                     max_estimate_ratio=0.1))
+    pair_manager.backup_incremental(dry_run=True)
+    assert cmd.commands[0] == "zfs send -nvP 'pool/fs@d3'"  # backup_full's estimate
+    assert bucket.requests['HEAD'] == 3  # metadata of the 3 backups, not the age
+
+
+def test_nothing_to_upload(bucket):
+    uploaded, pputs = backup(bucket, FullBackupPolicy(max_chain_length=0),
+                             local=('d0', 'd1', 'd2'))
+    assert uploaded == [] and pputs == []
+
+
+def test_no_earlier_backup():
+    uploaded, _ = backup(MemoryBucket(), FullBackupPolicy(max_chain_length=10))
+    assert uploaded[0]['reason'] == "no earlier backup to build on"
+
+
+def test_from_config():
+    cfg = OnionDict([{'FULL_MAX_CHAIN_LENGTH': '30'}], sections={
+        'fs:pool/big': {'FULL_MAX_AGE_DAYS': '7', 'FULL_MAX_INCREMENTAL_RATIO': '0.5'},
+    })
+    policy = FullBackupPolicy.from_config(cfg, section='fs:pool/big')
+    assert (policy.max_chain_length, policy.max_incremental_ratio, policy.max_full_age,
+            policy.max_estimate_ratio) == (30, 0.5, 7 * DAY, None)
+    assert FullBackupPolicy.from_config(OnionDict([{}])) is None
@@ -7,10 +7,11 @@ import hashlib
 import boto
 import pytest
 
-from z3.pput import (UploadSupervisor, UploadWorker, StreamHandler,
-                     Result, WorkerCrashed, multipart_etag, parse_metadata,
-                     retry, UploadException)
+from z3.pput import (UploadSupervisor, UploadWorker, StreamHandler, Uploader, WorkerPool,
+                     Result, WorkerCrashed, multipart_etag, parse_metadata, parse_size,
+                     retry, UploadException, wait_for_marker, write_marker)
 from z3.config import get_config
+from z3.snap import CommandExecutor
 
 
 cfg = get_config()
@@ -70,6 +71,13 @@ def test_multipart_etag(sample_data):
     assert multipart_etag(digests) == '"d229c1fc0e509475afe56426c89d2724-2"'
 
 
+@pytest.mark.parametrize("size, expected", [
+    ('100', 100), ('5M', 5 * 1024 ** 2), ('2g', 2 * 1024 ** 3), ('19K', 19 * 1024),
+    ('1.50G', 3 * 1024 ** 3 // 2), (42, 42)])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
 def test_stream_handler():
     stream_handler = StreamHandler(BytesIO(b"aabbccdde"), chunk_size=2)
     chunks = []
@@ -113,9 +121,12 @@ class FakeMultipart(object):
 class FakeBucket(object):
     def __init__(self):
         self._multipart = None
+        self.multiparts = {}
 
     def initiate_multipart_upload(self, name, headers):
         self._multipart = FakeMultipart(name)
+        self._multipart.headers = headers
+        self.multiparts[name] = self._multipart
         return self._multipart
 
 
@@ -142,6 +153,26 @@ def test_zero_data(sample_data):
     assert bucket._multipart._canceled is True
 
 
+@pytest.mark.parametrize("parent_succeeded", [True, False])
+def test_complete_after(sample_data, tmpdir, parent_succeeded):
+    marker = str(tmpdir.join('parent'))
+    write_marker(marker, success=parent_succeeded)
+    bucket = FakeBucket()
+    sup = UploadSupervisor(StreamHandler(sample_data), 'test', bucket=bucket,
+                           complete_after=lambda: wait_for_marker(marker))
+    if parent_succeeded:
+        sup.main_loop(worker_class=DummyWorker)
+        assert bucket._multipart._completed
+    else:
+        with pytest.raises(UploadException):
+            sup.main_loop(worker_class=DummyWorker)
+        assert bucket._multipart._canceled and not bucket._multipart._completed
+
+
+def test_complete_after_gives_up(tmpdir):
+    assert not wait_for_marker(str(tmpdir.join('parent')), poll=0.01, timeout=0.05)
+
+
 class ErrorWorker(UploadWorker):
     def upload_part(self, index, chunk):
         if index == 2:
@@ -158,6 +189,59 @@ def test_supervisor_loop_with_worker_crash(sample_data):
         sup.main_loop(worker_class=ErrorWorker)
 
 
+@pytest.mark.filterwarnings("ignore:Exception in thread")
+def test_shared_pool(sample_data):
+    """Uploads share the workers; a failed part fails its upload, not the pool"""
+    bucket = FakeBucket()
+    pool = WorkerPool(bucket, concurrency=2, worker_class=ErrorWorker)
+    with pytest.raises(Exception) as excinfo:
+        UploadSupervisor(StreamHandler(sample_data), 'first', bucket=bucket,
+                         pool=pool).main_loop()
+    assert str(excinfo.value) == "Testing worker crash"
+    assert pool.aborted(bucket.multiparts['first'])
+    sample_data.seek(0)
+    sup = UploadSupervisor(StreamHandler(sample_data, chunk_size=6 * 1024 * 1024), 'second',
+                           bucket=bucket, pool=pool)
+    sup.main_loop()
+    assert bucket.multiparts['second']._completed
+    assert sup.bytes == 6 * 1024 * 1024
+    assert all(worker.is_alive() for worker in pool.workers)
+
+
+def test_stopped_stream_is_canceled(sample_data):
+    bucket = FakeBucket()
+    sup = UploadSupervisor(StreamHandler(sample_data), 'test', bucket=bucket,
+                           stopped=lambda: True)
+    with pytest.raises(UploadException):
+        sup.main_loop(worker_class=DummyWorker)
+    assert bucket._multipart._canceled and not bucket._multipart._completed
+
+
+def test_uploader(sample_data):
+    bucket = FakeBucket()
+    uploader = Uploader(bucket, concurrency=2, worker_class=DummyWorker)
+    upload = uploader.upload(
+        ['--quiet', '--estimated', '6M', '--meta', 'isfull=true', 'z3/pool/fs@snap'],
+        sample_data)
+    assert upload.etag == '"d229c1fc0e509475afe56426c89d2724-2"'
+    assert upload.bytes == 6 * 1024 * 1024
+    assert uploader.uploads == [upload]
+    multipart = bucket.multiparts['z3/pool/fs@snap']
+    assert multipart._completed and multipart.headers['x-amz-meta-isfull'] == 'true'
+
+
+def test_pput_runs_in_process(tmpdir):
+    data = tmpdir.join('data')
+    data.write_binary(b'x' * 1024)
+    bucket = FakeBucket()
+    uploader = Uploader(bucket, concurrency=2, worker_class=DummyWorker)
+    pipeline = CommandExecutor(quiet=True, uploader=uploader).pipe(
+        "cat '{}'".format(data), "pput --quiet --estimated 1024 z3/pool/fs@snap")
+    assert pipeline.stages[-1].process.result == uploader.uploads[0]
+    assert bucket.multiparts['z3/pool/fs@snap']._completed
+    assert pipeline.stages[-1].bytes == 1024
+
+
 class BoomException(Exception):
     pass
 
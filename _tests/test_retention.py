@@ -0,0 +1,164 @@
+# pylint: disable=redefined-outer-name
+import datetime
+
+import pytest
+
+from z3 import retention
+from z3.retention import RetentionPolicy, prune_plan, snapshot_time
+from z3.snap import S3SnapshotManager, prune
+
+from _tests.fakes import MemoryBucket
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('pool/fs@zfs-auto-snap_daily-2016-05-01-1230', datetime.datetime(2016, 5, 1, 12, 30)),
+    ('pool/fs@autosnap_2016-05-01_12:30:01_daily', datetime.datetime(2016, 5, 1, 12, 30)),
+    ('pool/fs@zrepl_20160501_123000_000', datetime.datetime(2016, 5, 1, 12, 30)),
+    ('pool/fs@backup-2016-05-01', datetime.datetime(2016, 5, 1)),
+    ('pool/fs@snap_1', None),
+    ('pool/2016-05-01@snap_1', None),  # only the snapshot part is considered
+    ('pool/fs@snap-2016-13-01', None),
+])
+def test_snapshot_time(name, expected):
+    assert snapshot_time(name) == expected
+
+
+def daily(start, days, fmt='pool/fs@daily-%Y-%m-%d'):
+    return [(start + datetime.timedelta(days=day)).strftime(fmt) for day in range(days)]
+
+
+def test_grandfather_father_son():
+    # 2015-12-20 .. 2016-03-28, a monday
+    names = daily(datetime.datetime(2015, 12, 20), 100)
+    retained = RetentionPolicy(daily=3, weekly=2, monthly=3, yearly=2).retained(names)
+    assert list(retained.items()) == [
+        ('pool/fs@daily-2016-03-28', ['latest', 'daily', 'weekly', 'monthly', 'yearly']),
+        ('pool/fs@daily-2016-03-27', ['daily', 'weekly']),  # the sunday before
+        ('pool/fs@daily-2016-03-26', ['daily']),
+        ('pool/fs@daily-2016-02-29', ['monthly']),
+        ('pool/fs@daily-2016-01-31', ['monthly']),
+        ('pool/fs@daily-2015-12-31', ['yearly']),
+    ]
+
+
+def test_last_and_undated():
+    retained = RetentionPolicy(last=2).retained(
+        ['pool/fs@snap_1', 'pool/fs@d-2016-01-01', 'pool/fs@d-2016-01-02',
+         'pool/fs@d-2016-01-03'])
+    assert list(retained.items()) == [
+        ('pool/fs@snap_1', ['latest', 'last', 'undated']),
+        ('pool/fs@d-2016-01-03', ['last']),
+    ]
+
+
+@pytest.fixture
+def bucket():
+    """Daily backups from 2016-01-01 to 01-10, full backups on 01 and 06, and a
+    cumulative incremental of 10 on top of 01.
+    """
+    bucket = MemoryBucket()
+    names = daily(datetime.datetime(2016, 1, 1), 10, fmt='pool/fs@d-%Y-%m-%d')
+    for index, name in enumerate(names):
+        if index in (0, 5):
+            metadata = {'isfull': 'true'}
+        else:
+            metadata = {'parent': names[index - 1]}
+        bucket.put('z3/' + name, b'x' * 100, metadata=metadata)
+    bucket.put('z3/pool/fs@d-2016-01-10~d-2016-01-01', b'x' * 10,
+               metadata={'parent': 'pool/fs@d-2016-01-01'})
+    return bucket
+
+
+def manager(bucket, catalog=False):
+    return S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@d-',
+                             catalog=catalog)
+
+
+def test_prune_plan_keeps_chains(bucket):
+    keep, delete = prune_plan(manager(bucket), RetentionPolicy(last=2))
+    assert [(s3_obj.key, reason) for s3_obj, reason in keep] == [
+        ('pool/fs@d-2016-01-09', 'last'),
+        ('pool/fs@d-2016-01-08', 'parent of pool/fs@d-2016-01-09'),
+        ('pool/fs@d-2016-01-07', 'parent of pool/fs@d-2016-01-08'),
+        ('pool/fs@d-2016-01-06', 'parent of pool/fs@d-2016-01-07'),
+        ('pool/fs@d-2016-01-10', 'latest, last'),
+        ('pool/fs@d-2016-01-10~d-2016-01-01', 'latest, last'),
+        ('pool/fs@d-2016-01-01', 'parent of pool/fs@d-2016-01-10'),
+    ]
+    assert sorted(s3_obj.key for s3_obj in delete) == [
+        'pool/fs@d-2016-01-02', 'pool/fs@d-2016-01-03', 'pool/fs@d-2016-01-04',
+        'pool/fs@d-2016-01-05']
+
+
+def test_prune_plan_bundles(bucket):
+    bucket.put('z3/pool/fs@d-2016-01-13', b'x' * 30, metadata={
+        'parent': 'pool/fs@d-2016-01-06', 'contains': 'd-2016-01-11,d-2016-01-12,d-2016-01-13'})
+    keep, delete = prune_plan(manager(bucket), RetentionPolicy(last=3))
+    # the bundle is kept for all its snapshots, and listed once
+    assert [s3_obj.key for s3_obj, _ in keep] == [
+        'pool/fs@d-2016-01-13', 'pool/fs@d-2016-01-06']
+    bucket.put('z3/pool/fs@d-2016-01-14', b'x' * 100, metadata={'isfull': 'true'})
+    _, delete = prune_plan(manager(bucket), RetentionPolicy(last=1))
+    assert [s3_obj.key for s3_obj in delete].count('pool/fs@d-2016-01-13') == 1
+
+
+def test_batched_deletes(bucket, monkeypatch):
+    monkeypatch.setattr(retention, 'DELETE_BATCH', 2)
+    bucket.protected.add('z3/pool/fs@d-2016-01-05')
+    deleted, errors = retention.delete_keys(
+        bucket, ['z3/pool/fs@d-2016-01-0{}'.format(day) for day in range(2, 7)])
+    assert bucket.requests['DELETE_MULTI'] == 3
+    assert deleted == ['z3/pool/fs@d-2016-01-02', 'z3/pool/fs@d-2016-01-03',
+                       'z3/pool/fs@d-2016-01-04', 'z3/pool/fs@d-2016-01-06']
+    assert errors == [('z3/pool/fs@d-2016-01-05', 'AccessDenied Access Denied')]
+
+
+def test_prune_dry_run(bucket, capsys):
+    assert prune(bucket, 'z3/', ['pool/fs'], snapshot_prefix='d-', dry=True,
+                 keep={'last': 2}) is None
+    out = capsys.readouterr()[0].splitlines()
+    assert [col.strip() for col in out[2].split(' | ')][:3] == [
+        'pool/fs@d-2016-01-02', 'delete', '']
+    assert out[-1].startswith("would delete 4 objects, reclaiming")
+    assert len(bucket.objects) == 11
+
+
+def test_prune_updates_catalog(bucket, monkeypatch):
+    monkeypatch.setenv('SNAPSHOT_CATALOG', 'yes')
+    manager(bucket, catalog=True).list()  # writes the catalog
+    assert prune(bucket, 'z3/', ['pool/fs'], snapshot_prefix='d-', keep={'last': 2}) is None
+    assert 'z3/pool/fs@d-2016-01-02' not in bucket.objects
+    s3_mgr = manager(bucket, catalog=True)
+    s3_mgr.catalog.load()
+    assert sorted(s3_mgr.catalog.entries) == [
+        'pool/fs@d-2016-01-01', 'pool/fs@d-2016-01-06', 'pool/fs@d-2016-01-07',
+        'pool/fs@d-2016-01-08', 'pool/fs@d-2016-01-09', 'pool/fs@d-2016-01-10',
+        'pool/fs@d-2016-01-10~d-2016-01-01']
+    assert all(s3_snap.is_healthy for s3_snap in s3_mgr.list())
+
+
+def test_prune_records_deletes_of_batches_that_went_through(bucket, monkeypatch, capsys):
+    monkeypatch.setenv('SNAPSHOT_CATALOG', 'yes')
+    monkeypatch.setattr(retention, 'DELETE_BATCH', 2)
+    manager(bucket, catalog=True).list()
+    delete_keys = bucket.delete_keys
+
+    def flaky_delete_keys(names, quiet=False):
+        if 'z3/pool/fs@d-2016-01-04' in names:
+            raise IOError('connection reset')
+        return delete_keys(names, quiet=quiet)
+    monkeypatch.setattr(bucket, 'delete_keys', flaky_delete_keys)
+    assert prune(bucket, 'z3/', ['pool/fs'], snapshot_prefix='d-', keep={'last': 2}) == 1
+    assert sorted(capsys.readouterr()[1].splitlines()) == [
+        'Failed to delete z3/pool/fs@d-2016-01-04: connection reset',
+        'Failed to delete z3/pool/fs@d-2016-01-05: connection reset']
+    s3_mgr = manager(bucket, catalog=True)
+    s3_mgr.catalog.load()
+    assert [name for name in sorted(s3_mgr.catalog.entries) if name < 'pool/fs@d-2016-01-06'] == [
+        'pool/fs@d-2016-01-01', 'pool/fs@d-2016-01-04', 'pool/fs@d-2016-01-05']
+
+
+def test_prune_needs_rules(bucket):
+    with pytest.raises(Exception) as excinfo:
+        prune(bucket, 'z3/', ['pool/fs'], snapshot_prefix='d-')
+    assert 'No retention rules' in str(excinfo.value)
@@ -0,0 +1,67 @@
+import threading
+
+from z3.scheduler import Job, Scheduler
+
+
+def test_largest_first():
+    jobs = [Job(name, cost, lambda: None) for name, cost in
+            [('small', 1), ('huge', 1000), ('medium', 50)]]
+    assert [job.name for job in Scheduler.order(jobs)] == ['huge', 'medium', 'small']
+
+
+def test_run_order_and_results():
+    started = []
+    lock = threading.Lock()
+
+    def make_job(name, cost):
+        def func():
+            with lock:
+                started.append(name)
+        return Job(name, cost, func)
+
+    results = Scheduler(concurrency=1).run(
+        [make_job('a', 10), make_job('b', 30), make_job('c', 20)])
+    assert started == ['b', 'c', 'a']
+    assert [(r.name, r.cost, r.success) for r in results] == [
+        ('b', 30, True), ('c', 20, True), ('a', 10, True)]
+
+
+def test_failure_does_not_stop_other_jobs():
+    def boom():
+        raise Exception("Boom!")
+    ran = []
+    results = Scheduler(concurrency=2).run([
+        Job('bad', 10, boom),
+        Job('good', 5, lambda: ran.append('good')),
+    ])
+    assert ran == ['good']
+    assert [(r.name, r.success, str(r.error)) for r in results] == [
+        ('bad', False, 'Boom!'), ('good', True, 'None')]
+
+
+def test_concurrency_limit():
+    running = []
+    peak = []
+    lock = threading.Lock()
+    barrier = threading.Event()
+
+    def func():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        barrier.wait(0.05)
+        with lock:
+            running.pop()
+
+    Scheduler(concurrency=3).run([Job(str(i), i, func) for i in range(10)])
+    assert max(peak) <= 3
+
+
+def test_run_levels():
+    finished = []
+    jobs = [Job(name, cost, lambda name=name: finished.append(name)) for name, cost in [
+        ('tank/a/x', 100), ('tank', 1), ('tank/b', 5), ('tank/a', 10)]]
+    results = Scheduler(concurrency=4).run_levels(jobs, level=lambda job: job.name.count('/'))
+    assert finished.index('tank') < finished.index('tank/a') < finished.index('tank/a/x')
+    assert finished.index('tank/b') < finished.index('tank/a/x')
+    assert [result.name for result in results] == ['tank', 'tank/a', 'tank/b', 'tank/a/x']
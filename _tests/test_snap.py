@@ -5,15 +5,24 @@ import contextlib
 import string
 import sys
 import random
+import subprocess
+import threading
+import time
 import os.path
 
 import boto
+import boto.exception
 import pytest
 
+from _tests.fakes import MemoryBucket
+from z3 import snap
 from z3.config import get_config
+from z3.pput import wait_for_marker
 from z3.snap import (list_snapshots, S3SnapshotManager, ZFSSnapshotManager,
                      PairManager, CommandExecutor, IntegrityError, SoftError,
-                     _humanize, handle_soft_errors)
+                     _humanize, handle_soft_errors, list_s3_datasets, _match_datasets,
+                     _pick_restore_target, _humanize_duration, parse_send_flags,
+                     ZFSSnapshot)
 
 
 MEGA = 1024 ** 2
@@ -48,6 +57,8 @@ class FakeBucket(object):
 
     def get_key(self, key):
         name = key[len(self.rand_prefix):]
+        if name not in self.fake_data:
+            return None
         return FakeKey(
             name=key,
             metadata=self.fake_data[name])
@@ -95,6 +106,16 @@ def test_humanize(size, expected):
     assert _humanize(size) == expected
 
 
+@pytest.mark.parametrize("seconds, expected", [
+    (0, "0s"),
+    (59.6, "1m00s"),
+    (61, "1m01s"),
+    (3 * 3600 + 65, "3h01m"),
+])
+def test_humanize_duration(seconds, expected):
+    assert _humanize_duration(seconds) == expected
+
+
 def test_list_snapshots(s3_manager):
     snapshots = sorted(s3_manager.list(), key=lambda el: el.name)
     expected = sorted(
@@ -124,6 +145,42 @@ def test_unhealthy_incremental(s3_manager):
     assert snap.parent.reason_broken == 'missing parent'
 
 
+def test_chain_depth_and_size(s3_manager):
+    assert s3_manager.get('pool/fs@snap_1_f').chain_depth == 0
+    assert s3_manager.get('pool/fs@snap_3').chain_depth == 2
+    assert s3_manager.get('pool/fs@snap_3').chain_size == sum(
+        s3_manager.get(name).size
+        for name in ['pool/fs@snap_1_f', 'pool/fs@snap_2', 'pool/fs@snap_3'])
+    assert s3_manager.get('pool/fs@snap_5').chain_depth is None
+
+
+def test_long_chain_health():
+    length = sys.getrecursionlimit() * 2
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_00000', b'full', metadata={'isfull': 'true'})
+    for index in range(1, length):
+        bucket.put('z3/pool/fs@snap_{:05d}'.format(index), b'i',
+                   metadata={'parent': 'pool/fs@snap_{:05d}'.format(index - 1)})
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_')
+    assert all(snap.is_healthy for snap in s3_mgr.list())
+    assert s3_mgr.list()[-1].chain_depth == length - 1
+
+
+def test_metadata_is_read_when_needed():
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'full',
+               metadata={'isfull': 'true', 'size': '4096', 'note': 'spam'})
+    bucket.put('z3/pool/fs@snap_2', b'incr',
+               metadata={'parent': 'pool/fs@snap_1', 'size': 'unknown'})
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_')
+    assert s3_mgr.get('pool/fs@snap_1') == s3_mgr.list()[0]
+    assert s3_mgr.get('pool/fs@snap_1').uncompressed_size == 4096
+    assert bucket.requests['HEAD'] == 2
+    assert s3_mgr.get('pool/fs@snap_1').metadata['note'] == 'spam'
+    assert s3_mgr.get('pool/fs@snap_2').uncompressed_size == 'unknown'
+    assert bucket.requests['HEAD'] == 4
+
+
 def test_unhealthy_cycle(s3_manager):
     snap = s3_manager.get('pool/fs@snap_7_cycle')
     assert snap.is_full is False
@@ -132,6 +189,82 @@ def test_unhealthy_cycle(s3_manager):
     assert snap.parent.reason_broken == 'cycle detected'
 
 
+class SlowBucket(MemoryBucket):
+    """Keeps track of how many HEAD requests are in flight"""
+    def __init__(self):
+        super(SlowBucket, self).__init__()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.max_in_flight = 0
+
+    def get_key(self, name):
+        with self._lock:
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+        time.sleep(0.01)
+        with self._lock:
+            self._in_flight -= 1
+        return super(SlowBucket, self).get_key(name)
+
+
+def test_concurrent_metadata_fetch():
+    bucket = SlowBucket()
+    bucket.put('z3/pool/fs@snap_00', b'full', metadata={'isfull': 'true'})
+    for index in range(1, 40):
+        bucket.put('z3/pool/fs@snap_{:02d}'.format(index), b'incr',
+                   metadata={'parent': 'pool/fs@snap_{:02d}'.format(index - 1)})
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_',
+                               concurrency=8)
+    snapshots = s3_mgr.list()
+    assert len(snapshots) == 40
+    assert all(snap.is_healthy for snap in snapshots)
+    assert 1 < bucket.max_in_flight <= 8
+
+
+class ThrottlingBucket(MemoryBucket):
+    """Answers the first HEADs of every key with an error"""
+    def __init__(self, status, failures):
+        super(ThrottlingBucket, self).__init__()
+        self._status = status
+        self._failures = failures
+        self._attempts = {}
+
+    def get_key(self, name):
+        attempts = self._attempts[name] = self._attempts.get(name, 0) + 1
+        if attempts <= self._failures:
+            raise boto.exception.S3ResponseError(self._status, 'Slow Down')
+        return super(ThrottlingBucket, self).get_key(name)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('z3.snap.time.sleep', sleeps.append)
+    return sleeps
+
+
+def test_throttled_metadata_fetch(no_sleep):
+    bucket = ThrottlingBucket(status=503, failures=2)
+    bucket.put('z3/pool/fs@snap_1', b'full', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_2', b'incr', metadata={'parent': 'pool/fs@snap_1'})
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_',
+                               concurrency=1)
+    assert [snap.name for snap in s3_mgr.list()] == ['pool/fs@snap_1', 'pool/fs@snap_2']
+    assert len(no_sleep) == 4
+    # backoff grows exponentially, jitter is at most 50%
+    assert 0.1 <= no_sleep[0] <= 0.3
+    assert 0.2 <= no_sleep[1] <= 0.6
+
+
+@pytest.mark.parametrize("status, failures", [(403, 1), (503, 100)])
+def test_metadata_fetch_errors(no_sleep, status, failures):
+    bucket = ThrottlingBucket(status=status, failures=failures)
+    bucket.put('z3/pool/fs@snap_1', b'full', metadata={'isfull': 'true'})
+    s3_mgr = S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_')
+    with pytest.raises(boto.exception.S3ResponseError):
+        s3_mgr.list()
+
+
 class FakeZFSManager(ZFSSnapshotManager):
     _expected = (
         # pool is a different zfs dataset, the s3 fixtures don't include it
@@ -227,9 +360,45 @@ def test_zfs_list(fs_name, expected):
     assert actual == expected
 
 
-class FakeCommandExecutor(CommandExecutor):
-    has_pv = False  # disable pv for consistent test output
+def test_zfs_list_is_scoped():
+    assert ZFSSnapshotManager('pool/fs', 'snap_')._list_command(['pool/fs']) == [
+        'zfs', 'list', '-Hp', '-t', 'snapshot', '-d', '1', '-s', 'createtxg',
+        '-o', 'name,used,refer,mountpoint,written,guid,compressratio', 'pool/fs']
+
 
+def python_cmd(code):
+    return [sys.executable, '-c', code]
+
+
+def test_stream_lines():
+    lines = snap.stream_lines(python_cmd("print('a'); print('b\\tc')"))
+    assert next(lines) == 'a'  # read as they're printed
+    assert list(lines) == ['b\tc']
+    # zfs list fails for missing datasets, they have no snapshots
+    assert list(snap.stream_lines(python_cmd(
+        "import sys; sys.stderr.write(\"cannot open 'pool/new': dataset does not exist\\n\"); "
+        "sys.exit(1)"))) == []
+    with pytest.raises(subprocess.CalledProcessError):
+        list(snap.stream_lines(python_cmd("import sys; sys.stderr.write('boom'); sys.exit(1)")))
+
+
+def test_shared_listing(monkeypatch):
+    listed = []
+
+    def stream_lines(argv):
+        listed.append(argv[-2:])
+        return iter(['pool/a@snap_1\t0\t0\t-\t0', 'pool/b@snap_1\t0\t0\t-\t0',
+                     'pool/a@snap_2\t0\t0\t-\t0'])
+    monkeypatch.setattr(snap, 'stream_lines', stream_lines)
+    listing = snap.SnapshotListing(['pool/a', 'pool/b'])
+    managers = [ZFSSnapshotManager(dataset, 'snap_', listing=listing)
+                for dataset in ('pool/a', 'pool/b')]
+    assert [[z_snap.name for z_snap in manager.list()] for manager in managers] == [
+        ['pool/a@snap_1', 'pool/a@snap_2'], ['pool/b@snap_1']]
+    assert listed == [['pool/a', 'pool/b']]  # a single zfs list
+
+
+class FakeCommandExecutor(CommandExecutor):
     def __init__(self, *a, **kwa):
         super(FakeCommandExecutor, self).__init__(*a, **kwa)
         self._called_commands = []
@@ -240,6 +409,9 @@ class FakeCommandExecutor(CommandExecutor):
         self._called_commands.append(cmd)
         return self._expected
 
+    def run_pipeline(self, cmd, **kwa):
+        return self.shell(cmd)
+
 
 @pytest.fixture
 def pair_manager(s3_manager):
@@ -298,18 +470,158 @@ def test_backup_incremental_latest(pair_manager):
     pair_manager.backup_incremental()
     # snap_8 and snap_9 exist locally but not in s3
     # snap_8 comes after snap_3
-    commands = [
+    # both sizes are measured before the first upload, at the same time
+    estimates = [
         "zfs send -nvP -i 'pool/fs@snap_3' 'pool/fs@snap_8'",
+        "zfs send -nvP -i 'pool/fs@snap_8' 'pool/fs@snap_9'",
+    ]
+    assert sorted(pair_manager._cmd._called_commands[:2]) == estimates
+    commands = [
         ("zfs send -i 'pool/fs@snap_3' 'pool/fs@snap_8' | "
          "pput --quiet --estimated 1234 --meta size=1234 "
          "--meta parent=pool/fs@snap_3 {}pool/fs@snap_8"),
-        "zfs send -nvP -i 'pool/fs@snap_8' 'pool/fs@snap_9'",
         ("zfs send -i 'pool/fs@snap_8' 'pool/fs@snap_9' | "
          "pput --quiet --estimated 1234 --meta size=1234 "
          "--meta parent=pool/fs@snap_8 {}pool/fs@snap_9")
     ]
     expected = [e.format(FakeBucket.rand_prefix) for e in commands]
-    assert pair_manager._cmd._called_commands == expected
+    assert pair_manager._cmd._called_commands[2:] == expected
+
+
+def test_backup_incremental_bundle(s3_manager):
+    pair_manager = PairManager(
+        s3_manager, FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_'),
+        command_executor=FakeCommandExecutor(), bundle=True)
+    uploaded = pair_manager.backup_incremental()
+    assert uploaded == [{'snap_name': 'pool/fs@snap_9', 'size': 2468,
+                         'contains': ['pool/fs@snap_8', 'pool/fs@snap_9']}]
+    assert pair_manager._cmd._called_commands[2:] == [
+        "zfs send -I 'pool/fs@snap_3' 'pool/fs@snap_9' | "
+        "pput --quiet --estimated 2468 --meta size=2468 --meta parent=pool/fs@snap_3 "
+        "--meta contains=snap_8,snap_9 {}pool/fs@snap_9".format(FakeBucket.rand_prefix)]
+
+
+def test_bundles_fit_in_the_metadata(monkeypatch):
+    monkeypatch.setattr('z3.snap.BUNDLE_MAX_CONTAINS', 14)
+    snapshots = [ZFSSnapshot('pool/fs@snap_{}'.format(index), {}) for index in range(5)]
+    assert [([snap.name[-1] for snap in run], size) for run, size in PairManager._bundles(
+        snapshots, [1, 2, 3, 4, 5])] == [(['0', '1'], 3), (['2', '3'], 7), (['4'], 5)]
+
+
+def test_restore_from_bundle():
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'x', metadata={'isfull': 'true'})
+    bucket.put('z3/pool/fs@snap_4', b'x', metadata={
+        'parent': 'pool/fs@snap_1', 'contains': 'snap_2,snap_3,snap_4'})
+    fake_cmd = FakeCommandExecutor()
+    pair_manager = PairManager(
+        S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_'),
+        FakeZFSManager(fs_name='pool/fs', expected='', snapshot_prefix='snap_'),
+        command_executor=fake_cmd)
+    s3_snap = pair_manager.s3_manager.get('pool/fs@snap_3')
+    assert (s3_snap.key, s3_snap.parent_name, s3_snap.is_healthy) == \
+        ('pool/fs@snap_4', 'pool/fs@snap_1', True)
+    assert s3_snap.bundle == pair_manager.s3_manager.get('pool/fs@snap_4')
+    pair_manager.restore('pool/fs@snap_3')
+    # the stream creates snap_2 to snap_4, received into the dataset
+    assert fake_cmd._called_commands == [
+        "z3_get z3/pool/fs@snap_1 | zfs recv pool/fs@snap_1",
+        "z3_get z3/pool/fs@snap_4 | zfs recv pool/fs",
+        "zfs rollback -r 'pool/fs@snap_3'",
+    ]
+
+
+class PPutCommandExecutor(FakeCommandExecutor):
+    """Acts like pput for --complete-after: the upload of snap_8 is slow, and raises
+    fail if it's set
+    """
+    def __init__(self, fail=None):
+        super(PPutCommandExecutor, self).__init__()
+        self.fail = fail
+        self.completed = []
+
+    def shell(self, cmd, dry_run=None, capture=None):  # pylint: disable=arguments-differ
+        output = super(PPutCommandExecutor, self).shell(cmd, dry_run, capture)
+        if 'pput' not in cmd:
+            return output
+        name = cmd.split()[-1]
+        if name.endswith('snap_8'):
+            time.sleep(0.05)
+            if self.fail is not None:
+                raise self.fail('upload failed')
+        if '--complete-after' in cmd:
+            marker = cmd.split('--complete-after ')[1].split()[0].strip("'")
+            if not wait_for_marker(marker, poll=0.001):
+                raise Exception('canceled')
+        self.completed.append(name.rsplit('@', 1)[1])
+        return output
+
+
+def test_backup_incremental_concurrently(s3_manager):
+    cmd = PPutCommandExecutor()
+    pair_manager = PairManager(
+        s3_manager, FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_'),
+        command_executor=cmd, parallel_uploads=4)
+    uploaded = pair_manager.backup_incremental()
+    assert [meta['snap_name'] for meta in uploaded] == ['pool/fs@snap_8', 'pool/fs@snap_9']
+    # snap_9 is sent at the same time but only completed after its parent
+    assert cmd.completed == ['snap_8', 'snap_9']
+    pputs = dict((command.split()[-1].rsplit('@', 1)[1], command)
+                 for command in cmd._called_commands if 'pput' in command)
+    assert '--complete-after' not in pputs['snap_8']
+    assert '--complete-after' in pputs['snap_9']
+
+
+# an interrupted parent doesn't leave its child waiting either
+@pytest.mark.parametrize("error", [Exception, KeyboardInterrupt])
+def test_backup_incremental_concurrently_failed_parent(s3_manager, error):
+    cmd = PPutCommandExecutor(fail=error)
+    pair_manager = PairManager(
+        s3_manager, FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_'),
+        command_executor=cmd, parallel_uploads=4)
+    with pytest.raises(error) as excinfo:
+        pair_manager.backup_incremental()
+    assert str(excinfo.value) == 'upload failed'
+    assert cmd.completed == []  # snap_9 was canceled
+
+
+def test_backup_cumulative_latest(pair_manager):
+    pair_manager.backup_cumulative()
+    # snap_9 is not in s3, the delta from the last full is uploaded as snap_9
+    expected = [
+        "zfs send -nvP -i 'pool/fs@snap_1_f' 'pool/fs@snap_9'",
+        ("zfs send -i 'pool/fs@snap_1_f' 'pool/fs@snap_9' | "
+         "pput --quiet --estimated 1234 --meta size=1234 "
+         "--meta parent=pool/fs@snap_1_f {}pool/fs@snap_9")]
+    assert pair_manager._cmd._called_commands == [
+        e.format(FakeBucket.rand_prefix)
+        for e in expected]
+
+
+def test_backup_cumulative_alternate(pair_manager):
+    pair_manager.backup_cumulative('pool/fs@snap_3')
+    # snap_3 is already in s3, the delta is uploaded next to it
+    expected = [
+        "zfs send -nvP -i 'pool/fs@snap_1_f' 'pool/fs@snap_3'",
+        ("zfs send -i 'pool/fs@snap_1_f' 'pool/fs@snap_3' | "
+         "pput --quiet --estimated 1234 --meta size=1234 "
+         "--meta parent=pool/fs@snap_1_f {}pool/fs@snap_3~snap_1_f")]
+    assert pair_manager._cmd._called_commands == [
+        e.format(FakeBucket.rand_prefix)
+        for e in expected]
+
+
+def test_backup_cumulative_no_full(s3_manager):
+    zfs_list = (
+        'pool/fs@snap_2\t10.0M\t10.0M\t-\t10.0M\n'
+        'pool/fs@snap_3\t10.0M\t10.0M\t-\t10.0M\n'
+    )
+    zfs_manager = FakeZFSManager(fs_name='pool/fs', expected=zfs_list, snapshot_prefix='snap_')
+    fake_cmd = FakeCommandExecutor()
+    pair_manager = PairManager(s3_manager, zfs_manager, command_executor=fake_cmd)
+    with pytest.raises(SoftError):
+        pair_manager.backup_cumulative()
+    assert fake_cmd._called_commands == []
 
 
 def test_backup_incremental_missing_parent(s3_manager):
@@ -396,6 +708,54 @@ def test_backup_full_compressed(s3_manager):
     assert fake_cmd._called_commands == expected
 
 
+@pytest.mark.parametrize("compressor", [
+    'pigz1',  # the blocks are already compressed
+    'gpg',  # but still not encrypted
+])
+def test_backup_compressed_send(s3_manager, compressor):
+    zfs_manager = FakeZFSManager(fs_name='pool/fs', snapshot_prefix='snap_')
+    fake_cmd = FakeCommandExecutor()
+    pair_manager = PairManager(
+        s3_manager, zfs_manager, command_executor=fake_cmd, compressor=compressor,
+        send_flags=('-L', '-c'))
+    pair_manager.backup_full('pool/fs@snap_8')
+    pipe, meta = "", ""
+    if compressor == 'gpg':
+        pipe = "gpg -e -r z3_backup | "
+        meta = "--meta compressor=gpg "
+    assert fake_cmd._called_commands == [
+        "zfs send -nvP -L -c 'pool/fs@snap_8'",
+        "zfs send -L -c 'pool/fs@snap_8' | " + pipe +
+        "pput --quiet --estimated 1234 --meta size=1234 --meta isfull=true " + meta +
+        "--meta send_flags=-L,-c {}pool/fs@snap_8".format(FakeBucket.rand_prefix)]
+
+
+def test_restore_raw_send():
+    bucket = MemoryBucket()
+    bucket.put('z3/pool/fs@snap_1', b'raw', metadata={'isfull': 'true', 'send_flags': '-L,-w'})
+    fake_cmd = FakeCommandExecutor()
+    pair_manager = PairManager(
+        S3SnapshotManager(bucket, s3_prefix='z3/', snapshot_prefix='pool/fs@snap_'),
+        FakeZFSManager(fs_name='pool/fs', expected='', snapshot_prefix='snap_'),
+        command_executor=fake_cmd)
+    pair_manager.restore('pool/fs@snap_1')
+    # the key isn't loaded, the received dataset can't be mounted
+    assert fake_cmd._called_commands == ["z3_get z3/pool/fs@snap_1 | zfs recv -u pool/fs@snap_1"]
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, ()), ('', ()), ('-c', ('-c',)), ('-e -L -c', ('-L', '-c', '-e')), ('-Lw', ('-L', '-w')),
+])
+def test_parse_send_flags(value, expected):
+    assert parse_send_flags(value) == expected
+
+
+@pytest.mark.parametrize("value", ['-R', '-D', 'c', '--compressed'])
+def test_parse_unsupported_send_flags(value):
+    with pytest.raises(SoftError):
+        parse_send_flags(value)
+
+
 def test_restore_full(s3_manager):
     """Test full restore on empty zfs dataset"""
     zfs_list = 'pool@p1\t0\t19K\t-\t19K\n'  # we have no pool/fs snapshots locally
@@ -493,6 +853,51 @@ def test_restore_force(s3_manager):
     assert fake_cmd._called_commands == expected
 
 
+def test_restore_plan(s3_manager):
+    zfs_list = 'pool@p1\t0\t19K\t-\t19K\n'  # we have no pool/fs snapshots locally
+    zfs_manager = FakeZFSManager(fs_name='pool/fs', expected=zfs_list, snapshot_prefix='snap_')
+    fake_cmd = FakeCommandExecutor()
+    pair_manager = PairManager(s3_manager, zfs_manager, command_executor=fake_cmd)
+    plan = pair_manager.restore_plan('pool/fs@snap_3')
+    assert [s3_snap.name for s3_snap in plan] == [
+        'pool/fs@snap_1_f', 'pool/fs@snap_2', 'pool/fs@snap_3']
+    assert fake_cmd._called_commands == []
+
+
+def test_list_s3_datasets():
+    bucket = MemoryBucket()
+    for name in ['pool/fs@snap_1', 'pool/fs@snap_2', 'pool/fs/child@snap_1', 'tank@snap_1',
+                 '.z3/catalog/pool/fs.json']:
+        bucket.put('z3/' + name)
+    bucket.put('other/pool/other@snap_1')
+    bucket.requests.clear()
+    assert list_s3_datasets(bucket, 'z3') == ['pool/fs', 'pool/fs/child', 'tank']
+    assert bucket.requests == {'LIST': 1}
+
+
+@pytest.mark.parametrize("patterns, expected", [
+    (['tank/*'], ['tank/a', 'tank/a/b', 'tank/c']),
+    (['tank/a', 'pool'], ['pool', 'tank/a']),
+    (['tank/?'], ['tank/a', 'tank/c']),
+    (['nope'], []),
+])
+def test_match_datasets(patterns, expected):
+    datasets = ['pool', 'pool/fs', 'tank/a', 'tank/a/b', 'tank/c']
+    assert _match_datasets(datasets, patterns) == expected
+
+
+@pytest.mark.parametrize("snapshot, until, expected", [
+    (None, None, 'pool/fs@snap_3'),  # latest healthy, snap_4_mp onwards are broken
+    ('snap_2', None, 'pool/fs@snap_2'),
+    (None, 'snap_2', 'pool/fs@snap_2'),
+    (None, 'snap_1_z', 'pool/fs@snap_1_f'),
+    (None, 'snap_0', None),  # snap_0 has an expired parent
+])
+def test_pick_restore_target(s3_manager, snapshot, until, expected):
+    target = _pick_restore_target(s3_manager, 'pool/fs', snapshot=snapshot, until=until)
+    assert (target.name if target else None) == expected
+
+
 def test_get_latest():
     expected = (
         'pool@p1\t0\t19K\t-\t19K\n'
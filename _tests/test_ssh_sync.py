@@ -1,7 +1,7 @@
 # pylint: disable=redefined-outer-name,protected-access
 import pytest
 
-from z3.ssh_sync import snapshots_to_send, sync_snapshots
+from z3.ssh_sync import RemoteZFSSnapshotManager, snapshots_to_send, sync_snapshots
 
 
 ALL = ['S_0', 'S_1', 'S_2', 'S_3', 'S_4']
@@ -98,3 +98,11 @@ def test_push_command(pair, expected):
         dry_run=False,
     )
     assert commands == expected
+
+
+def test_remote_listing():
+    remote = RemoteZFSSnapshotManager('example.com', 'remote/fs', 'S_')
+    assert remote._list_command(['remote/fs']) == [
+        'ssh', 'example.com', '-C',
+        'sudo zfs list -Hp -t snapshot -d 1 -s createtxg '
+        '-o name,used,refer,mountpoint,written,guid,compressratio remote/fs']
@@ -0,0 +1,76 @@
+import sys
+
+from z3.health import Health, MISSING_PARENT
+from z3.table import NOT_AN_INT, SnapshotTable
+
+
+def make_table():
+    table = SnapshotTable()
+    table.add('pool/fs@d0', {'isfull': 'true', 'compressor': 'pigz1', 'size': '4096'}, 1000)
+    table.add('pool/fs@d1', {'parent': 'pool/fs@d0', 'compressor': 'pigz1'}, 100)
+    table.add('pool/fs@d2~d0', {'parent': 'pool/fs@d0'}, 150)
+    table.add('pool/fs@d2', {'parent': 'pool/fs@d1', 'size': 'lots'}, None)
+    table.add('pool/fs@d4', {'parent': 'pool/fs@d3'}, 100)
+    return table
+
+
+def test_fields():
+    table = make_table()
+    row = table.lookup('pool/fs@d0')
+    assert (table.name(row), table.key(row), table.is_full(row), table.size(row)) == \
+        ('pool/fs@d0', 'pool/fs@d0', True, 1000)
+    assert table.parent_name(row) is None
+    assert table.compressor(row) == 'pigz1'
+    assert table.uncompressed_size(row) == 4096
+    row = table.lookup('pool/fs@d2')
+    assert (table.parent_name(row), table.size(row), table.compressor(row)) == \
+        ('pool/fs@d1', None, None)
+    assert table.uncompressed_size(row) == NOT_AN_INT
+    assert table.lookup('pool/fs@d3') is None  # only known as a parent
+    assert table.lookup('pool/other@d0') is None
+
+
+def test_alternates():
+    table = make_table()
+    # the object named after the snapshot is the main one, even if listed later
+    assert [table.key(row) for row in table.rows('pool/fs@d2')] == [
+        'pool/fs@d2', 'pool/fs@d2~d0']
+    assert table.is_primary(table.lookup('pool/fs@d2'))
+    assert [table.name(row) for row in table.primary_rows()] == [
+        'pool/fs@d0', 'pool/fs@d1', 'pool/fs@d2', 'pool/fs@d4']
+    assert len(table.rows()) == len(table) == 5
+
+
+def test_health():
+    table = make_table()
+    analysis = table.analyze()
+    health = dict((table.key(row), table.health(analysis, row)) for row in table.rows())
+    assert health == {
+        'pool/fs@d0': Health(None, 0, 1000),
+        'pool/fs@d1': Health(None, 1, 1100),
+        'pool/fs@d2': Health(None, 2, 1100),
+        'pool/fs@d2~d0': Health(None, 1, 1150),
+        'pool/fs@d4': Health(MISSING_PARENT, None, None),
+    }
+
+
+def test_bundles():
+    table = make_table()
+    bundle = table.add('pool/fs@d7', {'parent': 'pool/fs@d2', 'contains': 'd5,d6,d7'}, 300)
+    table.add('pool/fs@d6', {'parent': 'pool/fs@d2'}, 50)  # has an object of its own
+    row = table.lookup('pool/fs@d5')
+    assert (table.key(row), table.parent_name(row), table.size(row)) == \
+        ('pool/fs@d7', 'pool/fs@d2', 300)
+    assert table.bundle(row) == bundle and table.bundle(bundle) is None
+    assert [table.key(row) for row in table.rows('pool/fs@d6')] == ['pool/fs@d6', 'pool/fs@d7']
+    analysis = table.analyze()
+    assert table.health(analysis, row) == Health(None, 3, 1400)
+
+
+def test_names_are_interned():
+    table = SnapshotTable()
+    snapshot = ''.join(['zfs-auto-snap_daily-', '2016-05-01'])  # not interned by the compiler
+    table.add('pool/a@' + snapshot, {'isfull': 'true'}, 1)
+    table.add('pool/b@' + snapshot, {'isfull': 'true'}, 1)
+    stored = table._name_snapshot
+    assert stored[0] is stored[1] is sys.intern(snapshot)
@@ -8,6 +8,10 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=["boto"],
+    extras_require={
+        # ORC and Parquet S3 Inventory reports
+        'inventory': ["pyarrow"],
+    },
     author="PressLabs SRL",
     author_email="contact@presslabs.com",
     url="https://github.com/presslabs/z3",
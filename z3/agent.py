@@ -0,0 +1,200 @@
+"""Backs up datasets as soon as they get a new snapshot.
+
+The agent keeps the latest local snapshot of every dataset and the latest one it backed
+up in memory. Every poll is a single zfs list of snapshot names for all the datasets;
+only a dataset whose latest snapshot changed gets a backup, S3 isn't asked about the
+others. Backups run side by side, at most one per dataset, on the connections and upload
+workers the agent keeps for its whole life. A dataset whose backup failed is tried again
+after retry_delay. The state can be read as json from a unix socket.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+
+class DatasetState(object):
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.local = None  # the latest local snapshot
+        self.backed_up = None  # the latest snapshot known to be in S3
+        self.running = False
+        self.last_success = None
+        self.last_error = None
+        self.failed_at = None
+        self.uploads = 0
+        self.bytes = 0
+
+    def as_dict(self):
+        return {
+            'local': self.local, 'backed_up': self.backed_up, 'running': self.running,
+            'last_success': self.last_success, 'last_error': self.last_error,
+            'uploads': self.uploads, 'bytes': self.bytes,
+        }
+
+
+class Agent(object):
+    def __init__(self, datasets, poll, backup, interval=60, concurrency=4, retry_delay=300,
+                 clock=time.time):
+        self.poll = poll  # () -> {dataset: name of its latest snapshot}
+        # (dataset) -> the uploaded metadata of backup_incremental, raises if it fails
+        self.backup = backup
+        self.interval = interval  # seconds between polls
+        self.retry_delay = retry_delay  # seconds before backing up a failed dataset again
+        self.clock = clock
+        self.states = dict((dataset, DatasetState(dataset)) for dataset in datasets)
+        self.started = clock()
+        self.polls = 0
+        self.last_poll = None
+        self._pool = ThreadPoolExecutor(max_workers=concurrency)
+        self._futures = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.log = logging.getLogger('Agent')
+
+    def _due(self, state):
+        if state.running or state.local is None or state.local == state.backed_up:
+            return False
+        return state.failed_at is None or self.clock() - state.failed_at >= self.retry_delay
+
+    def tick(self):
+        """Polls once and starts the backups of the datasets with new snapshots,
+        returns their names.
+        """
+        latest = self.poll()
+        started = []
+        with self._lock:
+            self.polls += 1
+            self.last_poll = self.clock()
+            for dataset, state in sorted(self.states.items()):
+                state.local = latest.get(dataset)
+                if self._due(state):
+                    state.running = True
+                    started.append(dataset)
+                    self._futures.append(
+                        self._pool.submit(self._run_backup, state, state.local))
+        return started
+
+    def _run_backup(self, state, snapshot):
+        try:
+            uploaded = self.backup(state.dataset)
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.error("backup of %s failed: %s", state.dataset, err)
+            with self._lock:
+                state.running = False
+                state.last_error = str(err)
+                state.failed_at = self.clock()
+            return
+        with self._lock:
+            state.running = False
+            # the backup took the latest snapshot when it started, maybe newer than this one
+            state.backed_up = uploaded[-1]['snap_name'] if uploaded else snapshot
+            state.last_success = self.clock()
+            state.last_error = state.failed_at = None
+            state.uploads += len(uploaded)
+            state.bytes += sum(meta.get('uploaded', meta['size']) for meta in uploaded)
+        for meta in uploaded:
+            self.log.info("backed up %s", meta['snap_name'])
+
+    def wait(self):
+        """Waits for the backups started so far"""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def run(self):
+        """Polls every interval seconds until stop is called"""
+        while not self._stopping.is_set():
+            started = self.clock()
+            try:
+                self.tick()
+            except Exception as err:  # pylint: disable=broad-except
+                self.log.error("poll failed: %s", err)
+            with self._lock:  # forget the backups that are done
+                self._futures = [future for future in self._futures if not future.done()]
+            self._stopping.wait(max(0, self.interval - (self.clock() - started)))
+        self._pool.shutdown(wait=True)  # running backups are completed
+
+    def stop(self):
+        self._stopping.set()
+
+    def status(self):
+        with self._lock:
+            return {
+                'started': self.started, 'polls': self.polls, 'last_poll': self.last_poll,
+                'datasets': dict((dataset, state.as_dict())
+                                 for dataset, state in self.states.items()),
+            }
+
+
+class _StatusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        status = self.server.agent.status()
+        self.wfile.write(json.dumps(status, sort_keys=True).encode('utf-8') + b'\n')
+
+
+class AgentRunning(Exception):
+    pass
+
+
+def _listening(path):
+    """Whether something answers on the unix socket at path"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        client.close()
+    return True
+
+
+class StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Answers every connection to the socket with the status of the agent"""
+    daemon_threads = True
+
+    def __init__(self, path, agent):
+        if os.path.exists(path):
+            if _listening(path):
+                raise AgentRunning("an agent is already running on {}".format(path))
+            os.unlink(path)  # left behind by an agent that didn't shut down
+        else:
+            # /run is emptied on boot, the socket's directory may be gone
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        socketserver.UnixStreamServer.__init__(self, path, _StatusHandler)
+        self.path = path
+        self.agent = agent
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.path)
+
+
+def read_status(path, timeout=5):
+    """Returns the status of the agent listening on path"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    return json.loads(b"".join(chunks).decode('utf-8'))
@@ -0,0 +1,199 @@
+"""Local cache of S3 key metadata.
+
+Backups never change once uploaded, so their metadata can be kept on disk across
+runs and only new keys need to be read from S3. Snapshot names sort by time, so new
+keys can be found by listing only the keys after the last one we know about. Every
+now and then the whole prefix is listed again, to check etags and evict deleted keys.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT,
+    size INTEGER,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (bucket, prefix, key)
+);
+CREATE TABLE IF NOT EXISTS validations (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    listing_prefix TEXT NOT NULL,
+    validated_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix, listing_prefix)
+);
+CREATE TABLE IF NOT EXISTS send_sizes (
+    from_guid TEXT NOT NULL,
+    to_guid TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (from_guid, to_guid, flags)
+);
+CREATE TABLE IF NOT EXISTS compressor_choices (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    compressor TEXT NOT NULL,
+    chosen_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix, dataset)
+);
+CREATE TABLE IF NOT EXISTS upload_rates (
+    bucket TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    rate REAL NOT NULL,
+    measured_at REAL NOT NULL,
+    PRIMARY KEY (bucket, prefix)
+);
+"""
+
+
+def _like_prefix(prefix):
+    """Escapes prefix for a LIKE 'prefix%' query"""
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class MetadataCache(object):
+    def __init__(self, path, bucket_name, s3_prefix, validate_every=24 * 3600):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.s3_prefix = s3_prefix  # key names are relative to this
+        self.validate_every = validate_every  # seconds between full listings
+        # the connection is shared with the scheduler's threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def etags(self, listing_prefix):
+        """Returns a dict of key name -> etag for the cached keys under listing_prefix"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, etag FROM keys WHERE bucket = ? AND prefix = ? "
+                "AND key LIKE ? ESCAPE '\\'",
+                (self.bucket_name, self.s3_prefix, _like_prefix(listing_prefix))).fetchall()
+        return dict(rows)
+
+    def get(self, key_names):
+        """Returns a dict of key name -> entry for the cached keys among key_names"""
+        entries = {}
+        with self._lock:
+            for key_name in key_names:
+                row = self._db.execute(
+                    "SELECT etag, size, metadata FROM keys "
+                    "WHERE bucket = ? AND prefix = ? AND key = ?",
+                    (self.bucket_name, self.s3_prefix, key_name)).fetchone()
+                if row is not None:
+                    etag, size, metadata = row
+                    entries[key_name] = {
+                        'etag': etag, 'size': size, 'metadata': json.loads(metadata)}
+        return entries
+
+    def store(self, entries):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO keys (bucket, prefix, key, etag, size, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(self.bucket_name, self.s3_prefix, key_name, entry['etag'], entry['size'],
+                  json.dumps(entry['metadata'], sort_keys=True))
+                 for key_name, entry in entries.items()])
+
+    def forget(self, key_names):
+        """Evicts deleted keys; listing only after the last key wouldn't notice them"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM keys WHERE bucket = ? AND prefix = ? AND key = ?",
+                [(self.bucket_name, self.s3_prefix, key_name) for key_name in key_names])
+
+    def send_sizes(self, pairs):
+        """Returns a dict of (from guid, to guid, send flags) -> measured send size
+        for the known pairs; a full send has an empty from guid.
+        """
+        sizes = {}
+        with self._lock:
+            for pair in pairs:
+                row = self._db.execute(
+                    "SELECT size FROM send_sizes WHERE from_guid = ? AND to_guid = ? "
+                    "AND flags = ?", pair).fetchone()
+                if row is not None:
+                    sizes[pair] = row[0]
+        return sizes
+
+    def store_send_sizes(self, sizes):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO send_sizes (from_guid, to_guid, flags, size) "
+                "VALUES (?, ?, ?, ?)",
+                [pair + (size,) for pair, size in sizes.items()])
+
+    def compressor_choice(self, dataset, max_age):
+        """Returns the compressor picked for dataset less than max_age seconds ago"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT compressor, chosen_at FROM compressor_choices "
+                "WHERE bucket = ? AND prefix = ? AND dataset = ?",
+                (self.bucket_name, self.s3_prefix, dataset)).fetchone()
+        if row is None or time.time() - row[1] >= max_age:
+            return None
+        return row[0]
+
+    def store_compressor_choice(self, dataset, compressor):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO compressor_choices "
+                "(bucket, prefix, dataset, compressor, chosen_at) VALUES (?, ?, ?, ?, ?)",
+                (self.bucket_name, self.s3_prefix, dataset, compressor, time.time()))
+
+    def upload_rate(self):
+        """Returns the last measured upload rate to the bucket, in bytes per second"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT rate FROM upload_rates WHERE bucket = ? AND prefix = ?",
+                (self.bucket_name, self.s3_prefix)).fetchone()
+        return None if row is None else row[0]
+
+    def store_upload_rate(self, rate):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO upload_rates (bucket, prefix, rate, measured_at) "
+                "VALUES (?, ?, ?, ?)", (self.bucket_name, self.s3_prefix, rate, time.time()))
+
+    def needs_validation(self, listing_prefix):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT validated_at FROM validations "
+                "WHERE bucket = ? AND prefix = ? AND listing_prefix = ?",
+                (self.bucket_name, self.s3_prefix, listing_prefix)).fetchone()
+        return row is None or time.time() - row[0] >= self.validate_every
+
+    def validated(self, listing_prefix, listed):
+        """Records a full listing of listing_prefix; evicts the keys that are gone"""
+        gone = [key_name for key_name in self.etags(listing_prefix) if key_name not in listed]
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM keys WHERE bucket = ? AND prefix = ? AND key = ?",
+                [(self.bucket_name, self.s3_prefix, key_name) for key_name in gone])
+            self._db.execute(
+                "INSERT OR REPLACE INTO validations "
+                "(bucket, prefix, listing_prefix, validated_at) VALUES (?, ?, ?, ?)",
+                (self.bucket_name, self.s3_prefix, listing_prefix, time.time()))
+
+
+def open_cache(cache_dir, bucket_name, s3_prefix, validate_every=24 * 3600):
+    """Returns a MetadataCache stored in cache_dir or None if it can't be opened"""
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return MetadataCache(os.path.join(cache_dir, 'metadata.sqlite'), bucket_name,
+                             s3_prefix, validate_every=validate_every)
+    except (OSError, sqlite3.Error) as err:
+        logging.warning("not using the metadata cache in %s: %s", cache_dir, err)
+        return None
@@ -0,0 +1,95 @@
+"""Per dataset catalog of backups.
+
+Reading the metadata of every snapshot takes one HEAD request per key. The catalog
+keeps the metadata of all the backups of a dataset in a single json object, so it
+can be read with one GET. It's kept up to date by z3 after each upload and checked
+against the key listing on every read; keys missing from the catalog or with a
+different etag are fetched and the catalog is fixed.
+"""
+
+import json
+import logging
+
+import boto.exception
+
+
+# z3's own objects live here; pool names can't start with a dot so there are no clashes
+META_PREFIX = '.z3/'
+CATALOG_PREFIX = META_PREFIX + 'catalog/'
+
+
+class SnapshotCatalog(object):
+    VERSION = 1
+
+    def __init__(self, bucket, s3_prefix, dataset):
+        self.bucket = bucket
+        self.dataset = dataset
+        self.key_name = "{}{}{}.json".format(s3_prefix, CATALOG_PREFIX, dataset)
+        # key name relative to s3_prefix -> {'metadata': {}, 'size': int, 'etag': str}
+        self.entries = {}
+        self.log = logging.getLogger('SnapshotCatalog')
+
+    def load(self):
+        """Reads the catalog from S3. Returns False if it doesn't exist."""
+        try:
+            raw = self.bucket.new_key(self.key_name).get_contents_as_string()
+        except boto.exception.S3ResponseError as err:
+            if err.status != 404:
+                raise
+            self.entries = {}
+            return False
+        data = json.loads(raw.decode('utf8'))
+        if data.get('version') != self.VERSION:
+            self.log.warning("ignoring catalog %s with unknown version %s",
+                             self.key_name, data.get('version'))
+            self.entries = {}
+            return False
+        self.entries = data['snapshots']
+        return True
+
+    def save(self):
+        # a PUT replaces the whole object at once, readers never see a partial catalog
+        key = self.bucket.new_key(self.key_name)
+        key.set_contents_from_string(
+            json.dumps({'version': self.VERSION, 'snapshots': self.entries},
+                       sort_keys=True),
+            headers={'Content-Type': 'application/json'})
+
+    def add(self, key_name, entry):
+        self.entries[key_name] = entry
+
+    def diff(self, listed, prefix=''):
+        """Compares the catalog with a listing of key name -> etag.
+        Only catalog entries starting with prefix are considered.
+        Returns a dict with the keys that are missing, stale or changed in the catalog.
+        """
+        missing, changed = [], []
+        for key_name, etag in listed.items():
+            entry = self.entries.get(key_name)
+            if entry is None:
+                missing.append(key_name)
+            elif etag is not None and entry.get('etag') != etag:
+                changed.append(key_name)
+        stale = [key_name for key_name in self.entries
+                 if key_name.startswith(prefix) and key_name not in listed]
+        return {'missing': sorted(missing), 'changed': sorted(changed), 'stale': sorted(stale)}
+
+    def sync(self, listed, fetch, prefix=''):
+        """Brings the catalog in line with a listing of key name -> etag.
+        fetch(key_names) is called with the keys the catalog doesn't know about and
+        returns a dict of key name -> entry. The catalog is saved if anything changed.
+        Returns the entries of the listed keys, fetch leaves out the ones deleted since
+        they were listed.
+        """
+        self.load()
+        diff = self.diff(listed, prefix=prefix)
+        self.entries.update(fetch(diff['missing'] + diff['changed']))
+        for key_name in diff['stale']:
+            del self.entries[key_name]
+        if any(diff.values()):
+            self.log.info("updating catalog %s: %d missing, %d changed, %d stale",
+                          self.key_name, len(diff['missing']), len(diff['changed']),
+                          len(diff['stale']))
+            self.save()
+        return dict((key_name, self.entries[key_name]) for key_name in listed
+                    if key_name in self.entries)
@@ -0,0 +1,229 @@
+"""Commands the zfs stream is piped through before it's uploaded, and after it's downloaded.
+
+Backups record the name of their compressor in the compressor metadata and are
+decompressed by looking the name up again, so a compressor keeps its name for as long
+as there are backups made with it. Besides the built-in ones, compressors can be
+defined in the config:
+
+    [compressor:zstd-long]
+    COMPRESS_CMD=zstd -3 --long=27 -T{threads}
+    DECOMPRESS_CMD=zstd -d --long=27
+    COMPRESSOR_THREADS=8
+
+{threads} is replaced with COMPRESSOR_THREADS, 0 for one thread per core where the
+command supports it, and {recipient} with the gpg recipient. A section named after a
+built-in compressor changes its settings.
+
+The auto compressor picks one per dataset: it compresses a sample of the dataset's send
+stream with each candidate and takes the one the whole stream would get through the
+fastest, given the upload rate measured on earlier backups. Compressing and uploading
+run side by side, so a stream takes as long as the slower of the two. The pick is kept
+in the cache and made again every so often; backups record the compressor picked, so
+restores don't need to know about auto.
+"""
+
+import logging
+import shlex
+import subprocess
+import time
+from collections import OrderedDict
+
+
+SECTION_PREFIX = 'compressor:'
+AUTO = 'auto'
+AUTO_CANDIDATES = ('none', 'lz4', 'zstd1', 'zstd3', 'pigz1')
+SAMPLE_SIZE = 16 * 1024 * 1024
+MIN_OBSERVED = 64 * 1024 * 1024  # smaller uploads are mostly spent starting and completing
+
+BUILTIN = OrderedDict([
+    ('pigz1', ('pigz -1 --blocksize 4096', 'pigz -d')),
+    ('pigz4', ('pigz -4 --blocksize 4096', 'pigz -d')),
+    ('gpg', ('gpg -e -r {recipient}', 'gpg -d')),
+    ('zstd1', ('zstd -1 -T{threads} -q', 'zstd -d -q')),
+    ('zstd3', ('zstd -3 -T{threads} -q', 'zstd -d -q')),
+    ('zstd9', ('zstd -9 -T{threads} -q', 'zstd -d -q')),
+    ('zstd19', ('zstd -19 -T{threads} -q', 'zstd -d -q')),
+    ('lz4', ('lz4 -1 -q -c', 'lz4 -d -q -c')),
+    ('xz', ('xz -6 -T{threads} -q -c', 'xz -d -T{threads} -q -c')),
+])
+
+
+class CompressorError(Exception):
+    pass
+
+
+class Compressor(object):
+    def __init__(self, name, compress, decompress, threads=0, recipient='z3_backup'):
+        self.name = name
+        self._compress = compress
+        self._decompress = decompress
+        self.threads = threads
+        self.recipient = recipient  # for gpg
+
+    def _format(self, template):
+        return template.format(threads=self.threads, recipient=self.recipient)
+
+    @property
+    def compress(self):
+        return self._format(self._compress)
+
+    @property
+    def decompress(self):
+        return self._format(self._decompress)
+
+
+class CompressorRegistry(object):
+    def __init__(self, compressors=None):
+        """By default holds the built-in compressors, with their default settings"""
+        if compressors is None:
+            compressors = [Compressor(name, compress, decompress)
+                           for name, (compress, decompress) in BUILTIN.items()]
+        self._compressors = OrderedDict(
+            (compressor.name, compressor) for compressor in compressors)
+
+    @classmethod
+    def from_config(cls, cfg=None, gpg_recipient=None):
+        """The built-in compressors and those of the [compressor:NAME] sections"""
+        recipient = gpg_recipient or (cfg and cfg.get('GPG_RECIPIENT')) or 'z3_backup'
+        templates = OrderedDict(BUILTIN)
+        sections = {}
+        if cfg is not None:
+            for section in cfg.sections():
+                if section.startswith(SECTION_PREFIX):
+                    name = section[len(SECTION_PREFIX):]
+                    sections[name] = section
+                    compress, decompress = templates.get(name, (None, None))
+                    templates[name] = (
+                        cfg.get('COMPRESS_CMD', compress, section=section),
+                        cfg.get('DECOMPRESS_CMD', decompress, section=section))
+        compressors = []
+        for name, (compress, decompress) in templates.items():
+            if not compress or not decompress:
+                raise CompressorError(
+                    "[{}{}] needs both COMPRESS_CMD and DECOMPRESS_CMD".format(
+                        SECTION_PREFIX, name))
+            threads = 0
+            if cfg is not None:
+                threads = int(cfg.get('COMPRESSOR_THREADS', 0, section=sections.get(name)))
+            compressors.append(Compressor(name, compress, decompress, threads=threads,
+                                          recipient=recipient))
+        return cls(compressors)
+
+    def names(self):
+        return list(self._compressors)
+
+    def __contains__(self, name):
+        return name in self._compressors
+
+    def get(self, name):
+        """Returns the compressor called name, None for no compressor"""
+        if name is None or name.lower() == 'none':
+            return None
+        try:
+            return self._compressors[name]
+        except KeyError:
+            raise CompressorError(
+                'Unknown compressor "{}", define it in a [{}{}] section'.format(
+                    name, SECTION_PREFIX, name))
+
+
+class Trial(object):
+    """How a compressor did on a sample"""
+    def __init__(self, name, ratio, rate):
+        self.name = name
+        self.ratio = ratio  # compressed size / sample size
+        self.rate = rate  # sample bytes compressed per second, None when not compressing
+
+    def seconds_per_byte(self, bandwidth):
+        compressing = 0.0 if self.rate is None else 1.0 / max(self.rate, 1e-9)
+        return max(compressing, self.ratio / bandwidth)
+
+    def __repr__(self):
+        return "<Trial {} ratio={:.2f} rate={}>".format(self.name, self.ratio, self.rate)
+
+
+def run_trial(compressor, sample):
+    """Compresses sample, returns a Trial or None if the compressor can't be run"""
+    started = time.monotonic()
+    try:
+        compressed = subprocess.run(
+            shlex.split(compressor.compress), input=sample, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as err:
+        logging.info("not considering compressor %s: %s", compressor.name, err)
+        return None
+    elapsed = max(time.monotonic() - started, 1e-6)
+    return Trial(compressor.name, float(len(compressed)) / max(len(sample), 1),
+                 len(sample) / elapsed)
+
+
+class CompressorSelector(object):
+    def __init__(self, compressors, candidates=AUTO_CANDIDATES, bandwidth=10 * 1024 ** 2,
+                 rate_limit=None, cache=None, reevaluate_every=7 * 24 * 3600,
+                 sample_size=SAMPLE_SIZE, trial=run_trial):
+        self.compressors = compressors  # a CompressorRegistry
+        self.candidates = candidates  # names, 'none' for not compressing
+        self.bandwidth = bandwidth  # bytes per second, until an upload has been measured
+        self.rate_limit = rate_limit  # the bandwidth limit, uploads never go faster
+        self.cache = cache  # z3.cache.MetadataCache, keeps picks and upload rates
+        self.reevaluate_every = reevaluate_every  # seconds a pick is kept for
+        self.sample_size = sample_size
+        self._trial = trial
+
+    def upload_rate(self):
+        rate = self.cache.upload_rate() if self.cache is not None else None
+        rate = rate or self.bandwidth
+        if self.rate_limit:
+            rate = min(rate, self.rate_limit)
+        return rate
+
+    def trials(self, sample):
+        trials = []
+        for name in self.candidates:
+            compressor = self.compressors.get(name)
+            if compressor is None:
+                trials.append(Trial(name, 1.0, None))
+                continue
+            trial = self._trial(compressor, sample)
+            if trial is not None:
+                trials.append(trial)
+        return trials
+
+    def pick(self, sample):
+        """Returns the name of the candidate that gets the stream through the fastest"""
+        bandwidth = self.upload_rate()
+        trials = self.trials(sample)
+        if not trials:
+            return 'none'
+        best = min(trials, key=lambda trial: trial.seconds_per_byte(bandwidth))
+        logging.info("picked %s at %.0f B/s out of %s", best.name, bandwidth, trials)
+        return best.name
+
+    def choose(self, dataset, read_sample):
+        """Returns the compressor for dataset, the cached pick while it's recent,
+        otherwise a new pick from the sample read_sample(size) returns. Without
+        read_sample, eg. for a dry run, the first candidate stands in for a new pick.
+        """
+        if self.cache is not None:
+            name = self.cache.compressor_choice(dataset, self.reevaluate_every)
+            if name is not None and (name == 'none' or name in self.compressors):
+                return name
+        if read_sample is None:
+            return self.candidates[0] if self.candidates else 'none'
+        name = self.pick(read_sample(self.sample_size))
+        if self.cache is not None:
+            self.cache.store_compressor_choice(dataset, name)
+        return name
+
+    def observe(self, pipeline):
+        """Learns the upload rate from a finished backup pipeline, its last stage uploads.
+        That's the rate only if the upload held the pipeline back, otherwise the upload
+        could have gone at least as fast.
+        """
+        upload = pipeline.stages[-1]
+        if self.cache is None or upload.bytes < MIN_OBSERVED or not pipeline.duration:
+            return
+        rate = upload.bytes / pipeline.duration
+        if pipeline.bottleneck is not upload:
+            rate = max(rate, self.cache.upload_rate() or 0)
+        self.cache.store_upload_rate(rate)
@@ -46,6 +46,16 @@ class OnionDict(object):
     def get(self, key, default=None, section=None):
         return self._get(key, section=section, default=default)
 
+    def sections(self):
+        """Names of the sections, eg. fs:pool/fs"""
+        return sorted(self.__sections)
+
+    def getboolean(self, key, default=False, section=None):
+        value = self._get(key, section=section, default=None)
+        if value is None:
+            return default
+        return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
+
 
 def get_config():
     global _settings
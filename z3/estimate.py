@@ -0,0 +1,86 @@
+"""How big a zfs send stream will be.
+
+pput needs the size of a stream before it starts, to pick a chunk size that fits in
+10000 parts. A dry-run send (zfs send -nvP) walks every changed block, so doing one
+per snapshot makes a long catch-up slow to start. Most sizes can be read from the
+properties zfs list already returns instead: an incremental from the snapshot right
+before is as big as the snapshot's written property, a full send as its referenced
+one. Those are sizes on disk and, unless sent with -c or -w, streams aren't
+compressed, so they're scaled by the compression ratio; without it they could be far
+too small and the chunks would run out. Only the remaining pairs get a dry run,
+several at a time, and the results are kept by the GUIDs of the two snapshots, which
+never change, so no pair is measured twice.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from z3.pput import parse_size
+
+
+def compress_ratio(value):
+    """Parses the compressratio property, 1.50x; returns None if it isn't set"""
+    try:
+        return float(str(value).rstrip('x'))
+    except ValueError:
+        return None
+
+
+class SendSizeEstimator(object):
+    def __init__(self, dry_run, cache=None, concurrency=4, send_flags=''):
+        self._dry_run = dry_run  # (parent, z_snap) -> size, parent is None for a full send
+        self.cache = cache  # z3.cache.MetadataCache, kept across runs
+        self.concurrency = concurrency  # dry-run sends at the same time
+        self.send_flags = send_flags  # the streams differ, so are their cached sizes
+
+    def from_properties(self, parent, z_snap):
+        """Returns the size from the zfs properties of z_snap, None if they don't tell"""
+        flags = self.send_flags.split()
+        if '-R' in flags:
+            return None  # the properties don't count the descendants
+        props = z_snap.metadata or {}
+        ratio = compress_ratio(props.get('compressratio'))
+        if ratio is None:
+            return None
+        if '-c' in flags or '-w' in flags:
+            ratio = 1.0  # blocks are sent as they're stored
+        if parent is None:
+            size = props.get('refer')
+        elif parent.name == z_snap.previous:
+            size = props.get('written')
+        else:
+            return None  # written only covers the changes since the snapshot right before
+        if size in (None, '', '-'):
+            return None
+        return int(parse_size(size) * ratio)
+
+    def _cache_key(self, parent, z_snap):
+        from_guid = '' if parent is None else (parent.metadata or {}).get('guid')
+        to_guid = (z_snap.metadata or {}).get('guid')
+        if from_guid is None or to_guid is None:
+            return None
+        return (from_guid, to_guid, self.send_flags.strip())
+
+    def estimate_many(self, pairs):
+        """Returns the size of sending each (parent, z_snap) pair, in order"""
+        sizes = [self.from_properties(parent, z_snap) for parent, z_snap in pairs]
+        missing = [index for index, size in enumerate(sizes) if size is None]
+        keys = dict((index, self._cache_key(*pairs[index])) for index in missing)
+        if self.cache is not None:
+            cached = self.cache.send_sizes([key for key in keys.values() if key is not None])
+            for index in missing:
+                sizes[index] = cached.get(keys[index])
+        to_measure = [index for index in missing if sizes[index] is None]
+        if len(to_measure) > 1 and self.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                measured = list(pool.map(lambda index: self._dry_run(*pairs[index]), to_measure))
+        else:
+            measured = [self._dry_run(*pairs[index]) for index in to_measure]
+        for index, size in zip(to_measure, measured):
+            sizes[index] = size
+        if self.cache is not None:
+            self.cache.store_send_sizes(dict(
+                (keys[index], sizes[index]) for index in to_measure if keys[index] is not None))
+        return sizes
+
+    def estimate(self, parent, z_snap):
+        return self.estimate_many([(parent, z_snap)])[0]
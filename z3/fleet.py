@@ -0,0 +1,89 @@
+"""Status of every dataset backed up under an S3 prefix.
+
+Datasets are found with a single delimited listing, every dataset is a shard of the
+keyspace that's then listed and checked on its own, many at a time. Meant to be run
+often, as a monitoring probe.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import email.utils
+import logging
+
+from z3 import layout
+
+
+OK = 'ok'
+STALE = 'stale'  # the latest backup is older than allowed
+BROKEN = 'broken'  # the latest backup can't be restored
+EMPTY = 'empty'
+ERROR = 'error'
+
+# latest_age is in seconds; chain_length is the number of incrementals on top of the
+# last full backup for the latest snapshot; broken is the number of unhealthy snapshots
+DatasetStatus = namedtuple('DatasetStatus', [
+    'dataset', 'snapshots', 'latest', 'latest_age', 'chain_length', 'broken', 'status',
+    'error'])
+
+
+def discover_datasets(bucket, s3_prefix):
+    """Returns the names of all datasets with backups under s3_prefix.
+    Keys are named [shard/]dataset@snapshot, so listing with '@' as the delimiter returns
+    one common prefix per dataset and layout, however many snapshots it has.
+    """
+    s3_prefix = s3_prefix.rstrip('/') + '/'
+    datasets = set()
+    for entry in bucket.list(s3_prefix, delimiter='@'):
+        if entry.name.endswith('@'):
+            datasets.add(layout.unshard(entry.name[len(s3_prefix):-1]))
+    return sorted(datasets)
+
+
+def parse_last_modified(value):
+    """Returns a unix timestamp from the Last-Modified of a HEAD or a listing"""
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        parsed = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def dataset_status(dataset, s3_mgr, max_age, now):
+    """Checks the backups of one dataset; max_age is in seconds"""
+    snapshots = s3_mgr.list()
+    if not snapshots:
+        return DatasetStatus(dataset, 0, None, None, None, 0, EMPTY, None)
+    latest = snapshots[-1]  # snapshot names sort by time
+    key = s3_mgr.bucket.get_key(s3_mgr.s3_prefix + latest.key)
+    age = now - parse_last_modified(key.last_modified)
+    broken = sum(1 for s3_snap in snapshots if not s3_snap.is_healthy)
+    if not latest.is_healthy:
+        status = BROKEN
+    elif age > max_age:
+        status = STALE
+    else:
+        status = OK
+    return DatasetStatus(dataset, len(snapshots), latest.name.split('@', 1)[1], age,
+                         latest.chain_depth, broken, status, None)
+
+
+def fleet_status(datasets, make_manager, max_age, now, concurrency=4):
+    """Checks many datasets concurrently.
+    make_manager(dataset) returns the S3SnapshotManager for all backups of a dataset,
+    max_age(dataset) the age in seconds past which its latest backup is stale.
+    Returns a list of DatasetStatus, sorted by dataset.
+    """
+    log = logging.getLogger('fleet')
+
+    def check(dataset):
+        try:
+            return dataset_status(dataset, make_manager(dataset), max_age(dataset), now)
+        except Exception as err:  # pylint: disable=broad-except
+            # one dataset we can't read must not hide the state of the others
+            log.error("failed to check %s: %s", dataset, err)
+            return DatasetStatus(dataset, None, None, None, None, None, ERROR, str(err))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(check, sorted(datasets)))
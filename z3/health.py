@@ -0,0 +1,94 @@
+"""Health checks for the graph of backups.
+
+A full backup is always healthy, an incremental one is healthy if its parent is.
+Every snapshot is classified in a single iterative pass, visiting each one once, so
+checking all of them stays linear and long chains don't hit the recursion limit.
+"""
+
+from array import array
+from collections import namedtuple
+
+
+CYCLE = 'cycle detected'
+MISSING_PARENT = 'missing parent'
+PARENT_BROKEN = 'parent broken'
+
+# analyze_indexed stores reasons as codes, indices in to REASONS
+REASONS = (None, CYCLE, MISSING_PARENT, PARENT_BROKEN)
+_OK, _CYCLE, _MISSING_PARENT, _PARENT_BROKEN = range(len(REASONS))
+NO_PARENT = -1
+
+# reason is None for healthy backups; depth is the number of incrementals back to
+# the nearest full backup and chain_size the bytes of that chain, None when broken
+Health = namedtuple('Health', ['reason', 'depth', 'chain_size'])
+
+
+def classify(is_full, parent_health, size):
+    """Health of a backup given the health of its parent; None for a missing parent"""
+    if is_full:
+        return Health(None, 0, size or 0)
+    if parent_health is None:
+        return Health(MISSING_PARENT, None, None)
+    if parent_health.reason is None:
+        return Health(None, parent_health.depth + 1, parent_health.chain_size + (size or 0))
+    if parent_health.reason == CYCLE:
+        # anything that leads in to a cycle is reported as part of it
+        return Health(CYCLE, None, None)
+    return Health(PARENT_BROKEN, None, None)
+
+
+def health_at(reasons, depths, chain_sizes, position):
+    """Health of a backup from the arrays returned by analyze_indexed"""
+    reason = REASONS[reasons[position]]
+    if reason is not None:
+        return Health(reason, None, None)
+    return Health(None, depths[position], chain_sizes[position])
+
+
+def analyze_indexed(is_full, parents, sizes):
+    """Classifies every backup. The backups are parallel sequences indexed by position:
+    whether each one is full, the position of its parent or NO_PARENT when there's none
+    or it's missing, and its size.
+    Returns arrays of reason codes (see REASONS), depths and chain sizes.
+    """
+    count = len(parents)
+    reasons = bytearray(count)
+    depths = array('l', [0]) * count
+    chain_sizes = array('q', [0]) * count
+    done = bytearray(count)
+    for start in range(count):
+        # walk up until we reach something already classified, a full backup,
+        # a missing parent or a snapshot already on this walk
+        path, on_path = [], {}
+        position = start
+        while not done[position]:
+            if position in on_path:
+                for looped in path[on_path[position]:]:
+                    reasons[looped] = _CYCLE
+                    done[looped] = 1
+                break
+            if is_full[position] or parents[position] == NO_PARENT:
+                if is_full[position]:
+                    chain_sizes[position] = sizes[position] or 0
+                else:
+                    reasons[position] = _MISSING_PARENT
+                done[position] = 1
+                break
+            on_path[position] = len(path)
+            path.append(position)
+            position = parents[position]
+        # then classify the walk top down, each parent is known by now
+        for position in reversed(path):
+            if done[position]:
+                continue
+            parent = parents[position]
+            if reasons[parent] == _OK:
+                depths[position] = depths[parent] + 1
+                chain_sizes[position] = chain_sizes[parent] + (sizes[position] or 0)
+            elif reasons[parent] == _CYCLE:
+                # anything that leads in to a cycle is reported as part of it
+                reasons[position] = _CYCLE
+            else:
+                reasons[position] = _PARENT_BROKEN
+            done[position] = 1
+    return reasons, depths, chain_sizes
@@ -0,0 +1,214 @@
+"""Read the key listing from S3 Inventory reports.
+
+Listing a bucket with millions of keys takes one LIST request per thousand keys.
+S3 Inventory writes a list of every key in a bucket, daily or weekly, as a manifest
+and a set of data files in CSV, ORC or Parquet format. z3 can read the listing from
+the latest report and only LIST the keys added since; snapshot names sort by time,
+so those are the keys after the last one in the report. Reports don't include user
+metadata, that's still read from the catalog, the cache or with HEAD requests.
+
+ORC and Parquet reports require pyarrow.
+"""
+
+import bisect
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import tempfile
+from urllib.parse import unquote_plus
+
+
+MANIFEST = 'manifest.json'
+# reports are written to folders named after the time they were taken, these sort by time
+REPORT_FOLDER = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$')
+COLUMNS = ('key', 'e_tag', 'is_latest', 'is_delete_marker')
+
+
+class InventoryError(Exception):
+    pass
+
+
+def _column_name(name):
+    """Normalizes csv schema names to the ones used by ORC and Parquet, ETag -> e_tag"""
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name.strip()).lower()
+
+
+def _is_true(value):
+    return value is True or value == 'true'
+
+
+def _csv_rows(data_file, schema):
+    columns = [_column_name(name) for name in schema.split(',')]
+    with gzip.GzipFile(fileobj=data_file) as raw:
+        for values in csv.reader(io.TextIOWrapper(raw, encoding='utf8', newline='')):
+            row = dict(zip(columns, values))
+            row['key'] = unquote_plus(row['key'])  # csv reports url-encode key names
+            yield row
+
+
+def _arrow_batches(data_file, file_format):
+    try:
+        if file_format == 'ORC':
+            from pyarrow import orc
+        else:
+            from pyarrow import parquet
+    except ImportError:
+        raise InventoryError(
+            "reading {} inventory reports requires pyarrow".format(file_format))
+    if file_format == 'ORC':
+        orc_file = orc.ORCFile(data_file)
+        present = [name for name in COLUMNS if name in orc_file.schema.names]
+        for stripe in range(orc_file.nstripes):
+            yield orc_file.read_stripe(stripe, columns=present)
+    else:
+        parquet_file = parquet.ParquetFile(data_file)
+        present = [name for name in COLUMNS if name in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(columns=present):
+            yield batch
+
+
+def _arrow_rows(data_file, file_format):
+    for batch in _arrow_batches(data_file, file_format):
+        columns = dict((name, batch.column(index).to_pylist())
+                       for index, name in enumerate(batch.schema.names))
+        for index in range(batch.num_rows):
+            yield dict((name, values[index]) for name, values in columns.items())
+
+
+class Inventory(object):
+    """The keys in one inventory report.
+    open_file(key) returns a seekable binary file holding the data file `key`
+    listed in the manifest. Only keys under `prefix` are kept in memory.
+    """
+
+    def __init__(self, manifest, open_file, prefix=''):
+        self.manifest = manifest
+        self.prefix = prefix
+        self._open_file = open_file
+        self._keys = None  # sorted key names
+        self._etags = None  # etags of _keys, in the same order
+        self.log = logging.getLogger('Inventory')
+
+    @property
+    def source_bucket(self):
+        return self.manifest.get('sourceBucket')
+
+    @property
+    def created(self):
+        """When the report was taken, as a utc datetime"""
+        return datetime.datetime.utcfromtimestamp(
+            int(self.manifest['creationTimestamp']) / 1000.0)
+
+    def _rows(self):
+        file_format = self.manifest.get('fileFormat', 'CSV')
+        if file_format not in ('CSV', 'ORC', 'Parquet'):
+            raise InventoryError("unknown inventory format '{}'".format(file_format))
+        for data in self.manifest['files']:
+            with self._open_file(data['key']) as data_file:
+                if file_format == 'CSV':
+                    rows = _csv_rows(data_file, self.manifest['fileSchema'])
+                else:
+                    rows = _arrow_rows(data_file, file_format)
+                for row in rows:
+                    yield row
+
+    def _load(self):
+        listed = []
+        for row in self._rows():
+            # versioned buckets list every version, keep the current ones
+            if _is_true(row.get('is_delete_marker')) or row.get('is_latest') in (False, 'false'):
+                continue
+            if row['key'].startswith(self.prefix):
+                # listings quote etags, so does boto; ETag is an optional field of a
+                # report, without it the cache and the catalog are trusted
+                etag = row.get('e_tag')
+                listed.append((row['key'], None if etag is None else
+                               '"{}"'.format(etag.strip('"'))))
+        listed.sort()
+        self._keys = [key_name for key_name, _ in listed]
+        self._etags = [etag for _, etag in listed]
+        self.log.info("read %d keys from the inventory report of %s taken at %s",
+                      len(self._keys), self.source_bucket, self.created)
+
+    def keys(self, prefix=None):
+        """Returns a dict of key name -> etag for the keys starting with prefix"""
+        if prefix is None:
+            prefix = self.prefix
+        if not prefix.startswith(self.prefix):
+            raise AssertionError("'{}' is outside of the inventory prefix '{}'".format(
+                prefix, self.prefix))
+        if self._keys is None:
+            self._load()
+        start = bisect.bisect_left(self._keys, prefix)
+        end = start
+        while end < len(self._keys) and self._keys[end].startswith(prefix):
+            end += 1
+        return dict(zip(self._keys[start:end], self._etags[start:end]))
+
+
+def _local_inventory(path, prefix):
+    if os.path.isdir(path):
+        folders = sorted(name for name in os.listdir(path) if REPORT_FOLDER.match(name))
+        if not folders:
+            raise InventoryError("no inventory reports in {}".format(path))
+        path = os.path.join(path, folders[-1], MANIFEST)
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    # a copy of the inventory destination has the data files in config-folder/data/
+    config_folder = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+
+    def open_file(key):
+        file_name = posixpath.basename(key)
+        for candidate in [os.path.join(config_folder, 'data', file_name),
+                          os.path.join(os.path.dirname(path), file_name)]:
+            if os.path.exists(candidate):
+                return open(candidate, 'rb')
+        raise InventoryError("missing inventory data file {}".format(file_name))
+    return Inventory(manifest, open_file, prefix=prefix)
+
+
+def _s3_inventory(bucket, key_name, prefix):
+    if not key_name.endswith(MANIFEST):
+        folder = key_name.rstrip('/') + '/'
+        folders = sorted(
+            key.name[len(folder):].rstrip('/') for key in bucket.list(folder, delimiter='/'))
+        folders = [name for name in folders if REPORT_FOLDER.match(name)]
+        if not folders:
+            raise InventoryError("no inventory reports in s3://{}/{}".format(bucket.name, folder))
+        key_name = "{}{}/{}".format(folder, folders[-1], MANIFEST)
+    manifest = json.loads(bucket.new_key(key_name).get_contents_as_string().decode('utf8'))
+
+    def open_file(key):
+        # ORC and Parquet need to seek, a temporary file also keeps memory use flat
+        data_file = tempfile.TemporaryFile()
+        bucket.new_key(key).get_contents_to_file(data_file)
+        data_file.seek(0)
+        return data_file
+    return Inventory(manifest, open_file, prefix=prefix)
+
+
+def open_inventory(location, bucket, prefix=''):
+    """Opens the inventory report at location, a local path or s3://bucket/key.
+    location is either a manifest.json or the folder of an inventory configuration,
+    in which case the latest report is used. `bucket` is the bucket the report is
+    about, its connection is used to read reports stored in S3.
+    """
+    if location.startswith('s3://'):
+        bucket_name, _, key_name = location[len('s3://'):].partition('/')
+        if bucket_name != bucket.name:
+            report_bucket = bucket.connection.get_bucket(bucket_name)
+        else:
+            report_bucket = bucket
+        inventory = _s3_inventory(report_bucket, key_name, prefix)
+    else:
+        inventory = _local_inventory(location, prefix)
+    if inventory.source_bucket not in (None, bucket.name):
+        raise InventoryError("the inventory report at {} is for bucket {}, not {}".format(
+            location, inventory.source_bucket, bucket.name))
+    return inventory
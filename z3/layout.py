@@ -0,0 +1,100 @@
+"""Where backups are stored in the bucket.
+
+By default keys are named S3_PREFIX + dataset@snapshot. S3 limits the request rate
+per key prefix, so when many hosts upload at the same time they can get throttled.
+The sharded layout puts a short hash of the dataset name in front of the key,
+S3_PREFIX + shard/ + dataset@snapshot, spreading datasets over 256 prefixes. The
+shard is derived from the dataset name, so a snapshot can still be found by name
+and all the backups of a dataset stay under a single prefix.
+"""
+
+import functools
+import hashlib
+import logging
+import re
+
+from z3.config import get_config
+from z3.scheduler import Job
+
+
+SHARD_WIDTH = 2  # hex digits
+SHARD = re.compile(r'^[0-9a-f]{%d}/' % SHARD_WIDTH)
+COPY_LIMIT = 5 * 1024 ** 3  # the largest object a single COPY request can create
+COPY_PART_SIZE = 512 * 1024 ** 2
+
+
+class MigrationError(Exception):
+    pass
+
+
+def shard_prefix(dataset):
+    """Returns the shard of a dataset, with a trailing /"""
+    return hashlib.md5(dataset.encode('utf8')).hexdigest()[:SHARD_WIDTH] + '/'
+
+
+def unshard(name):
+    """Returns name without its shard, or name if it isn't sharded.
+    name is relative to the s3 prefix and starts with a dataset name.
+    """
+    if SHARD.match(name):
+        rest = name[SHARD_WIDTH + 1:]
+        if shard_prefix(rest.split('@', 1)[0]) == name[:SHARD_WIDTH + 1]:
+            return rest
+    return name
+
+
+def copy_key(bucket, src_name, dst_name, size, storage_class=None, part_size=COPY_PART_SIZE):
+    """Copies a key inside the bucket, the data never leaves S3.
+    The copy keeps storage_class, that of the source by default; S3 would make it STANDARD.
+    """
+    src = None
+    if storage_class is None:
+        src = bucket.get_key(src_name)
+        storage_class = src.storage_class or get_config().get('S3_STORAGE_CLASS')
+    if size <= COPY_LIMIT:
+        # metadata is copied too
+        bucket.copy_key(dst_name, bucket.name, src_name, storage_class=storage_class)
+        return
+    metadata = (src or bucket.get_key(src_name)).metadata
+    upload = bucket.initiate_multipart_upload(
+        dst_name, metadata=metadata, headers={'x-amz-storage-class': storage_class})
+    try:
+        for part_num, start in enumerate(range(0, size, part_size), 1):
+            upload.copy_part_from_key(
+                bucket.name, src_name, part_num, start, min(start + part_size, size) - 1)
+    except Exception:
+        upload.cancel_upload()
+        raise
+    upload.complete_upload()
+
+
+def _migrate_key(bucket, src_name, dst_name, size, copied_size, delete, storage_class=None):
+    if copied_size != size:
+        copy_key(bucket, src_name, dst_name, size, storage_class=storage_class)
+        copied = bucket.get_key(dst_name)
+        if copied is None or copied.size != size:
+            raise MigrationError("copy of {} to {} is incomplete".format(src_name, dst_name))
+    if delete:
+        bucket.delete_key(src_name)
+
+
+def migration_jobs(bucket, s3_prefix, dataset, delete=False):
+    """Returns a Job for every backup of dataset that isn't in the sharded layout yet.
+    Keys that have already been copied are only deleted, if delete is set.
+    """
+    s3_prefix = s3_prefix.rstrip('/') + '/'
+    shard = shard_prefix(dataset)
+    copied = dict((key.name, key.size)
+                  for key in bucket.list(s3_prefix + shard + dataset + '@'))
+    jobs = []
+    for key in bucket.list(s3_prefix + dataset + '@'):
+        dst_name = s3_prefix + shard + key.name[len(s3_prefix):]
+        if copied.get(dst_name) == key.size and not delete:
+            continue
+        logging.debug("migrating %s to %s", key.name, dst_name)
+        jobs.append(Job(
+            name=key.name, cost=key.size,
+            func=functools.partial(_migrate_key, bucket, key.name, dst_name, key.size,
+                                   copied.get(dst_name), delete,
+                                   storage_class=getattr(key, 'storage_class', None))))
+    return jobs
@@ -0,0 +1,224 @@
+"""Coordinates the uploads of many hosts through leases stored in S3.
+
+A lease is a small json object written with a conditional PUT: If-None-Match: * only
+creates it if it doesn't exist, so of many hosts writing the same lease at once exactly
+one wins. A lease names its owner and when it expires; the owner renews it while it's
+held and deletes it when done. A lease left behind by a host that died is taken over once
+it has expired, with If-Match on the etag that was read, so again only one host wins.
+Expiry is judged by the clocks of the hosts, they have to be kept in sync.
+
+Two things are built on leases:
+* claims, one per snapshot being uploaded, so a second run uploading the same snapshot
+  skips it instead of sending it again
+* a fixed number of upload slots shared by every host, a backup waits for a free one
+"""
+
+import contextlib
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+import boto.exception
+
+from z3.catalog import META_PREFIX
+
+
+LEASE_PREFIX = META_PREFIX + 'leases/'
+CLAIM_PREFIX = 'claims/'  # the names of leases are relative to LEASE_PREFIX
+SLOT_PREFIX = 'slots/'
+# the conditional write lost: the lease exists, was changed or is being written by another
+LOST = (404, 409, 412)
+
+
+class LeaseError(Exception):
+    pass
+
+
+class Lease(object):
+    def __init__(self, name, key_name, token, etag, expires):
+        self.name = name  # relative to the lease prefix
+        self.key_name = key_name
+        self.token = token  # tells our lease from the one of a host that took it over
+        self.etag = etag  # of our last write, for If-Match
+        self.expires = expires
+
+    def __repr__(self):
+        return "<Lease {} until {}>".format(self.name, self.expires)
+
+
+def default_owner():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class LeaseStore(object):
+    """Takes, renews and releases leases; the ones held are renewed every third of
+    duration by a background thread, as long as any is held.
+    """
+    def __init__(self, bucket, s3_prefix, owner=None, duration=900, clock=time.time):
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix.rstrip('/') + '/'
+        self.owner = owner or default_owner()
+        self.duration = duration  # seconds a lease lasts without being renewed
+        self.clock = clock
+        self._held = {}  # name -> Lease
+        self._lock = threading.Lock()
+        self._renewer = None
+        self.log = logging.getLogger('LeaseStore')
+
+    def _key_name(self, name):
+        # snapshot names would show up as datasets in a listing delimited by '@'
+        return self.s3_prefix + LEASE_PREFIX + quote(name, safe='/')
+
+    def _write(self, key_name, token, headers):
+        body = json.dumps({'owner': self.owner, 'token': token,
+                           'expires': self.clock() + self.duration}, sort_keys=True)
+        key = self.bucket.new_key(key_name)
+        try:
+            key.set_contents_from_string(body, headers=dict(
+                headers, **{'Content-Type': 'application/json'}))
+        except boto.exception.S3ResponseError as err:
+            if err.status not in LOST:
+                raise
+            return None
+        return key.etag
+
+    def read(self, name):
+        """Returns the content of a lease and its etag, (None, None) if there's none"""
+        key = self.bucket.new_key(self._key_name(name))
+        try:
+            raw = key.get_contents_as_string()
+        except boto.exception.S3ResponseError as err:
+            if err.status != 404:
+                raise
+            return None, None
+        return json.loads(raw.decode('utf8')), key.etag
+
+    def acquire(self, name):
+        """Returns a Lease, or None if another owner holds it"""
+        key_name, token = self._key_name(name), uuid.uuid4().hex
+        etag = self._write(key_name, token, {'If-None-Match': '*'})
+        if etag is None:
+            current, current_etag = self.read(name)
+            if current is None:
+                return None  # released in the meantime, it's for the next attempt
+            if current['expires'] > self.clock():
+                return None
+            self.log.info("taking over %s, expired lease of %s", name, current['owner'])
+            etag = self._write(key_name, token, {'If-Match': current_etag})
+            if etag is None:
+                return None
+        lease = Lease(name, key_name, token, etag, self.clock() + self.duration)
+        with self._lock:
+            self._held[name] = lease
+            if self._renewer is None:
+                self._renewer = threading.Thread(target=self._renew_held)
+                self._renewer.daemon = True
+                self._renewer.start()
+        return lease
+
+    def renew(self, lease):
+        """Extends a lease; returns False if it was lost to another owner"""
+        etag = self._write(lease.key_name, lease.token, {'If-Match': lease.etag})
+        if etag is None:
+            self.log.warning("lost the lease %s", lease.name)
+            with self._lock:
+                self._held.pop(lease.name, None)
+            return False
+        lease.etag, lease.expires = etag, self.clock() + self.duration
+        return True
+
+    def _renew_held(self):
+        while True:
+            time.sleep(self.duration / 3.0)
+            with self._lock:
+                held = list(self._held.values())
+                if not held:
+                    self._renewer = None
+                    return
+            for lease in held:
+                try:
+                    self.renew(lease)
+                except Exception as err:  # pylint: disable=broad-except
+                    # S3 is having a bad time, the lease is still good for a while
+                    self.log.warning("failed to renew %s: %s", lease.name, err)
+
+    def release(self, lease):
+        """Deletes a lease, unless another owner took it over"""
+        with self._lock:
+            self._held.pop(lease.name, None)
+        current, etag = self.read(lease.name)
+        if current is None or current['token'] != lease.token:
+            return
+        try:
+            self.bucket.delete_key(lease.key_name, headers={'If-Match': etag})
+        except boto.exception.S3ResponseError as err:
+            if err.status not in LOST:
+                raise
+
+
+class Coordinator(object):
+    """Per snapshot claims and fleet-wide upload slots; either one can be turned off"""
+    def __init__(self, leases, claims=True, slots=0, slot_wait=3600, poll=30,
+                 sleep=time.sleep):
+        self.leases = leases
+        self.claims = claims
+        self.slots = slots  # backups uploading at the same time on all hosts, 0 for no limit
+        self.slot_wait = slot_wait  # seconds to wait for a free slot before giving up
+        self.poll = poll  # seconds between two rounds over the slots
+        self.sleep = sleep
+        self.log = logging.getLogger('Coordinator')
+
+    @contextlib.contextmanager
+    def claim(self, key_names):
+        """Claims the keys about to be uploaded, oldest first. Yields the ones claimed,
+        stopping at the first one another run is uploading or has uploaded since they
+        were found missing; the keys after it depend on it.
+        """
+        claimed = []
+        try:
+            for key_name in key_names if self.claims else ():
+                lease = self.leases.acquire(CLAIM_PREFIX + key_name)
+                if lease is None:
+                    current, _ = self.leases.read(CLAIM_PREFIX + key_name)
+                    self.log.warning("skipping %s, it's being uploaded by %s", key_name,
+                                     current['owner'] if current else 'another run')
+                    break
+                claimed.append(lease)
+                if self.leases.bucket.get_key(self.leases.s3_prefix + key_name) is not None:
+                    self.log.warning("skipping %s, it's been uploaded by another run",
+                                     key_name)
+                    claimed.pop()
+                    self.leases.release(lease)
+                    break
+            yield key_names[:len(claimed)] if self.claims else key_names
+        finally:
+            for lease in claimed:
+                self.leases.release(lease)
+
+    def acquire_slot(self):
+        """Takes one of the fleet-wide upload slots, waits for one to be free.
+        Returns its lease, None if there's no limit.
+        """
+        if not self.slots:
+            return None
+        deadline = self.leases.clock() + self.slot_wait
+        while True:
+            # in random order, so hosts don't all fight over the first slots
+            for index in random.sample(range(self.slots), self.slots):
+                lease = self.leases.acquire(SLOT_PREFIX + str(index))
+                if lease is not None:
+                    return lease
+            if self.leases.clock() >= deadline:
+                raise LeaseError("none of the {} upload slots got free in {}s".format(
+                    self.slots, self.slot_wait))
+            self.sleep(self.poll * random.uniform(0.5, 1.5))
+
+    def release_slot(self, lease):
+        if lease is not None:
+            self.leases.release(lease)
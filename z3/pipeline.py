@@ -0,0 +1,363 @@
+"""Runs pipelines of commands without a shell.
+
+Every stage is its own process and z3 relays the data between them, so the exit status of
+every stage is checked and every boundary is measured: the bytes that went through, the
+time spent waiting for the stage before it to produce data and for the stage after it to
+take it. Data is moved with splice(2), from pipe to pipe inside the kernel, or with large
+reads and writes where that isn't available. The first boundary also reports progress and
+enforces the rate limit, which used to take pv. The last stage can be a Sink, a function
+run in a thread of this process, that reads the output of the stage before it.
+"""
+
+import fcntl
+import functools
+import os
+import select
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+CHUNK = 1024 * 1024  # the most bytes moved at once
+PIPE_SIZE = 1024 * 1024  # pipes only hold 64K by default
+
+
+def split_pipeline(cmd):
+    """Splits 'a -x | b "c d"' in to the argv of every stage, [['a', '-x'], ['b', 'c d']]"""
+    lexer = shlex.shlex(cmd, posix=True, punctuation_chars='|')
+    lexer.whitespace_split = True
+    stages = [[]]
+    for token in lexer:
+        if token == '|':
+            stages.append([])
+        else:
+            stages[-1].append(token)
+    if not all(stages):
+        raise ValueError("empty stage in pipeline {!r}".format(cmd))
+    return stages
+
+
+def _humanize_rate(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TiB'
+    return "{:.1f} {}".format(size, unit)
+
+
+class RateLimiter(object):
+    """Caps the bytes per second relayed by every pipeline sharing it"""
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()  # when the bytes already let through are paid for
+
+    @property
+    def chunk_size(self):
+        # about 10 waits per second so the rate stays even
+        return max(4096, min(CHUNK, self.rate // 10))
+
+    def wait(self, size):
+        """Called after moving size bytes, sleeps until they fit in the rate"""
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / float(self.rate)
+        if start > now:
+            time.sleep(start - now)
+
+
+class Progress(object):
+    """Shows the bytes relayed so far on a terminal line, instead of pv"""
+    def __init__(self, estimated_size=None, out=None, every=1.0):
+        self.estimated_size = estimated_size
+        self.out = out or sys.stderr
+        self.every = every  # seconds between updates
+        self._started = time.monotonic()
+        self._shown = 0
+
+    def update(self, done, final=False):
+        now = time.monotonic()
+        if not final and now - self._shown < self.every:
+            return
+        self._shown = now
+        rate = done / max(now - self._started, 1e-6)
+        line = "{} at {}/s".format(_humanize_rate(done), _humanize_rate(rate))
+        if self.estimated_size:
+            line += " ({:.0f}% of ~{})".format(
+                100.0 * done / self.estimated_size, _humanize_rate(self.estimated_size))
+        self.out.write("\r" + line + ("\n" if final else ""))
+        self.out.flush()
+
+
+class Relay(object):
+    """Moves the output of one stage to the input of the next and times the waits"""
+    def __init__(self, src, dst, limiter=None, progress=None, upstream=None, abort=None):
+        self.src = src
+        self.dst = dst
+        self.upstream = upstream  # the Stage writing to src
+        self.abort = abort  # stops the stages after, so they don't take a cut stream as whole
+        self.limiter = limiter
+        self.progress = progress
+        self.bytes = 0
+        self.read_wait = 0.0  # waiting for the stage before to produce data
+        self.write_wait = 0.0  # waiting for the stage after to take it
+        self.error = None
+
+    def _wait(self, fd, event):
+        poller = select.poll()
+        poller.register(fd, event)
+        started = time.monotonic()
+        poller.poll()
+        return time.monotonic() - started
+
+    def _move(self, size):
+        if hasattr(os, 'splice'):
+            try:
+                return os.splice(self.src, self.dst, size,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return None  # the other side of the pipe raced us, wait again
+        data = os.read(self.src, size)
+        started = time.monotonic()
+        view = memoryview(data)
+        while view:
+            written = os.write(self.dst, view)
+            view = view[written:]
+        self.write_wait += time.monotonic() - started
+        return len(data)
+
+    def run(self):
+        size = self.limiter.chunk_size if self.limiter is not None else CHUNK
+        try:
+            while True:
+                self.read_wait += self._wait(self.src, select.POLLIN)
+                self.write_wait += self._wait(self.dst, select.POLLOUT)
+                moved = self._move(size)
+                if moved is None:
+                    continue
+                if moved == 0:
+                    # the end of the stream, unless the stage before failed half way
+                    if self.upstream is not None and self.upstream.process.wait() != 0:
+                        self.abort()
+                    break
+                self.bytes += moved
+                if self.limiter is not None:
+                    self.limiter.wait(moved)
+                if self.progress is not None:
+                    self.progress.update(self.bytes)
+        except OSError as err:  # the next stage is gone, its exit status tells why
+            self.error = err
+        finally:
+            # the stages on both sides see the end of the stream, or SIGPIPE
+            os.close(self.src)
+            os.close(self.dst)
+        if self.progress is not None:
+            self.progress.update(self.bytes, final=True)
+
+
+class SinkProcess(object):
+    """A Sink running in a thread, looks like a Popen to the pipeline"""
+    def __init__(self, func, fd):
+        self.returncode = None
+        self.error = None
+        self.result = None  # what func returned
+        self.stopped = False  # the stream was cut short, func mustn't take it for whole
+        self._thread = threading.Thread(target=self._run, args=(func, fd))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, fd):
+        try:
+            # closing the input when done lets the relay writing to it see EPIPE
+            with os.fdopen(fd, 'rb') as stream:
+                self.result = func(stream, lambda: self.stopped)
+        except BaseException as err:  # pylint: disable=broad-except
+            self.error = err
+            self.returncode = 1
+        else:
+            self.returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+    def terminate(self):
+        self.stopped = True
+
+    kill = terminate
+
+
+class Sink(object):
+    """The last stage of a pipeline run in this process: func(stream, stopped) reads the
+    stream, stopped() tells whether the stages before were stopped half way.
+    """
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def start(self, stdin):
+        return SinkProcess(self.func, os.dup(stdin))
+
+
+class Stage(object):
+    def __init__(self, argv):
+        self.sink = argv if isinstance(argv, Sink) else None
+        if self.sink is not None:
+            argv = [self.sink.name]
+        self.argv = argv
+        self.cmd = " ".join(shlex.quote(arg) for arg in argv)
+        self.process = None
+        self.bytes = 0  # the bytes it wrote, or read for the last stage
+        self.stalled = 0.0  # seconds it kept the other stages waiting
+
+    @property
+    def name(self):
+        return os.path.basename(self.argv[0])
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def status(self):
+        if self.sink is not None and self.process.error is not None:
+            return "failed: {}".format(self.process.error)
+        if self.returncode < 0:
+            try:
+                return "killed by {}".format(signal.Signals(-self.returncode).name)
+            except ValueError:
+                return "killed by signal {}".format(-self.returncode)
+        return "exited with {}".format(self.returncode)
+
+
+class PipelineError(subprocess.CalledProcessError):
+    """Some stages failed; returncode and cmd are those of the stage that failed first,
+    the stages before it were likely killed by SIGPIPE when it went away, the ones
+    after it were stopped.
+    """
+    def __init__(self, failed):
+        failed = sorted(failed, key=lambda stage: stage.returncode in (
+            -signal.SIGPIPE, -signal.SIGTERM))
+        super(PipelineError, self).__init__(failed[0].returncode, failed[0].cmd)
+        self.failed = failed
+
+    def __str__(self):
+        return "; ".join("'{}' {}".format(stage.cmd, stage.status) for stage in self.failed)
+
+
+def _pipe():
+    read_end, write_end = os.pipe()
+    try:
+        fcntl.fcntl(write_end, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+    except (AttributeError, OSError):
+        pass  # not linux, or above /proc/sys/fs/pipe-max-size
+    return read_end, write_end
+
+
+class Pipeline(object):
+    def __init__(self, stages, limiter=None, progress=None):
+        self.stages = [Stage(argv) for argv in stages]
+        if any(stage.sink is not None for stage in self.stages[:-1]) or (
+                self.stages[0].sink is not None):
+            raise ValueError("a Sink can only be the last stage, after a command")
+        self.limiter = limiter  # a RateLimiter, applied to the first boundary
+        self.progress = progress  # a Progress, for the first boundary
+        self.relays = []
+        self.duration = None
+
+    def _start(self):
+        stdin = None
+        for index, stage in enumerate(self.stages):
+            last = index == len(self.stages) - 1
+            stdout = None
+            if not last:
+                relay_in, stdout = _pipe()
+            try:
+                if stage.sink is not None:
+                    stage.process = stage.sink.start(stdin)
+                else:
+                    stage.process = subprocess.Popen(stage.argv, stdin=stdin, stdout=stdout)
+            finally:
+                for fd in (stdin, stdout):
+                    if fd is not None:
+                        os.close(fd)
+            if not last:
+                stdin, relay_out = _pipe()
+                first = index == 0
+                self.relays.append(Relay(
+                    relay_in, relay_out,
+                    limiter=self.limiter if first else None,
+                    progress=self.progress if first else None,
+                    upstream=stage, abort=functools.partial(self._stop, index + 1)))
+
+    def _stop(self, start):
+        for stage in self.stages[start:]:
+            if stage.process is not None and stage.process.poll() is None:
+                stage.process.terminate()
+
+    def run(self):
+        """Runs every stage to the end, raises a PipelineError if any of them failed"""
+        started = time.monotonic()
+        try:
+            self._start()
+        except OSError:
+            for relay in self.relays:
+                os.close(relay.src)
+                os.close(relay.dst)
+            for stage in self.stages:
+                if stage.process is not None:
+                    stage.process.kill()
+                    stage.process.wait()
+            raise
+        threads = [threading.Thread(target=relay.run) for relay in self.relays]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for stage in self.stages:
+            stage.process.wait()
+        self.duration = time.monotonic() - started
+        self._account()
+        failed = [stage for stage in self.stages if stage.returncode != 0]
+        if failed:
+            raise PipelineError(failed)
+        return self
+
+    def _account(self):
+        """A slow stage starves the stages after it and backs up the ones before it, so
+        the waits of every boundary grow alike. What a stage adds is the difference with
+        the boundary on its other side.
+        """
+        for index, stage in enumerate(self.stages):
+            before = self.relays[index - 1] if index > 0 else None
+            after = self.relays[index] if index < len(self.relays) else None
+            stage.bytes = (after or before).bytes if (after or before) else 0
+            stage.stalled = ((after.read_wait if after else 0) -
+                             (before.read_wait if before else 0) +
+                             (before.write_wait if before else 0) -
+                             (after.write_wait if after else 0))
+
+    @property
+    def bottleneck(self):
+        if len(self.stages) < 2:
+            return None
+        return max(self.stages, key=lambda stage: stage.stalled)
+
+    def summary(self):
+        rates = ", ".join(
+            "{} {}/s".format(stage.name, _humanize_rate(stage.bytes / max(self.duration, 1e-6)))
+            for stage in self.stages)
+        bottleneck = self.bottleneck
+        if bottleneck is None:
+            return rates
+        return "{}; bottleneck: {}".format(rates, bottleneck.name)
@@ -0,0 +1,103 @@
+"""Pick the cheapest chain of S3 objects to restore a snapshot.
+
+Every object in S3 is an edge in a graph of snapshots: a full backup leads from the
+empty dataset to its snapshot, an incremental one leads from its parent. A snapshot
+can be reached through more than one object, eg. a daily incremental and a cumulative
+incremental on top of the last full backup. Local snapshots are free starting points.
+"""
+
+import heapq
+
+
+EMPTY = None  # the starting point of full backups
+
+
+class RestorePlanner(object):
+    BYTES = 'bytes'
+    STREAMS = 'streams'
+    METRICS = (BYTES, STREAMS)
+
+    def __init__(self, s3_manager, zfs_manager, metric=BYTES):
+        if metric not in self.METRICS:
+            raise AssertionError("unknown restore metric '{}'".format(metric))
+        self.s3_manager = s3_manager
+        self.zfs_manager = zfs_manager
+        self.metric = metric
+        self._best = None
+
+    def _weight(self, s3_obj):
+        # ties on the main metric are broken by the other one
+        size = s3_obj.size or 0
+        if self.metric == self.STREAMS:
+            return (1, size)
+        return (size, 1)
+
+    def reset(self):
+        """Forgets the paths found, eg. after backups were deleted"""
+        self._best = None
+
+    @property
+    def _paths(self):
+        if self._best is None:
+            self._best = self._find_paths()
+        return self._best
+
+    def _find_paths(self):
+        """Runs Dijkstra once from every starting point.
+        Returns a dict of snapshot name -> (cost, object used to reach it);
+        the object is None for the starting points.
+        """
+        children = {}
+        for s3_obj in self.s3_manager.objects():
+            if s3_obj.is_full:
+                source = EMPTY
+            elif s3_obj.parent_name is None:
+                continue  # incremental with no parent, can't be restored
+            else:
+                source = s3_obj.parent_name
+            children.setdefault(source, []).append(s3_obj)
+        starts = [EMPTY] + [z_snap.name for z_snap in self.zfs_manager.list()]
+        # the counter keeps heapq from ever comparing names or objects
+        heap = [((0, 0), index, name, None) for index, name in enumerate(starts)]
+        counter = len(heap)
+        best = {}
+        while heap:
+            cost, _, name, s3_obj = heapq.heappop(heap)
+            if name in best:
+                continue
+            best[name] = (cost, s3_obj)
+            for child in children.get(name, ()):
+                if child.name in best:
+                    continue
+                weight = self._weight(child)
+                counter += 1
+                heapq.heappush(
+                    heap, ((cost[0] + weight[0], cost[1] + weight[1]), counter, child.name, child))
+        return best
+
+    def plan(self, snap_name):
+        """Returns the objects to receive, in order, to restore snap_name.
+        An empty list means the snapshot exists locally, None that it can't be restored.
+        """
+        if snap_name not in self._paths:
+            return None
+        to_restore = []
+        name = snap_name
+        while True:
+            _, s3_obj = self._paths[name]
+            if s3_obj is None:
+                break
+            to_restore.append(s3_obj)
+            name = EMPTY if s3_obj.is_full else s3_obj.parent_name
+        return list(reversed(to_restore))
+
+    def estimate(self, snap_name):
+        """Returns (bytes, streams) needed to restore snap_name or None.
+        Read from the cost of the path found, the chain isn't walked again.
+        """
+        if snap_name not in self._paths:
+            return None
+        cost, _ = self._paths[snap_name]
+        if self.metric == self.STREAMS:
+            return cost[1], cost[0]
+        return cost
@@ -0,0 +1,72 @@
+"""When an incremental backup should be a full backup instead.
+
+Restoring a snapshot means receiving its whole chain, the last full backup and every
+incremental on top of it, so an incremental-only schedule makes restores slower and
+slower. The policy starts a new chain once the current one crosses a threshold.
+"""
+
+
+class FullBackupPolicy(object):
+    """All thresholds are optional, a full backup is made when any of them is crossed:
+    max_chain_length: incrementals on top of the last full backup
+    max_incremental_ratio: bytes stored for those incrementals / bytes of the full backup
+    max_full_age: seconds since the full backup was uploaded
+    max_estimate_ratio: estimated size of the incremental send / of a full send
+    """
+
+    def __init__(self, max_chain_length=None, max_incremental_ratio=None, max_full_age=None,
+                 max_estimate_ratio=None):
+        self.max_chain_length = max_chain_length
+        self.max_incremental_ratio = max_incremental_ratio
+        self.max_full_age = max_full_age
+        self.max_estimate_ratio = max_estimate_ratio
+
+    @classmethod
+    def from_config(cls, cfg, section=None):
+        """Reads the FULL_* settings; returns None if none of them is set"""
+        def setting(key, convert, scale=1):
+            value = cfg.get(key, section=section)
+            if value is None or str(value).strip() == '':
+                return None
+            return convert(value) * scale
+        policy = cls(
+            max_chain_length=setting('FULL_MAX_CHAIN_LENGTH', int),
+            max_incremental_ratio=setting('FULL_MAX_INCREMENTAL_RATIO', float),
+            max_full_age=setting('FULL_MAX_AGE_DAYS', float, scale=24 * 3600),
+            max_estimate_ratio=setting('FULL_MAX_ESTIMATE_RATIO', float))
+        return policy if policy.enabled else None
+
+    @property
+    def enabled(self):
+        return any(value is not None for value in (
+            self.max_chain_length, self.max_incremental_ratio, self.max_full_age,
+            self.max_estimate_ratio))
+
+    def reason(self, chain_length, incremental_size, full_size, full_age=None,
+               estimates=None):
+        """Returns why a full backup is needed, or None to go on with incrementals.
+        chain_length and incremental_size describe the chain once the pending
+        incrementals are uploaded. The checks that cost requests or dry-run sends
+        are last and only done when configured: full_age() returns the age of the
+        full backup in seconds, estimates() a tuple of the estimated incremental
+        and full send sizes.
+        """
+        if self.max_chain_length is not None and chain_length > self.max_chain_length:
+            return "chain of {} incrementals is longer than {}".format(
+                chain_length, self.max_chain_length)
+        if self.max_incremental_ratio is not None and full_size:
+            ratio = float(incremental_size) / full_size
+            if ratio > self.max_incremental_ratio:
+                return "incrementals are {:.2f} times the size of the full backup".format(
+                    ratio)
+        if self.max_full_age is not None and full_age is not None:
+            age = full_age()
+            if age > self.max_full_age:
+                return "full backup is {:.1f} days old".format(age / (24 * 3600))
+        if self.max_estimate_ratio is not None and estimates is not None:
+            incremental_estimate, full_estimate = estimates()
+            if full_estimate and float(incremental_estimate) / full_estimate > \
+                    self.max_estimate_ratio:
+                return "incremental send is {:.2f} times the size of a full send".format(
+                    float(incremental_estimate) / full_estimate)
+        return None
@@ -4,10 +4,10 @@ usage
 pput bucket_name/filename
 """
 
-from queue import Queue
+from queue import Empty, Queue
 from io import BytesIO
 from collections import namedtuple
-from threading import Thread
+from threading import Lock, Thread
 import argparse
 import binascii
 import functools
@@ -16,6 +16,7 @@ import logging
 import json
 import os
 import sys
+import time
 
 import boto.s3.multipart
 
@@ -23,10 +24,14 @@ from z3.config import get_config
 
 
 Result = namedtuple('Result', ['success', 'traceback', 'index', 'md5'])
+Upload = namedtuple('Upload', ['name', 'etag', 'bytes'])
 CFG = get_config()
 VERB_QUIET = 0
 VERB_NORMAL = 1
 VERB_PROGRESS = 2
+MARKER_OK = 'ok'
+MARKER_FAILED = 'failed'
+MARKER_TIMEOUT = 24 * 3600  # seconds to wait for the upload of the parent
 
 
 def multipart_etag(digests):
@@ -47,19 +52,19 @@ def multipart_etag(digests):
 
 
 def parse_size(size):
+    """Parses sizes like 100M; zfs style fractions (1.50G) are rounded down to a byte"""
     if isinstance(size, int):
         return size
     size = size.strip().upper()
     last = size[-1]
-    if last == 'T':
-        return int(size[:-1]) * 1024 * 1024 * 1024 * 1024
-    if last == 'G':
-        return int(size[:-1]) * 1024 * 1024 * 1024
-    if last == 'M':
-        return int(size[:-1]) * 1024 * 1024
-    if last == 'K':
-        return int(size[:-1]) * 1024
-    return int(size)
+    units = {'T': 1024 ** 4, 'G': 1024 ** 3, 'M': 1024 ** 2, 'K': 1024}
+    if last in units:
+        number, unit = size[:-1], units[last]
+    else:
+        number, unit = size, 1
+    if '.' in number:
+        return int(float(number) * unit)
+    return int(number) * unit
 
 
 class StreamHandler(object):
@@ -125,8 +130,9 @@ class UploadWorker(object):
         return part.upload_part_from_file(
             BytesIO(chunk), index, replace=True).md5
 
-    def start(self):
-        self._thread = Thread(target=self.main_loop)
+    def start(self, pool=None):
+        target = self.main_loop if pool is None else functools.partial(self.serve, pool)
+        self._thread = Thread(target=target)
         self._thread.daemon = True
         self._thread.start()
         return self
@@ -146,6 +152,49 @@ class UploadWorker(object):
                 index=index,
             ))
 
+    def serve(self, pool):
+        """Uploads the parts of any upload of the pool. A failed part is reported to its
+        upload and the worker carries on with the next one, the other uploads still
+        need it.
+        """
+        while True:
+            multipart, outbox, index, chunk = self.inbox.get()
+            if pool.aborted(multipart):
+                continue
+            self.multipart = multipart
+            try:
+                md5 = self.upload_part(index, chunk)
+            except Exception as err:  # pylint: disable=broad-except
+                outbox.put(Result(success=False, md5=None, traceback=err, index=index))
+            else:
+                outbox.put(Result(success=True, md5=md5, traceback=None, index=index))
+
+
+class WorkerPool(object):
+    """Upload workers shared by all the uploads of a process, started once"""
+
+    def __init__(self, bucket, concurrency=4, worker_class=UploadWorker):
+        self.tasks = Queue(maxsize=concurrency)
+        self._aborted = set()  # ids of the multipart uploads that gave up
+        self._lock = Lock()
+        self.workers = [
+            worker_class(bucket=bucket, multipart=None, inbox=self.tasks, outbox=None).start(
+                pool=self)
+            for _ in range(concurrency)]
+
+    def submit(self, multipart, outbox, index, chunk):
+        """Blocks while all the workers are busy"""
+        self.tasks.put((multipart, outbox, index, chunk))
+
+    def abort(self, multipart):
+        """The parts of multipart still queued are dropped"""
+        with self._lock:
+            self._aborted.add(multipart.id)
+
+    def aborted(self, multipart):
+        with self._lock:
+            return multipart.id in self._aborted
+
 
 class UploadException(Exception):
     pass
@@ -154,10 +203,19 @@ class UploadException(Exception):
 class UploadSupervisor(object):
     '''Reads chunks and dispatches them to UploadWorkers'''
 
-    def __init__(self, stream_handler, name, bucket, headers=None, verbosity=1):
+    def __init__(self, stream_handler, name, bucket, headers=None, verbosity=1,
+                 complete_after=None, pool=None, stopped=None):
         self.stream_handler = stream_handler
         self.name = name
         self.bucket = bucket
+        # called once all parts are uploaded, the upload is only completed if it returns
+        # True; keeps an incremental backup invisible until the one it depends on is done
+        self.complete_after = complete_after
+        self.pool = pool  # a WorkerPool to use instead of starting workers
+        # returns True if whatever writes the stream was stopped, the end of the stream
+        # isn't the end of the data then and the upload is canceled
+        self.stopped = stopped
+        self.bytes = 0
         self.inbox = None
         self.outbox = None
         self.multipart = None
@@ -196,12 +254,21 @@ class UploadSupervisor(object):
         if len(self.results) == 0:
             self.multipart.cancel_upload()
             raise UploadException("Error: Can't upload zero bytes!")
+        if self.stopped is not None and self.stopped():
+            self.multipart.cancel_upload()
+            raise UploadException("Error: the stream of {} was cut short".format(self.name))
+        if self.complete_after is not None and not self.complete_after():
+            self.multipart.cancel_upload()
+            raise UploadException("Error: the upload {} depends on failed".format(self.name))
         return self.multipart.complete_upload()
 
-    def _handle_result(self):
-        """Process one result. Block untill one is available
+    def _handle_result(self, timeout=None):
+        """Process one result. Block untill one is available or for timeout seconds
         """
-        result = self.inbox.get()
+        try:
+            result = self.inbox.get(timeout=timeout)
+        except Empty:
+            return
         if result.success:
             if self._verbosity >= VERB_PROGRESS:
                 sys.stderr.write("\nuploaded chunk {} \n".format(result.index))
@@ -224,7 +291,11 @@ class UploadSupervisor(object):
         Blocks when the outbox is full.
         """
         self._pending_chunks += 1
-        self.outbox.put((index, chunk))
+        self.bytes += len(chunk)
+        if self.pool is not None:
+            self.pool.submit(self.multipart, self.inbox, index, chunk)
+        else:
+            self.outbox.put((index, chunk))
 
     def _check_workers(self):
         """Check workers are alive, raise exception if any is dead."""
@@ -233,25 +304,65 @@ class UploadSupervisor(object):
                 raise WorkerCrashed()
 
     def main_loop(self, concurrency=4, worker_class=UploadWorker):
+        """Uploads the stream, returns the etag; with a pool, concurrency and
+        worker_class are those of the pool
+        """
         chunk_index = 0
         self._begin_upload()
-        self._workers = self._start_workers(concurrency, worker_class=worker_class)
-        while self._pending_chunks or not self.stream_handler.finished:
-            self._check_workers()  # raise exception and stop everything if any worker has crashed
-            # print "main_loop p:{} o:{} i:{}".format(
-            #     self._pending_chunks, self.outbox.qsize(), self.inbox.qsize())
-            # consume results first as this is a quick operation
-            self._handle_results()
-            chunk = self.stream_handler.get_chunk()
-            if chunk:
-                # s3 multipart index is 1 based, increment before sending
-                chunk_index += 1
-                self._send_chunk(chunk_index, chunk)
-        self._finish_upload()
+        if self.pool is None:
+            self._workers = self._start_workers(concurrency, worker_class=worker_class)
+        else:
+            self.inbox = Queue()
+            self._workers = self.pool.workers
+        try:
+            while self._pending_chunks or not self.stream_handler.finished:
+                # raise exception and stop everything if any worker has crashed
+                self._check_workers()
+                # print "main_loop p:{} o:{} i:{}".format(
+                #     self._pending_chunks, self.outbox.qsize(), self.inbox.qsize())
+                # consume results first as this is a quick operation
+                self._handle_results()
+                if self.stream_handler.finished:
+                    # only results left, wait for them instead of spinning
+                    self._handle_result(timeout=0.1)
+                    continue
+                chunk = self.stream_handler.get_chunk()
+                if chunk:
+                    # s3 multipart index is 1 based, increment before sending
+                    chunk_index += 1
+                    self._send_chunk(chunk_index, chunk)
+            self._finish_upload()
+        except BaseException:
+            if self.pool is not None:
+                self.pool.abort(self.multipart)  # its queued parts would only waste the workers
+            raise
         self.results.sort()
         return multipart_etag(r[1] for r in self.results)
 
 
+def wait_for_marker(path, poll=0.5, timeout=MARKER_TIMEOUT):
+    """Waits for another upload to write its outcome to path.
+    Returns True if it succeeded, False if it failed or said nothing for timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() >= deadline:
+            logging.error("gave up waiting for %s after %ss", path, timeout)
+            return False
+        time.sleep(poll)
+    with open(path) as marker:
+        return marker.read().strip() == MARKER_OK
+
+
+def write_marker(path, success):
+    """Records the outcome of an upload for wait_for_marker; the rename makes sure
+    readers never see a partial file
+    """
+    with open(path + '.tmp', 'w') as marker:
+        marker.write(MARKER_OK if success else MARKER_FAILED)
+    os.rename(path + '.tmp', path)
+
+
 def parse_metadata(metadata):
     headers = {}
     for meta in metadata:
@@ -273,7 +384,7 @@ def optimize_chunksize(estimated):
     return int(min_part_size)
 
 
-def parse_args():
+def parse_args(args=None):
     parser = argparse.ArgumentParser(
         description='Read data from stdin and upload it to s3',
         epilog=('All optional args have a configurable default. '
@@ -307,6 +418,13 @@ def parse_args():
                         help='Metatada in key=value format')
     parser.add_argument('--storage-class', default=CFG['S3_STORAGE_CLASS'],
                         dest='storage_class', help='The S3 storage class. Defaults to STANDARD_IA.')
+    parser.add_argument('--complete-after', dest='complete_after', default=None,
+                        help=('upload the data but only complete the upload once this file '
+                              'says another upload succeeded; cancel it if that failed'))
+    parser.add_argument('--complete-after-timeout', dest='complete_after_timeout', type=float,
+                        default=MARKER_TIMEOUT,
+                        help=('seconds to wait for the file given to --complete-after, the '
+                              'upload is canceled after that'))
     quiet_group = parser.add_mutually_exclusive_group()
     quiet_group.add_argument('--progress',
                              dest='progress',
@@ -316,17 +434,77 @@ def parse_args():
                              dest='quiet',
                              action='store_true',
                              help=('don\'t emit any output at all'))
-    return parser.parse_args()
+    return parser.parse_args(args)
 
 
-def main():
-    args = parse_args()
-    input_fd = os.fdopen(args.file_descriptor, 'rb') if args.file_descriptor else sys.stdin.buffer
+def verbosity(args):
+    """0 totally silent, 1 default, 2 show progress"""
+    return 0 if args.quiet else 1 + int(args.progress)
+
+
+def make_supervisor(args, input_stream, bucket, pool=None, stopped=None):
+    """Returns the UploadSupervisor for the parsed command line and its chunk size"""
     if args.estimated is not None:
         chunk_size = optimize_chunksize(parse_size(args.estimated))
     else:
         chunk_size = parse_size(args.chunk_size)
-    stream_handler = StreamHandler(input_fd, chunk_size=chunk_size)
+    stream_handler = StreamHandler(input_stream, chunk_size=chunk_size)
+    headers = parse_metadata(args.metadata)
+    headers["x-amz-storage-class"] = args.storage_class
+    sup = UploadSupervisor(
+        stream_handler,
+        args.name,
+        bucket=bucket,
+        verbosity=verbosity(args),
+        headers=headers,
+        complete_after=(None if args.complete_after is None else
+                        functools.partial(wait_for_marker, args.complete_after,
+                                          timeout=args.complete_after_timeout)),
+        pool=pool,
+        stopped=stopped,
+    )
+    return sup, chunk_size
+
+
+class Uploader(object):
+    """Runs pput uploads in this process. A backup of many snapshots pays for starting
+    an interpreter, importing boto and connecting to S3 once, instead of once per
+    snapshot, and all its uploads share one pool of workers.
+    """
+
+    def __init__(self, bucket, concurrency=int(CFG['CONCURRENCY']), worker_class=UploadWorker):
+        self.bucket = bucket
+        self.concurrency = concurrency  # workers shared by all the uploads
+        self.worker_class = worker_class
+        self.uploads = []  # an Upload for every completed upload, for reporting
+        self._pool = None
+        self._lock = Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:  # started by the first upload, dry runs don't need it
+                self._pool = WorkerPool(self.bucket, concurrency=self.concurrency,
+                                        worker_class=self.worker_class)
+            return self._pool
+
+    def upload(self, argv, input_stream, stopped=None):
+        """Uploads input_stream as pput would with the arguments argv; --concurrency is
+        ignored, the pool is shared. Returns an Upload.
+        """
+        args = parse_args(argv)
+        sup, _ = make_supervisor(args, input_stream, self.bucket, pool=self.pool,
+                                 stopped=stopped)
+        etag = sup.main_loop()
+        upload = Upload(name=args.name, etag=etag, bytes=sup.bytes)
+        with self._lock:
+            self.uploads.append(upload)
+        return upload
+
+
+def main():
+    args = parse_args()
+    input_fd = os.fdopen(args.file_descriptor, 'rb') if args.file_descriptor else sys.stdin.buffer
 
     extra_config = {}
     if 'HOST' in CFG:
@@ -339,18 +517,8 @@ def main():
         bucket = boto.connect_s3(
             **extra_config).get_bucket(CFG['BUCKET'])
 
-    # verbosity: 0 totally silent, 1 default, 2 show progress
-    verbosity = 0 if args.quiet else 1 + int(args.progress)
-    headers = parse_metadata(args.metadata)
-    headers["x-amz-storage-class"] = args.storage_class
-    sup = UploadSupervisor(
-        stream_handler,
-        args.name,
-        bucket=bucket,
-        verbosity=verbosity,
-        headers=headers,
-    )
-    if verbosity >= VERB_NORMAL:
+    sup, chunk_size = make_supervisor(args, input_fd, bucket)
+    if verbosity(args) >= VERB_NORMAL:
         sys.stderr.write("starting upload to {}/{} with chunksize {}M using {} workers\n".format(
             CFG['BUCKET'], args.name, (chunk_size/(1024*1024.0)), args.concurrency))
     try:
@@ -358,7 +526,7 @@ def main():
     except UploadException as excp:
         sys.stderr.write("{}\n".format(excp))
         return 1
-    if verbosity >= VERB_NORMAL:
+    if verbosity(args) >= VERB_NORMAL:
         print(json.dumps({'status': 'success', 'etag': etag}))
 
 
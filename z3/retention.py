@@ -0,0 +1,155 @@
+"""Which backups to keep and deleting the others.
+
+Snapshots are kept by grandfather-father-son rules: the newest snapshot of each of the
+last N hours, days, weeks, months and years, plus the last N snapshots. Incrementals
+can't be restored without their parents, so the whole chain of a kept snapshot is kept,
+whatever its age.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+import re
+
+
+# the newest snapshot in each period is kept, periods are told apart by these formats
+PERIODS = (
+    ('hourly', '%Y-%m-%d %H'),
+    ('daily', '%Y-%m-%d'),
+    ('weekly', '%G-%V'),
+    ('monthly', '%Y-%m'),
+    ('yearly', '%Y'),
+)
+# zfs-auto-snap_daily-2016-05-01-0000, autosnap_2016-05-01_00:00:01_daily, zrepl_20160501_000000
+SNAPSHOT_TIME = re.compile(
+    r'(\d{4})-?(\d{2})-?(\d{2})(?:[-_T ]?(\d{2}):?(\d{2}))?')
+DELETE_BATCH = 1000  # the most keys a DeleteObjects request takes
+
+LATEST = 'latest'
+UNDATED = 'undated'
+
+
+def snapshot_time(name):
+    """Returns the time in a snapshot name, or None if it doesn't hold one"""
+    match = SNAPSHOT_TIME.search(name.split('@', 1)[-1])
+    if match is None:
+        return None
+    year, month, day, hour, minute = match.groups()
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour or 0),
+                                 int(minute or 0))
+    except ValueError:
+        return None
+
+
+class RetentionPolicy(object):
+    def __init__(self, last=0, hourly=0, daily=0, weekly=0, monthly=0, yearly=0):
+        self.last = last
+        self.counts = OrderedDict([
+            ('hourly', hourly), ('daily', daily), ('weekly', weekly), ('monthly', monthly),
+            ('yearly', yearly)])
+
+    @classmethod
+    def from_config(cls, cfg, section=None, **overrides):
+        """Reads the KEEP_* settings, keyword arguments that aren't None take precedence"""
+        counts = {}
+        for rule in ('last', 'hourly', 'daily', 'weekly', 'monthly', 'yearly'):
+            value = overrides.get(rule)
+            if value is None:
+                value = cfg.get('KEEP_' + rule.upper(), 0, section=section)
+            counts[rule] = int(value or 0)
+        return cls(**counts)
+
+    @property
+    def enabled(self):
+        return self.last > 0 or any(self.counts.values())
+
+    def retained(self, names):
+        """Returns an OrderedDict of snapshot name -> the rules that keep it, newest first.
+        Snapshots with no time in their name are always kept, so is the newest one,
+        the next incremental backup is built on it.
+        """
+        newest_first = sorted(names, reverse=True)  # snapshot names sort by time
+        times = dict((name, snapshot_time(name)) for name in newest_first)
+        kept = OrderedDict((name, []) for name in newest_first)
+        if newest_first:
+            kept[newest_first[0]].append(LATEST)
+        for name in newest_first[:self.last]:
+            kept[name].append('last')
+        for period, fmt in PERIODS:
+            count = self.counts[period]
+            seen = set()
+            for name in newest_first:
+                if times[name] is None:
+                    continue
+                period_key = times[name].strftime(fmt)
+                if period_key in seen:
+                    continue
+                if len(seen) == count:
+                    break
+                seen.add(period_key)
+                kept[name].append(period)
+        for name in newest_first:
+            if times[name] is None:
+                kept[name].append(UNDATED)
+        return OrderedDict((name, rules) for name, rules in kept.items() if rules)
+
+
+def prune_plan(s3_mgr, policy):
+    """Decides the fate of every object of a dataset.
+    Returns a list of (S3Snapshot, reason) to keep and a list of S3Snapshot to delete.
+    """
+    retained = policy.retained([s3_snap.name for s3_snap in s3_mgr.list()])
+    keep = OrderedDict()  # key -> (object, reason)
+    # oldest first, so a kept snapshot is reported by its rules rather than as the
+    # parent of a newer one, and walking a chain stops at the first object already kept
+    for name, rules in reversed(list(retained.items())):
+        # every object of a kept snapshot is kept, with the chain it's restored through
+        for s3_obj in s3_mgr.objects(name):
+            reason = ", ".join(rules)
+            while s3_obj is not None and s3_obj.key not in keep:
+                keep[s3_obj.key] = (s3_obj, reason)
+                if s3_obj.is_full or s3_obj.parent_name is None:
+                    break
+                reason = "parent of {}".format(s3_obj.name)
+                s3_obj = s3_mgr.get(s3_obj.parent_name)
+    delete = OrderedDict()  # the snapshots of a bundle share its key, deleted once
+    for s3_obj in s3_mgr.objects():
+        if s3_obj.key not in keep:
+            delete.setdefault(s3_obj.key, s3_obj)
+    return list(keep.values()), list(delete.values())
+
+
+def _delete_batch(bucket, batch):
+    try:
+        result = bucket.delete_keys(batch, quiet=False)
+    except Exception as err:  # pylint: disable=broad-except
+        # the other batches go on, the keys of this one are reported as not deleted
+        logging.error("failed to delete %s keys from %s: %s", len(batch), batch[0], err)
+        return [], [(key_name, str(err)) for key_name in batch]
+    errors = []
+    for error in result.errors:
+        logging.error("failed to delete %s: %s %s", error.key, error.code, error.message)
+        errors.append((error.key, "{} {}".format(error.code, error.message)))
+    return [entry.key for entry in result.deleted], errors
+
+
+def delete_keys(bucket, key_names, concurrency=4):
+    """Deletes keys with DeleteObjects, DELETE_BATCH keys per request and up to
+    `concurrency` requests in flight.
+    Returns the names of the deleted keys and a list of (key name, error) for the
+    keys that couldn't be deleted, including every key of a request that failed.
+    """
+    key_names = list(key_names)
+    batches = [key_names[start:start + DELETE_BATCH]
+               for start in range(0, len(key_names), DELETE_BATCH)]
+    if not batches:
+        return [], []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda batch: _delete_batch(bucket, batch), batches))
+    deleted, errors = [], []
+    for batch_deleted, batch_errors in results:
+        deleted.extend(batch_deleted)
+        errors.extend(batch_errors)
+    return deleted, errors
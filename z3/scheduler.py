@@ -0,0 +1,73 @@
+"""Run independent jobs concurrently, largest first.
+
+Used by the multi-dataset commands to drive many `zfs send`/`zfs recv`
+pipelines at once under a global concurrency limit.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+
+JobResult = namedtuple('JobResult', ['name', 'cost', 'success', 'error', 'duration'])
+
+
+class Job(object):
+    def __init__(self, name, cost, func):
+        self.name = name
+        self.cost = cost  # estimated bytes to move, used for ordering
+        self.func = func
+
+    def __repr__(self):
+        return "<Job {} [{}]>".format(self.name, self.cost)
+
+
+class Scheduler(object):
+    """Runs jobs on a bounded pool of threads.
+
+    Jobs are started in decreasing order of cost (longest processing time first),
+    which keeps the total wall clock time close to optimal when job sizes vary a lot:
+    the big jobs start early and the small ones fill in the gaps at the end.
+    """
+
+    def __init__(self, concurrency=4):
+        if concurrency < 1:
+            raise AssertionError("concurrency must be at least 1")
+        self.concurrency = concurrency
+        self.log = logging.getLogger('Scheduler')
+
+    @staticmethod
+    def order(jobs):
+        return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+    def _run_job(self, job):
+        started = time.time()
+        try:
+            job.func()
+        except Exception as err:  # pylint: disable=broad-except
+            # one failed dataset must not stop the others
+            self.log.error("%s failed: %s", job.name, err)
+            return JobResult(name=job.name, cost=job.cost, success=False, error=err,
+                             duration=time.time() - started)
+        return JobResult(name=job.name, cost=job.cost, success=True, error=None,
+                         duration=time.time() - started)
+
+    def run_levels(self, jobs, level):
+        """Runs the jobs of each level in turn, lowest first; a level only starts once
+        the one before it is done. Eg. a dataset can only be received once its parent
+        dataset exists. Returns the results of all jobs.
+        """
+        levels = {}
+        for job in jobs:
+            levels.setdefault(level(job), []).append(job)
+        results = []
+        for key in sorted(levels):
+            results.extend(self.run(levels[key]))
+        return results
+
+    def run(self, jobs):
+        """Runs all jobs and returns a list of JobResult, in the order they were started."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            # the pool picks up submitted work in FIFO order
+            return list(pool.map(self._run_job, self.order(jobs)))
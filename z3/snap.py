@@ -1,15 +1,44 @@
 import argparse
+import contextlib
+import fnmatch
 import functools
+import json
 import logging
-import operator
 import os
+import random
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import boto
-
+import boto.exception
+
+from z3 import agent
+from z3.cache import open_cache
+from z3.catalog import SnapshotCatalog
+from z3.compressors import (
+    AUTO, AUTO_CANDIDATES, CompressorError, CompressorRegistry, CompressorSelector)
+from z3 import health
+from z3 import fleet
 from z3.config import get_config
+from z3.estimate import SendSizeEstimator
+from z3 import layout
+from z3.inventory import InventoryError, open_inventory
+from z3.lease import Coordinator, LeaseError, LeaseStore
+from z3.pipeline import Pipeline, Progress, RateLimiter, Sink, split_pipeline
+from z3.planner import RestorePlanner
+from z3.policy import FullBackupPolicy
+from z3.pput import Uploader, parse_size, write_marker
+from z3 import retention
+from z3.scheduler import Job, Scheduler
+from z3.table import ALTERNATE_SEP, BUNDLE_SEP, NOT_AN_INT, SnapshotTable
 
 
 def cached(func):
@@ -26,17 +55,44 @@ def cached(func):
     return cacheing_wrapper
 
 
-COMPRESSORS = {
-    'pigz1': {
-        'compress': 'pigz -1 --blocksize 4096',
-        'decompress': 'pigz -d'},
-    'pigz4': {
-        'compress': 'pigz -4 --blocksize 4096',
-        'decompress': 'pigz -d'},
-    'gpg': {
-        'compress': 'gpg -e -r {}',
-        'decompress': 'gpg -d'},
+THROTTLED = (500, 503)  # InternalError and SlowDown, S3 wants us to back off
+
+
+def retry_throttled(times=6, delay=0.2):
+    """Retries S3 requests that got throttled, with exponential backoff and jitter"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*a, **kwa):
+            for attempt in range(1, times + 1):
+                try:
+                    return func(*a, **kwa)
+                except boto.exception.S3ResponseError as err:
+                    if err.status not in THROTTLED or attempt >= times:
+                        raise
+                    wait = delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                    logging.warning('S3 request throttled (%s), retrying in %.2fs',
+                                    err.status, wait)
+                    time.sleep(wait)
+        return wrapped
+    return decorator
+
+
+
+# zfs send flags that can be set per dataset with SEND_FLAGS
+SEND_FLAGS = {
+    '-L': 'large blocks',
+    '-c': 'compressed, blocks are sent as stored on disk',
+    '-e': 'embedded data',
+    '-w': 'raw, encrypted datasets are sent encrypted',
 }
+# the stream is already compressed, only gpg is worth running on it
+COMPRESSED_SEND_FLAGS = ('-c', '-w')
+# characters of the 'contains' metadata of a bundle, a longer catch-up is split in more
+# bundles; S3 allows 2KB of metadata per object
+BUNDLE_MAX_CONTAINS = 1024
+# zfs recv flags for streams sent with these flags
+# the key of a raw stream isn't loaded once received, so it can't be mounted
+RECV_FLAGS = {'-w': '-u'}
 
 
 class IntegrityError(Exception):
@@ -47,6 +103,20 @@ class SoftError(Exception):
     pass
 
 
+def parse_send_flags(value):
+    """Parses SEND_FLAGS, eg. '-L -c -e' or '-Lce'; returns a sorted tuple of flags"""
+    flags = set()
+    for token in (value or '').replace(',', ' ').split():
+        if not token.startswith('-') or token.startswith('--'):
+            raise SoftError('Invalid zfs send flags "{}"'.format(value))
+        flags.update('-' + letter for letter in token[1:])
+    unsupported = flags.difference(SEND_FLAGS)
+    if unsupported:
+        raise SoftError('Unsupported zfs send flags {}, only {} can be used'.format(
+            " ".join(sorted(unsupported)), " ".join(sorted(SEND_FLAGS))))
+    return tuple(sorted(flags))
+
+
 def handle_soft_errors(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -59,16 +129,19 @@ def handle_soft_errors(func):
 
 
 class S3Snapshot(object):
-    CYCLE = 'cycle detected'
-    MISSING_PARENT = 'missing parent'
-    PARENT_BROKEN = 'parent broken'
+    """A view of one object in the manager's SnapshotTable.
+    Views are made on demand and hold nothing but the row, so they're cheap to create
+    and to throw away; two views of the same object compare equal.
+    """
+    __slots__ = ('_mgr', '_row')
 
-    def __init__(self, name, metadata, manager, size):
-        self.name = name
-        self._metadata = metadata
+    CYCLE = health.CYCLE
+    MISSING_PARENT = health.MISSING_PARENT
+    PARENT_BROKEN = health.PARENT_BROKEN
+
+    def __init__(self, manager, row):
         self._mgr = manager
-        self._reason_broken = None
-        self.size = size
+        self._row = row
 
     def __repr__(self):
         if self.is_full:
@@ -76,149 +149,488 @@ class S3Snapshot(object):
         else:
             return "<Snapshot {} [{}]>".format(self.name, self.parent_name)
 
+    def __eq__(self, other):
+        return (isinstance(other, S3Snapshot) and
+                self._mgr is other._mgr and self._row == other._row)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._mgr), self._row))
+
+    @property
+    def name(self):
+        return self._mgr._table.name(self._row)
+
+    @property
+    def key(self):
+        """Key name relative to the manager's s3_prefix"""
+        return self._mgr._table.key(self._row)
+
+    @property
+    def size(self):
+        return self._mgr._table.size(self._row)
+
     @property
     def is_full(self):
-        # keep backwards compatibility for underscore metadata
-        return 'true' in [self._metadata.get('is_full'), self._metadata.get('isfull')]
+        return self._mgr._table.is_full(self._row)
 
     @property
     def parent(self):
-        parent_name = self._metadata.get('parent')
-        return self._mgr.get(parent_name)
+        return self._mgr.get(self.parent_name)
 
     @property
     def parent_name(self):
-        return self._metadata.get("parent")
+        return self._mgr._table.parent_name(self._row)
 
-    def _is_healthy(self, visited=frozenset()):
-        if self.is_full:
-            return True
-        if self in visited:
-            self._reason_broken = self.CYCLE
-            return False  # we ended up with a cycle, abort
-        if self.parent is None:
-            self._reason_broken = self.MISSING_PARENT
-            return False  # missing parent
-        if not self.parent._is_healthy(visited.union([self])):
-            if self.parent._reason_broken == self.CYCLE:
-                self._reason_broken = self.CYCLE
-            else:
-                self._reason_broken = self.PARENT_BROKEN
-            return False
-        return True
+    @property
+    def metadata(self):
+        """All the metadata of the object, read again from the catalog, the cache or S3"""
+        return self._mgr.metadata(self.key)
+
+    @property
+    def health(self):
+        return self._mgr.health(self)
 
     @property
-    @cached
     def is_healthy(self):
-        return self._is_healthy()
+        return self.health.reason is None
 
     @property
     def reason_broken(self):
-        if self.is_healthy:
-            return
-        return self._reason_broken
+        return self.health.reason
+
+    @property
+    def chain_depth(self):
+        """Number of incrementals back to the nearest full backup"""
+        return self.health.depth
+
+    @property
+    def chain_size(self):
+        """Bytes stored in S3 for the chain back to the nearest full backup"""
+        return self.health.chain_size
 
     @property
     def compressor(self):
-        return self._metadata.get('compressor')
+        return self._mgr._table.compressor(self._row)
+
+    @property
+    def bundle(self):
+        """The bundle whose stream holds this snapshot, None if it has an object of its own"""
+        row = self._mgr._table.bundle(self._row)
+        return None if row is None else S3Snapshot(self._mgr, row)
+
+    @property
+    def send_flags(self):
+        """The zfs send flags the stream was made with, besides -i and -R"""
+        return parse_send_flags(self.metadata.get('send_flags'))
 
     @property
     def uncompressed_size(self):
-        return self._metadata.get('size')
+        size = self._mgr._table.uncompressed_size(self._row)
+        if size == NOT_AN_INT:
+            return self.metadata.get('size')
+        return size
 
 
 class S3SnapshotManager(object):
-    def __init__(self, bucket, s3_prefix, snapshot_prefix):
+    def __init__(self, bucket, s3_prefix, snapshot_prefix, catalog=False, concurrency=16,
+                 cache=None, inventory=None, sharded=False):
         self.bucket = bucket
         self.s3_prefix = s3_prefix.rstrip('/') + '/'  # make sure we always have a trailing /
         self.snapshot_prefix = snapshot_prefix
+        # with the sharded layout new backups go under the dataset's shard and backups
+        # are read from both layouts, keys that haven't been migrated are still found
+        self.shard_prefix = None
+        self._listing_prefixes = [snapshot_prefix]
+        if sharded:
+            if '@' not in snapshot_prefix:
+                raise AssertionError("the sharded layout needs a dataset@ snapshot prefix")
+            self.shard_prefix = layout.shard_prefix(snapshot_prefix.split('@', 1)[0])
+            self._listing_prefixes.append(self.shard_prefix + snapshot_prefix)
+        self.concurrency = concurrency  # number of HEAD requests in flight
+        self.cache = cache  # z3.cache.MetadataCache, kept across runs
+        self.inventory = inventory  # z3.inventory.Inventory, lists keys instead of LIST
+        self.catalog = None
+        if catalog:
+            self.catalog = SnapshotCatalog(
+                bucket, self.s3_prefix, dataset=snapshot_prefix.split('@', 1)[0])
+
+    def _iter_keys(self, listing_prefix=None, marker=None):
+        """Yields (key name, etag) for every key under listing_prefix, or only for the
+        keys after marker. Defaults to all the keys of both layouts.
+        boto fetches the listing one page at a time, as it's consumed.
+        """
+        if listing_prefix is None:
+            for listing_prefix in self._listing_prefixes:
+                for key_name, etag in self._iter_keys(listing_prefix):
+                    yield key_name, etag
+            return
+        prefix = os.path.join(self.s3_prefix, listing_prefix)
+        strip_chars = len(self.s3_prefix)
+        if marker is None:
+            keys = self.bucket.list(prefix)
+        else:
+            keys = self.bucket.list(prefix, marker=self.s3_prefix + marker)
+        for key in keys:
+            yield key.key[strip_chars:], getattr(key, 'etag', None)
+
+    def _list_keys(self):
+        """Returns a dict of key name -> etag for every key under the snapshot prefix"""
+        return dict(self._iter_keys())
+
+    def _list_new_keys(self, listed, listing_prefixes=None):
+        """Adds the keys after the last one already in listed, for every layout.
+        Snapshot names sort by time, so these are the keys added since.
+        """
+        for listing_prefix in listing_prefixes or self._listing_prefixes:
+            known = [key_name for key_name in listed if key_name.startswith(listing_prefix)]
+            listed.update(self._iter_keys(listing_prefix, marker=max(known) if known else None))
+        return listed
+
+    def upload_key(self, key_name):
+        """Returns the name new backups of key_name are uploaded to, relative to s3_prefix"""
+        if self.shard_prefix is not None:
+            return self.shard_prefix + key_name
+        return key_name
+
+    @retry_throttled()
+    def _head(self, key_name):
+        """Returns the entry of a key, None if it doesn't exist (anymore)"""
+        key = self.bucket.get_key(self.s3_prefix + key_name)
+        if key is None:
+            return None
+        return {'metadata': key.metadata, 'size': key.size, 'etag': getattr(key, 'etag', None)}
+
+    def _fetch(self, key_names):
+        """HEADs keys using up to `concurrency` requests in flight.
+        key_names can be a generator, requests start as soon as names come in.
+        Keys deleted since they were listed are left out.
+        """
+        if self.concurrency <= 1:
+            entries = ((key_name, self._head(key_name)) for key_name in key_names)
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                futures = [(key_name, pool.submit(self._head, key_name))
+                           for key_name in key_names]
+                entries = [(key_name, future.result()) for key_name, future in futures]
+        return dict((key_name, entry) for key_name, entry in entries if entry is not None)
+
+    def _cached_listing(self):
+        """Lists keys with the help of the cache.
+        Snapshot names sort by time, so usually we only need to list the keys after the
+        last one we know about. Once in a while the whole prefix is listed to check etags
+        and to evict deleted keys.
+        """
+        listed = {}
+        for listing_prefix in self._listing_prefixes:
+            if self.cache.needs_validation(listing_prefix):
+                listed_here = dict(self._iter_keys(listing_prefix))
+                self.cache.validated(listing_prefix, listed_here)
+            else:
+                listed_here = self._list_new_keys(
+                    self.cache.etags(listing_prefix), listing_prefixes=[listing_prefix])
+            listed.update(listed_here)
+        return listed
+
+    def _inventory_listing(self):
+        """Lists keys from the inventory report, only the keys added since are LISTed"""
+        strip_chars = len(self.s3_prefix)
+        listed = {}
+        for listing_prefix in self._listing_prefixes:
+            listed.update(
+                (key_name[strip_chars:], etag) for key_name, etag in
+                self.inventory.keys(os.path.join(self.s3_prefix, listing_prefix)).items())
+        return self._list_new_keys(listed)
+
+    def _fetch_with_cache(self, listed, key_names):
+        """Reads metadata from the cache, keys that aren't cached or changed are fetched"""
+        key_names = list(key_names)
+        entries = dict(
+            (key_name, entry) for key_name, entry in self.cache.get(key_names).items()
+            if listed.get(key_name) is None or listed[key_name] == entry['etag'])
+        fetched = self._fetch(key_name for key_name in key_names if key_name not in entries)
+        self.cache.store(fetched)
+        entries.update(fetched)
+        return entries
+
+    def _load_records(self):
+        """Metadata of every key, from the cache and the catalog if enabled,
+        or one HEAD per key
+        """
+        if self.inventory is not None:
+            listed = self._inventory_listing()
+        elif self.cache is not None:
+            listed = self._cached_listing()
+        elif self.catalog is not None:
+            listed = self._list_keys()
+        else:
+            # start fetching metadata while the listing is still coming in
+            return self._fetch(key_name for key_name, _ in self._iter_keys())
+        if self.cache is None:
+            fetch = self._fetch
+        else:
+            fetch = functools.partial(self._fetch_with_cache, listed)
+        if self.catalog is None:
+            return fetch(listed)
+        return self.catalog.sync(listed, fetch, prefix=tuple(self._listing_prefixes))
+
+    def check_catalog(self):
+        """Returns whether the catalog exists and how it differs from the keys in S3"""
+        exists = self.catalog.load()
+        return exists, self.catalog.diff(self._list_keys(),
+                                         prefix=tuple(self._listing_prefixes))
+
+    def rebuild_catalog(self):
+        """Rewrites the catalog entries under the snapshot prefix from scratch"""
+        listed = self._list_keys()
+        self.catalog.load()
+        for key_name in list(self.catalog.entries):
+            if key_name.startswith(tuple(self._listing_prefixes)):
+                del self.catalog.entries[key_name]
+        self.catalog.entries.update(self._fetch(listed))
+        self.catalog.save()
+
+    def record_upload(self, key_name):
+        """Adds a freshly uploaded key to the catalog, the cache and the backups already
+        read in memory
+        """
+        loaded = '_table_cached_value' in self.__dict__
+        if self.catalog is None and self.cache is None and not loaded:
+            return
+        entry = self._head(key_name)
+        if entry is None:
+            return  # not there after all, it'll be found on the next listing
+        if loaded:
+            self._add_record(self._table, key_name, entry)
+            self.__dict__.pop('_health_cached_value', None)  # analyzed again on next use
+        if self.cache is not None:
+            self.cache.store({key_name: entry})
+        if self.catalog is not None:
+            self.catalog.load()  # pick up any change made since we've read it
+            self.catalog.add(key_name, entry)
+            self.catalog.save()
+
+    def record_deletes(self, key_names):
+        """Removes deleted keys from the catalog and the cache"""
+        if self.cache is not None:
+            self.cache.forget(key_names)
+        if self.catalog is not None:
+            self.catalog.load()
+            for key_name in key_names:
+                self.catalog.entries.pop(key_name, None)
+            self.catalog.save()
+
+    def missing(self, s3_objs):
+        """Returns the keys of s3_objs deleted by another host since they were cached and
+        forgets them, the backups are read again on next use. Between validations the
+        cache can't know of them, listing only after the last key doesn't show deletes.
+        """
+        if self.cache is None:
+            return []
+        gone = [s3_obj.key for s3_obj in s3_objs if self._head(s3_obj.key) is None]
+        if gone:
+            self.record_deletes(gone)
+            self.__dict__.pop('_table_cached_value', None)
+            self.__dict__.pop('_health_cached_value', None)
+        return gone
 
     @property
     @cached
-    def _snapshots(self):
-        prefix = os.path.join(self.s3_prefix, self.snapshot_prefix)
-        snapshots = {}
-        strip_chars = len(self.s3_prefix)
-        for key in self.bucket.list(prefix):
-            key = self.bucket.get_key(key.key)
-            name = key.key[strip_chars:]
-            snapshots[name] = S3Snapshot(name, metadata=key.metadata, manager=self, size=key.size)
-        return snapshots
+    def _table(self):
+        table = SnapshotTable()
+        records = self._load_records()
+        for key_name, record in records.items():
+            if (self.shard_prefix is not None and not key_name.startswith(self.shard_prefix)
+                    and self.shard_prefix + key_name in records):
+                continue  # a key that's being migrated, use the sharded copy
+            self._add_record(table, key_name, record)
+        return table
+
+    def _add_record(self, table, key_name, record):
+        key_prefix = ''
+        if self.shard_prefix is not None and key_name.startswith(self._listing_prefixes[1]):
+            key_prefix, key_name = self.shard_prefix, key_name[len(self.shard_prefix):]
+        table.add(key_name, record['metadata'], record['size'], key_prefix=key_prefix)
+
+    def metadata(self, key_name):
+        """Returns the metadata of a key; only a few fields are kept in memory"""
+        if self.catalog is not None and key_name in self.catalog.entries:
+            return self.catalog.entries[key_name]['metadata'] or {}
+        if self.cache is not None:
+            entry = self.cache.get([key_name]).get(key_name)
+            if entry is not None:
+                return entry['metadata'] or {}
+        entry = self._head(key_name)
+        return (entry['metadata'] if entry is not None else None) or {}
+
+    @property
+    @cached
+    def _health(self):
+        return self._table.analyze()
+
+    def health(self, s3_snap):
+        return self._table.health(self._health, s3_snap._row)
 
     def list(self):
-        return sorted(list(self._snapshots.values()), key=operator.attrgetter('name'))
+        return [S3Snapshot(self, row) for row in self._table.primary_rows()]
+
+    def objects(self, name=None):
+        """Returns every object holding a backup of snapshot `name`, or of all snapshots"""
+        return [S3Snapshot(self, row) for row in self._table.rows(name)]
 
     def get(self, name):
-        return self._snapshots.get(name)
+        row = self._table.lookup(name)
+        return None if row is None else S3Snapshot(self, row)
 
 
 class ZFSSnapshot(object):
-    def __init__(self, name, metadata, parent=None, manager=None):
+    def __init__(self, name, metadata, parent=None, manager=None, previous=None):
         self.name = name
+        self.metadata = metadata  # the zfs properties listed for it, eg. written
         self.parent = parent
+        # the snapshot right before this one, whatever its prefix; what written is relative to
+        self.previous = previous
 
     def __repr__(self):
         return "<Snapshot {} [{}]>".format(self.name, self.parent.name if self.parent else '')
 
 
+# listed for every snapshot, older listings may stop after written
+SNAPSHOT_PROPERTIES = ('name', 'used', 'refer', 'mountpoint', 'written', 'guid', 'compressratio')
+
+
+def zfs_list_command(datasets):
+    """Lists the snapshots of datasets, not of their children, oldest first and in bytes"""
+    return ['zfs', 'list', '-Hp', '-t', 'snapshot', '-d', '1', '-s', 'createtxg',
+            '-o', ','.join(SNAPSHOT_PROPERTIES)] + list(datasets)
+
+
+def stream_lines(argv):
+    """Yields the lines a command prints as they're printed.
+    zfs list fails for datasets that don't exist, they just have no snapshots here.
+    """
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=stderr,
+                                universal_newlines=True)
+        try:
+            for line in proc.stdout:
+                yield line.rstrip('\n')
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        stderr.seek(0)
+        errors = [line for line in stderr.read().splitlines() if line]
+    if returncode != 0 and not all('does not exist' in line for line in errors):
+        raise subprocess.CalledProcessError(returncode, argv, output="\n".join(errors))
+
+
+def read_head(argv, size):
+    """Returns the first size bytes argv writes to stdout and stops it"""
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    chunks, remaining = [], size
+    try:
+        while remaining > 0:
+            chunk = process.stdout.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+    finally:
+        process.kill()
+        process.stdout.close()
+        process.wait()
+    return b"".join(chunks)
+
+
+class SnapshotListing(object):
+    """The snapshots of many datasets from a single zfs list, shared by their managers
+    in runs that handle many datasets. Only the lines are kept until a manager parses them.
+    """
+    def __init__(self, datasets):
+        self.datasets = list(datasets)
+        self._lock = threading.Lock()
+        self._lines = None
+
+    def lines(self, fs_name):
+        if fs_name not in self.datasets:
+            return stream_lines(zfs_list_command([fs_name]))
+        with self._lock:
+            if self._lines is None:
+                self._lines = dict((dataset, []) for dataset in self.datasets)
+                for line in stream_lines(zfs_list_command(self.datasets)):
+                    self._lines[line.split('@', 1)[0]].append(line)
+        return self._lines[fs_name]
+
+
 class ZFSSnapshotManager(object):
-    def __init__(self, fs_name, snapshot_prefix):
+    PROPERTIES = SNAPSHOT_PROPERTIES
+
+    def __init__(self, fs_name, snapshot_prefix, listing=None):
         self._fs_name = fs_name
         self._snapshot_prefix = snapshot_prefix
+        self._listing = listing  # a SnapshotListing shared with other datasets
         self._sorted = None
 
+    def _list_command(self, datasets):
+        return zfs_list_command(datasets)
+
     def _list_snapshots(self):
         # This is overridden in tests
         # see FakeZFSManager
-        return subprocess.check_output(
-            ['zfs', 'list', '-Ht', 'snap', '-o',
-             'name,used,refer,mountpoint,written'], universal_newlines=True)
+        if self._listing is not None:
+            return self._listing.lines(self._fs_name)
+        return stream_lines(self._list_command([self._fs_name]))
+
+    def _parse_lines(self):
+        """Yields the properties of every listed snapshot, as the listing is read"""
+        lines = self._list_snapshots()
+        if isinstance(lines, str):  # a whole listing at once
+            lines = lines.splitlines()
+        try:
+            for line in lines:
+                if len(line) == 0:
+                    continue
+                yield dict(zip(self.PROPERTIES, line.split('\t')))
+        except OSError:
+            logging.error("unable to list local snapshots!")
 
     def _parse_snapshots(self):
-        """Returns all snapshots grouped by filesystem, a dict of OrderedDict's
+        """Returns all listed snapshots grouped by filesystem, a dict of OrderedDict's
         The order of snapshots matters when determining parents for incremental send,
         so it's preserved.
         Data is indexed by filesystem then for each filesystem we have an OrderedDict
         of snapshots.
         """
-        try:
-            snap = self._list_snapshots()
-        except OSError as err:
-            logging.error("unable to list local snapshots!")
-            return {}
         vols = {}
-        for line in snap.splitlines():
-            if len(line) == 0:
-                continue
-            name, used, refer, mountpoint, written = line.split('\t')
-            vol_name, snap_name = name.split('@', 1)
-            snapshots = vols.setdefault(vol_name, OrderedDict())
-            snapshots[snap_name] = {
-                'name': name,
-                'used': used,
-                'refer': refer,
-                'mountpoint': mountpoint,
-                'written': written,
-            }
+        for data in self._parse_lines():
+            vol_name, snap_name = data['name'].split('@', 1)
+            vols.setdefault(vol_name, OrderedDict())[snap_name] = data
         return vols
 
     def _build_snapshots(self, fs_name):
         snapshots = OrderedDict()
-        # for fs_name, fs_snaps in self._parse_snapshots().iteritems():
-        fs_snaps = self._parse_snapshots().get(fs_name, {})
         parent = None
-        for snap_name, data in fs_snaps.items():
+        previous = None
+        for data in self._parse_lines():
+            vol_name, snap_name = data['name'].split('@', 1)
+            if vol_name != fs_name:
+                continue
+            full_name = data['name']
             if not snap_name.startswith(self._snapshot_prefix):
+                previous = full_name
                 continue
-            full_name = '{}@{}'.format(fs_name, snap_name)
             zfs_snap = ZFSSnapshot(
                 full_name,
                 metadata=data,
                 parent=parent,
                 manager=self,
+                previous=previous,
             )
             snapshots[full_name] = zfs_snap
             parent = zfs_snap
+            previous = full_name
         return snapshots
 
     @property
@@ -241,8 +653,20 @@ class ZFSSnapshotManager(object):
     def get(self, name):
         return self._snapshots.get(name)
 
+    def refresh(self):
+        """Forgets the listed snapshots, they're listed again on next use"""
+        self.__dict__.pop('_snapshots_cached_value', None)
+
 
 class CommandExecutor(object):
+    def __init__(self, quiet=False, rate_limit=None, uploader=None):
+        self.quiet = quiet
+        self.rate_limit = rate_limit  # bytes per second
+        # shared by the pipelines run at the same time, the limit holds for all of them
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        # a z3.pput.Uploader that runs the pput of the pipelines in this process
+        self.uploader = uploader
+
     @staticmethod
     def shell(cmd, dry_run=False, capture=False):
         if dry_run:
@@ -255,28 +679,59 @@ class CommandExecutor(object):
                 return subprocess.check_call(
                     cmd, shell=True)
 
-    @property
-    @cached
-    def has_pv(self):
-        return subprocess.call(
-            ['which', 'pv'],
-            stderr=subprocess.STDOUT, stdout=subprocess.PIPE) == 0
-
-    def pipe(self, cmd1, cmd2, quiet=False, estimated_size=None, **kwa):
+    def run_pipeline(self, cmd, quiet=False, estimated_size=None):
+        """Runs the stages of cmd without a shell, raises a PipelineError if one fails"""
+        stages = split_pipeline(cmd)
+        if self.uploader is not None and stages[-1][0] == 'pput':
+            stages[-1] = Sink('pput', functools.partial(self.uploader.upload, stages[-1][1:]))
+        pipeline = Pipeline(
+            stages, limiter=self.rate_limiter,
+            progress=None if quiet else Progress(estimated_size))
+        pipeline.run()
+        logging.info("%s: %s", cmd, pipeline.summary())
+        if not quiet:
+            sys.stderr.write(pipeline.summary() + os.linesep)
+        return pipeline
+
+    def pipe(self, cmd1, cmd2, quiet=None, estimated_size=None, dry_run=False):
         """Executes commands"""
-        if self.has_pv and not quiet:
-            pv = "pv" if estimated_size is None else "pv --size {}".format(estimated_size)
-            return self.shell("{} | {}| {}".format(cmd1, pv, cmd2), **kwa)
-        else:
-            return self.shell("{} | {}".format(cmd1, cmd2), **kwa)
+        quiet = self.quiet if quiet is None else quiet
+        cmd = "{} | {}".format(cmd1, cmd2)
+        if dry_run:
+            return self.shell(cmd, dry_run=True)
+        return self.run_pipeline(cmd, quiet=quiet, estimated_size=estimated_size)
 
 
 class PairManager(object):
-    def __init__(self, s3_manager, zfs_manager, command_executor=None, compressor=None):
+    def __init__(self, s3_manager, zfs_manager, command_executor=None, compressor=None,
+                 plan_by=RestorePlanner.BYTES, full_policy=None, upload_concurrency=None,
+                 replicate=False, parallel_uploads=1, estimator=None, send_flags=(),
+                 compressors=None, selector=None, bundle=False, coordinator=None):
         self.s3_manager = s3_manager
         self.zfs_manager = zfs_manager
         self._cmd = command_executor or CommandExecutor()
-        self.compressor = compressor
+        self.compressor = compressor  # a name in compressors or auto
+        self.compressors = compressors or CompressorRegistry()
+        # picks the compressor of auto backups and learns the upload rate from every backup
+        self.selector = selector or CompressorSelector(
+            self.compressors, cache=s3_manager.cache, rate_limit=self._cmd.rate_limit)
+        self._picked = None  # the compressor the selector picked for auto
+        self._pick_lock = threading.Lock()
+        self.upload_concurrency = upload_concurrency  # pput worker threads, None for its default
+        # send the dataset and all its descendants as one replication stream (zfs send -R)
+        self.replicate = replicate
+        self.send_flags = tuple(send_flags)  # from SEND_FLAGS, like ('-L', '-c')
+        self.parallel_uploads = parallel_uploads  # incrementals sent at the same time
+        # send the missing incrementals as -I streams holding many snapshots each
+        self.bundle = bundle
+        # a z3.lease.Coordinator, to skip snapshots other runs are uploading and to share
+        # upload slots with the other hosts
+        self.coordinator = coordinator
+        self._record_lock = threading.Lock()
+        self.full_policy = full_policy  # a FullBackupPolicy, None to never switch to full
+        self.estimator = estimator or SendSizeEstimator(
+            self._measure_send, cache=s3_manager.cache, send_flags=self._send_flags)
+        self.planner = RestorePlanner(s3_manager, zfs_manager, metric=plan_by)
 
     def list(self):
         pairs = []
@@ -309,64 +764,267 @@ class PairManager(object):
             logging.error("failed to parse output '%s'", output)
             raise
 
+    def _measure_send(self, parent, z_snap):
+        """Size of a send from a dry run, parent is None for a full send"""
+        incremental = '' if parent is None else "-i '{}' ".format(parent.name)
+        return self._parse_estimated_size(self._cmd.shell(
+            "zfs send -nvP {}{}'{}'".format(self._send_flags, incremental, z_snap.name),
+            capture=True))
+
+    @property
+    def _stream_compressor(self):
+        """The compressor that's actually run, none on a compressed send unless it's gpg"""
+        if self.compressor != 'gpg' and set(self.send_flags).intersection(
+                COMPRESSED_SEND_FLAGS):
+            return None
+        if self.compressor == AUTO:
+            return self._auto_compressor()
+        return self.compressor
+
+    def _auto_compressor(self):
+        """Picks the compressor once, concurrent sends all use the same one"""
+        with self._pick_lock:
+            if self._picked is None:
+                self._picked = self.selector.choose(
+                    self.zfs_manager._fs_name, self._read_sample)
+                logging.info("compressing %s with %s", self.zfs_manager._fs_name, self._picked)
+        return None if self._picked == 'none' else self._picked
+
+    @contextlib.contextmanager
+    def _unsampled_pick(self):
+        """Lets auto use the cached pick or the first candidate without reading a sample,
+        and forgets it after, a real backup still makes its own pick
+        """
+        if self.compressor != AUTO or self._picked is not None:
+            yield
+            return
+        self._picked = self.selector.choose(self.zfs_manager._fs_name, read_sample=None)
+        try:
+            yield
+        finally:
+            self._picked = None
+
+    def _read_sample(self, size):
+        """The start of a full send of the latest snapshot"""
+        z_snap = self.zfs_manager.get_latest()
+        return read_head(
+            shlex.split("zfs send {}'{}'".format(self._send_flags, z_snap.name)), size)
+
+    def _observe(self, pipeline):
+        if isinstance(pipeline, Pipeline):
+            self.selector.observe(pipeline)
+
+    @staticmethod
+    def _uploaded_meta(meta, pipeline):
+        """Adds the etag and the bytes of an upload done in this process to meta"""
+        if isinstance(pipeline, Pipeline) and pipeline.stages[-1].sink is not None:
+            upload = pipeline.stages[-1].process.result
+            logging.info("uploaded %s: %s bytes, etag %s", upload.name, upload.bytes,
+                         upload.etag)
+            meta.update(etag=upload.etag, uploaded=upload.bytes)
+        return meta
+
+    def _get_compressor(self, name):
+        try:
+            return self.compressors.get(name)
+        except CompressorError as err:
+            raise SoftError(str(err))
+
     def _compress(self, cmd):
         """Adds the appropriate command to compress the zfs stream"""
-        compressor = COMPRESSORS.get(self.compressor)
+        compressor = self._get_compressor(self._stream_compressor)
         if compressor is None:
             return cmd
-        compress_cmd = compressor['compress']
-        return "{} | {}".format(compress_cmd, cmd)
+        return "{} | {}".format(compressor.compress, cmd)
 
     def _decompress(self, cmd, s3_snap):
         """Adds the appropriate command to decompress the zfs stream
         This is determined from the metadata of the s3_snap.
         """
-        compressor = COMPRESSORS.get(s3_snap.compressor)
+        compressor = self._get_compressor(s3_snap.compressor)
         if compressor is None:
             return cmd
-        decompress_cmd = compressor['decompress']
-        return "{} | {}".format(decompress_cmd, cmd)
+        return "{} | {}".format(compressor.decompress, cmd)
+
+    @property
+    def _send_flags(self):
+        flags = (('-R',) if self.replicate else ()) + self.send_flags
+        return "".join(flag + ' ' for flag in flags)
 
-    def _pput_cmd(self, estimated, s3_prefix, snap_name, parent=None):
+    def _pput_cmd(self, estimated, s3_prefix, snap_name, parent=None, complete_after=None,
+                  contains=None):
         meta = ['size={}'.format(estimated)]
         if parent is None:
             meta.append("isfull=true")
         else:
             meta.append("parent={}".format(parent))
-        if self.compressor is not None:
-            meta.append("compressor={}".format(self.compressor))
-        return "pput --quiet --estimated {estimated} {meta} {prefix}{name}".format(
-            estimated=estimated, prefix=s3_prefix, name=snap_name,
+        if contains:
+            meta.append("contains={}".format(BUNDLE_SEP.join(
+                name.split('@', 1)[1] for name in contains)))
+        if self._stream_compressor is not None:
+            meta.append("compressor={}".format(self._stream_compressor))
+        if self.replicate:
+            meta.append("replicate=true")
+        if self.send_flags:
+            meta.append("send_flags={}".format(",".join(self.send_flags)))
+        concurrency = ''
+        if self.upload_concurrency is not None:
+            concurrency = '--concurrency {} '.format(self.upload_concurrency)
+        if complete_after is not None:
+            concurrency += "--complete-after '{}' ".format(complete_after)
+        return "pput --quiet {concurrency}--estimated {estimated} {meta} {prefix}{name}".format(
+            concurrency=concurrency, estimated=estimated, prefix=s3_prefix, name=snap_name,
             meta=" ".join(("--meta " + m) for m in meta))
 
+    @contextlib.contextmanager
+    def _coordinated(self, key_names, dry_run=False):
+        """Claims the keys about to be uploaded, oldest first, and holds a fleet-wide
+        upload slot while they are. Yields the keys that can be uploaded, see z3.lease.
+        A dry run claims nothing and starts no send to pick the auto compressor.
+        """
+        if dry_run:
+            with self._unsampled_pick():
+                yield key_names
+            return
+        if self.coordinator is None:
+            yield key_names
+            return
+        with self.coordinator.claim(key_names) as claimed:
+            if not claimed:
+                yield claimed
+                return
+            try:
+                slot = self.coordinator.acquire_slot()
+            except LeaseError as err:
+                raise SoftError(str(err))
+            try:
+                yield claimed
+            finally:
+                self.coordinator.release_slot(slot)
+
     def backup_full(self, snap_name=None, dry_run=False):
         """Do a full backup of a snapshot. By default latest local snapshot"""
         z_snap = self._snapshot_to_backup(snap_name)
-        estimated_size = self._parse_estimated_size(
-            self._cmd.shell(
-                "zfs send -nvP '{}'".format(z_snap.name),
-                capture=True))
-        self._cmd.pipe(
-            "zfs send '{}'".format(z_snap.name),
+        with self._coordinated([self.s3_manager.upload_key(z_snap.name)], dry_run) as claimed:
+            if not claimed:
+                return []
+            return self._send_full(z_snap, dry_run)
+
+    def _send_full(self, z_snap, dry_run=False):
+        estimated_size = self.estimator.estimate(None, z_snap)
+        pipeline = self._cmd.pipe(
+            "zfs send {}'{}'".format(self._send_flags, z_snap.name),
             self._compress(
                 self._pput_cmd(
                     estimated=estimated_size,
                     s3_prefix=self.s3_manager.s3_prefix,
-                    snap_name=z_snap.name)
+                    snap_name=self.s3_manager.upload_key(z_snap.name))
             ),
             dry_run=dry_run,
             estimated_size=estimated_size,
         )
-        return [{'snap_name': z_snap.name, 'size': estimated_size}]
+        if not dry_run:
+            self._observe(pipeline)
+            self.s3_manager.record_upload(self.s3_manager.upload_key(z_snap.name))
+        meta = {'snap_name': z_snap.name, 'size': estimated_size}
+        return [self._uploaded_meta(meta, pipeline)]
 
     def backup_incremental(self, snap_name=None, dry_run=False):
         """Uploads named snapshot or latest, along with any other snapshots
         required for an incremental backup.
+        Does a full backup of the snapshot instead if the full_policy asks for one.
         """
         z_snap = self._snapshot_to_backup(snap_name)
+        base, to_upload = self._missing_chain(z_snap)
+        if to_upload and self.full_policy is not None:
+            reason = self._full_backup_reason(base, z_snap, to_upload)
+            if reason is not None:
+                logging.info("full backup of %s: %s", z_snap.name, reason)
+                uploaded_meta = self.backup_full(z_snap.name, dry_run=dry_run)
+                for meta in uploaded_meta:  # none if another run is uploading it
+                    meta['reason'] = reason
+                return uploaded_meta
+        to_upload.reverse()  # oldest first
+        with self._coordinated([self.s3_manager.upload_key(snap.name) for snap in to_upload],
+                               dry_run) as claimed:
+            return self._send_chain(to_upload[:len(claimed)], dry_run)
+
+    def _send_chain(self, to_upload, dry_run=False):
+        """Sends the missing incrementals, oldest first"""
+        uploaded_meta = []
+        # measured before the first upload starts, the dry runs can run side by side
+        sizes = self.estimator.estimate_many([(snap.parent, snap) for snap in to_upload])
+        if self.bundle and not self.replicate and len(to_upload) > 1:
+            for snapshots, estimated_size in self._bundles(to_upload, sizes):
+                uploaded_meta.append(self._send_incremental(
+                    snapshots[0].parent, snapshots[-1], dry_run=dry_run,
+                    estimated_size=estimated_size, contains=snapshots))
+            return uploaded_meta
+        if self.parallel_uploads > 1 and len(to_upload) > 1 and not dry_run:
+            return self._send_concurrently(to_upload, sizes)
+        for z_snap, estimated_size in zip(to_upload, sizes):
+            uploaded_meta.append(self._send_incremental(
+                z_snap.parent, z_snap, dry_run=dry_run, estimated_size=estimated_size))
+        return uploaded_meta
+
+    @staticmethod
+    def _bundles(snapshots, sizes):
+        """Splits a chain of incrementals, oldest first, in runs whose names fit in the
+        metadata of a bundle. Yields each run with the sum of its estimated sizes.
+        """
+        run, run_size, length = [], 0, 0
+        for z_snap, size in zip(snapshots, sizes):
+            name_length = len(z_snap.name.split('@', 1)[1]) + len(BUNDLE_SEP)
+            if run and length + name_length > BUNDLE_MAX_CONTAINS:
+                yield run, run_size
+                run, run_size, length = [], 0, 0
+            run.append(z_snap)
+            run_size += size
+            length += name_length
+        yield run, run_size
+
+    def _send_concurrently(self, snapshots, sizes):
+        """Sends a chain of incrementals, oldest first, up to parallel_uploads at a time.
+        The streams don't depend on each other, only their visibility does: pput uploads
+        the data right away but only completes an upload once the upload of its parent
+        has completed, and cancels it if that failed. An incremental never shows up in S3
+        before its parent. Parents are started first, so a waiting upload never keeps its
+        parent from running.
+        """
+        markers = tempfile.mkdtemp(prefix='z3-uploads-')
+
+        def marker(index):
+            return os.path.join(markers, str(index))
+
+        def send(index):
+            z_snap = snapshots[index]
+            sent = False
+            try:
+                meta = self._send_incremental(
+                    z_snap.parent, z_snap, complete_after=marker(index - 1) if index else None,
+                    estimated_size=sizes[index])
+                sent = True
+            finally:
+                # whatever happened, the upload of the child mustn't wait forever
+                write_marker(marker(index), success=sent)
+            return meta
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_uploads) as pool:
+                futures = [pool.submit(send, index) for index in range(len(snapshots))]
+                errors = [future.exception() for future in futures]
+        finally:
+            shutil.rmtree(markers, ignore_errors=True)
+        for error in errors:
+            if error is not None:
+                raise error  # the oldest failure, the ones after it were canceled
+        return [future.result() for future in futures]
+
+    def _missing_chain(self, z_snap):
+        """Returns the latest backed up ancestor of z_snap, None if there's none, and the
+        local snapshots missing from S3 since, newest first.
+        """
         to_upload = []
         current = z_snap
-        uploaded_meta = []
         while True:
             s3_snap = self.s3_manager.get(current.name)
             if s3_snap is not None:
@@ -376,65 +1034,171 @@ class PairManager(object):
                         "Broken snapshot detected {}, reason: '{}'".format(
                             s3_snap.name, s3_snap.reason_broken
                         ))
-                break
+                return s3_snap, to_upload
             to_upload.append(current)
             if current.parent is None:
-                break
+                return None, to_upload
             current = current.parent
-        for z_snap in reversed(to_upload):
-            estimated_size = self._parse_estimated_size(
-                self._cmd.shell(
-                    "zfs send -nvP -i '{}' '{}'".format(
-                        z_snap.parent.name, z_snap.name),
-                    capture=True))
-            self._cmd.pipe(
-                "zfs send -i '{}' '{}'".format(
-                    z_snap.parent.name, z_snap.name),
-                self._compress(
-                    self._pput_cmd(
-                        estimated=estimated_size,
-                        parent=z_snap.parent.name,
-                        s3_prefix=self.s3_manager.s3_prefix,
-                        snap_name=z_snap.name)
-                ),
-                dry_run=dry_run,
-                estimated_size=estimated_size,
-            )
-            uploaded_meta.append({'snap_name': z_snap.name, 'size': estimated_size})
-        return uploaded_meta
 
-    def restore(self, snap_name, dry_run=False, force=False):
-        current_snap = self.s3_manager.get(snap_name)
-        if current_snap is None:
+    def pending_size(self, full=False):
+        """Rough size of the next backup, from the written property of the local
+        snapshots it would upload (the referenced one for a full backup).
+        Used to order many backups, costs no dry-run send.
+        """
+        z_snap = self._snapshot_to_backup(None)
+        if full:
+            return parse_size(z_snap.metadata.get('refer') or '0')
+        _, to_upload = self._missing_chain(z_snap)
+        return self._written(to_upload)
+
+    @staticmethod
+    def _written(snapshots):
+        return sum(parse_size(snap.metadata.get('written') or '0') for snap in snapshots)
+
+    def _pending_size(self, full, to_upload):
+        """Rough size in S3 of the incrementals still to upload, in the unit of the objects
+        already there: their streams, sized from the zfs properties without any dry-run
+        send, shrunk as much as the compressor shrank the stream of the full backup.
+        """
+        streams = sum(
+            self.estimator.from_properties(z_snap.parent, z_snap) or self._written([z_snap])
+            for z_snap in to_upload)
+        if full.size and full.uncompressed_size:
+            return int(streams * float(full.size) / full.uncompressed_size)
+        return streams
+
+    def _full_backup_reason(self, base, z_snap, to_upload):
+        """Asks the full_policy whether z_snap should start a new chain.
+        base is the latest backed up ancestor of z_snap, to_upload the snapshots
+        missing between them.
+        """
+        if base is None:
+            return "no earlier backup to build on"
+        full = base
+        while not full.is_full:
+            full = full.parent
+
+        def full_age():
+            key = self.s3_manager.bucket.get_key(self.s3_manager.s3_prefix + full.key)
+            return time.time() - fleet.parse_last_modified(key.last_modified)
+
+        def estimates():
+            return tuple(self.estimator.estimate_many(
+                [(self.zfs_manager.get(base.name), z_snap), (None, z_snap)]))
+        return self.full_policy.reason(
+            chain_length=base.chain_depth + len(to_upload),
+            incremental_size=(base.chain_size - (full.size or 0) +
+                              self._pending_size(full, to_upload)),
+            full_size=full.size,
+            full_age=full_age,
+            estimates=estimates)
+
+    def _send_incremental(self, parent, z_snap, key=None, dry_run=False, complete_after=None,
+                          estimated_size=None, contains=None):
+        """Sends z_snap on top of parent; contains is the run of snapshots, oldest first
+        and ending with z_snap, of a bundle sent as one -I stream instead.
+        """
+        if estimated_size is None:
+            estimated_size = self.estimator.estimate(parent, z_snap)
+        pipeline = self._cmd.pipe(
+            "zfs send {}{} '{}' '{}'".format(
+                self._send_flags, '-I' if contains else '-i', parent.name, z_snap.name),
+            self._compress(
+                self._pput_cmd(
+                    estimated=estimated_size,
+                    parent=parent.name,
+                    s3_prefix=self.s3_manager.s3_prefix,
+                    snap_name=self.s3_manager.upload_key(key or z_snap.name),
+                    complete_after=complete_after,
+                    contains=[snap.name for snap in contains or ()])
+            ),
+            dry_run=dry_run,
+            estimated_size=estimated_size,
+        )
+        if not dry_run:
+            self._observe(pipeline)
+            with self._record_lock:  # the catalog is read, changed and written back
+                self.s3_manager.record_upload(self.s3_manager.upload_key(key or z_snap.name))
+        meta = {'snap_name': z_snap.name, 'size': estimated_size}
+        if contains:
+            meta['contains'] = [snap.name for snap in contains]
+        return self._uploaded_meta(meta, pipeline)
+
+    def backup_cumulative(self, snap_name=None, dry_run=False):
+        """Uploads named snapshot or latest as an incremental on top of the latest
+        full backup, so restoring it only needs the full backup and one delta.
+        If the snapshot is already backed up the delta is stored as an alternate object.
+        """
+        z_snap = self._snapshot_to_backup(snap_name)
+        base = z_snap.parent
+        while base is not None:
+            s3_snap = self.s3_manager.get(base.name)
+            if s3_snap is not None and s3_snap.is_full and s3_snap.is_healthy:
+                break
+            base = base.parent
+        if base is None:
+            raise SoftError(
+                'No full backup older than {} exists locally, run a full backup first.'.format(
+                    z_snap.name))
+        key = z_snap.name
+        if self.s3_manager.get(z_snap.name) is not None:
+            key = "{}{}{}".format(z_snap.name, ALTERNATE_SEP, base.name.split('@', 1)[1])
+        with self._coordinated([self.s3_manager.upload_key(key)], dry_run) as claimed:
+            if not claimed:
+                return []
+            return [self._send_incremental(base, z_snap, key=key, dry_run=dry_run)]
+
+    def restore_plan(self, snap_name):
+        """Returns the s3 objects that have to be received, in order, to bring
+        the local dataset to snap_name. The cheapest chain is chosen by the planner.
+        """
+        target = self.s3_manager.get(snap_name)
+        if target is None:
             raise Exception('no such snapshot "{}"'.format(snap_name))
-        to_restore = []
+        plan = self.planner.plan(snap_name)
+        if plan is None:
+            raise IntegrityError(
+                "Broken snapshot detected {}, reason: '{}'".format(
+                    target.name, target.reason_broken
+                ))
+        return plan
+
+    def _checked_restore_plan(self, snap_name):
+        """restore_plan, planned again without the objects found deleted since cached"""
         while True:
-            z_snap = self.zfs_manager.get(current_snap.name)
-            if z_snap is not None:
-                break
-            if not current_snap.is_healthy:
-                raise IntegrityError(
-                    "Broken snapshot detected {}, reason: '{}'".format(
-                        current_snap.name, current_snap.reason_broken
-                    ))
-            to_restore.append(current_snap)
-            if current_snap.is_full:
-                break
-            else:
-                current_snap = current_snap.parent
+            plan = self.restore_plan(snap_name)
+            gone = self.s3_manager.missing(plan)
+            if not gone:
+                return plan
+            logging.warning("%s deleted since cached, planning the restore of %s again",
+                            " ".join(gone), snap_name)
+            self.planner.reset()
+
+    def restore(self, snap_name, dry_run=False, force=False):
         force = '-F ' if force is True else ''
-        for s3_snap in reversed(to_restore):
+        for s3_snap in self._checked_restore_plan(snap_name):
+            target = s3_snap.name
+            metadata = s3_snap.metadata
+            if metadata.get('replicate') == 'true' or metadata.get('contains'):
+                # a replication stream is received into the dataset, children included,
+                # and so is a bundle, which creates all the snapshots it holds
+                target = s3_snap.name.split('@', 1)[0]
+            recv_flags = "".join(
+                RECV_FLAGS[flag] + ' ' for flag in s3_snap.send_flags if flag in RECV_FLAGS)
             self._cmd.pipe(
                 "z3_get {}".format(
-                    os.path.join(self.s3_manager.s3_prefix, s3_snap.name)),
+                    os.path.join(self.s3_manager.s3_prefix, s3_snap.key)),
                 self._decompress(
-                    cmd="zfs recv {force}{snap}".format(
-                        force=force, snap=s3_snap.name),
+                    cmd="zfs recv {force}{flags}{snap}".format(
+                        force=force, flags=recv_flags, snap=target),
                     s3_snap=s3_snap,
                 ),
                 dry_run=dry_run,
                 estimated_size=s3_snap.size,
             )
+            if s3_snap.bundle is not None:
+                # the bundle went on past the snapshot that was asked for
+                self._cmd.shell("zfs rollback -r '{}'".format(s3_snap.name), dry_run=dry_run)
 
 
 def _humanize(size):
@@ -449,42 +1213,101 @@ def _humanize(size):
     return "{} {}".format(size, units[unit_index])
 
 
+def _humanize_duration(seconds):
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "{}h{:02d}m".format(hours, minutes)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
 def _get_widths(widths, line):
     for index, value in enumerate(line):
         widths[index] = max(widths[index], len("{}".format(value)))
     return widths
 
 
-def _prepare_line(s3_snap, z_snap):
+def _prepare_restore_estimate(s3_snap, z_snap, planner, bandwidth):
+    if z_snap is not None:
+        return '-', '-'
+    estimate = planner.estimate(s3_snap.name)
+    if estimate is None:
+        return '', ''
+    restore_bytes, _ = estimate
+    return _humanize(restore_bytes), _humanize_duration(float(restore_bytes) / bandwidth)
+
+
+def _prepare_line(s3_snap, z_snap, planner, bandwidth):
     if s3_snap is None:
         snap_type = 'missing'
-        health = '-'
+        snap_health = '-'
         name = z_snap.name.split('@', 1)[1]
         parent_name = '-'
+        depth = '-'
         local_state = 'ok'
         size = ''
+        restore_size, restore_time = '-', '-'
     else:
         snap_type = 'full' if s3_snap.is_full else 'incremental'
-        health = s3_snap.reason_broken or 'ok'
+        snap_health = s3_snap.reason_broken or 'ok'
+        depth = s3_snap.chain_depth if s3_snap.chain_depth is not None else ''
         parent_name = '' if s3_snap.is_full else s3_snap.parent_name.split('@', 1)[1]
         name = s3_snap.name.split('@', 1)[1]
         local_state = 'ok' if z_snap is not None else 'missing'
         size = _humanize(s3_snap.uncompressed_size) if s3_snap.uncompressed_size is not None else ''
-    return (name, parent_name, snap_type, health, local_state, size)
+        restore_size, restore_time = _prepare_restore_estimate(
+            s3_snap, z_snap, planner, bandwidth)
+    return (name, parent_name, snap_type, snap_health, depth, local_state, size,
+            restore_size, restore_time)
+
 
+@functools.lru_cache(maxsize=None)
+def _inventory(bucket, location, s3_prefix):
+    """Opens an inventory report once, it's shared by all the datasets in a run"""
+    try:
+        return open_inventory(location, bucket, prefix=s3_prefix)
+    except InventoryError as err:
+        raise SoftError("Failed to read the inventory report: {}".format(err))
 
-def list_snapshots(bucket, s3_prefix, filesystem, snapshot_prefix):
+
+def _s3_manager(bucket, s3_prefix, snapshot_prefix):
+    cfg = get_config()
+    s3_prefix = s3_prefix.rstrip('/') + '/'
+    cache = None
+    if cfg.getboolean('METADATA_CACHE'):
+        cache = open_cache(
+            cfg.get('CACHE_DIR', '/var/cache/z3'), bucket.name, s3_prefix,
+            validate_every=float(cfg.get('CACHE_VALIDATE_HOURS', 24)) * 3600)
+    inventory = None
+    if cfg.get('INVENTORY'):
+        inventory = _inventory(bucket, cfg.get('INVENTORY'), s3_prefix)
+    fs_section = _fs_section(snapshot_prefix.split('@', 1)[0])
+    return S3SnapshotManager(bucket, s3_prefix=s3_prefix, snapshot_prefix=snapshot_prefix,
+                             catalog=cfg.getboolean('SNAPSHOT_CATALOG'),
+                             concurrency=int(cfg.get('METADATA_CONCURRENCY', 16)),
+                             cache=cache, inventory=inventory,
+                             sharded=cfg.getboolean('SHARDED_KEYS', section=fs_section))
+
+
+def list_snapshots(bucket, s3_prefix, filesystem, snapshot_prefix,
+                   plan_by=RestorePlanner.BYTES, restore_bandwidth='50M'):
     print("backup status for {}@{}* on {}/{}".format(
         filesystem, snapshot_prefix, bucket.name, s3_prefix))
     prefix = "{}@{}".format(filesystem, snapshot_prefix)
     pair_manager = PairManager(
-        S3SnapshotManager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix),
-        ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix))
-    header = ("NAME", "PARENT", "TYPE", "HEALTH", "LOCAL STATE", "SIZE")
+        _s3_manager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix),
+        ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix),
+        plan_by=plan_by)
+    bandwidth = parse_size(restore_bandwidth)
+    header = ("NAME", "PARENT", "TYPE", "HEALTH", "DEPTH", "LOCAL STATE", "SIZE",
+              "RESTORE SIZE", "RESTORE TIME")
     widths = [len(col) for col in header]
     listing = []
     for s3_snap, z_snap in pair_manager.list():
-        line = _prepare_line(s3_snap, z_snap)
+        line = _prepare_line(s3_snap, z_snap, pair_manager.planner, bandwidth)
         listing.append(line)
         widths = _get_widths(widths, line)
     fmt = " | ".join("{{:{w}}}".format(w=w) for w in widths)
@@ -493,33 +1316,600 @@ def list_snapshots(bucket, s3_prefix, filesystem, snapshot_prefix):
         print(fmt.format(*line))
 
 
-def do_backup(bucket, s3_prefix, filesystem, snapshot_prefix, full, snapshot, compressor, dry, parseable):
-    prefix = "{}@{}".format(filesystem, snapshot_prefix)
-    s3_mgr = S3SnapshotManager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix)
-    zfs_mgr = ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix)
-    pair_manager = PairManager(s3_mgr, zfs_mgr, compressor=compressor)
+def do_backup(bucket, s3_prefix, filesystem, snapshot_prefix, full, snapshot, compressor, dry,
+              parseable, cumulative=False, replicate=False, parallel_uploads=None,
+              send_flags=None, compressors=None, bundle=None, bwlimit=None):
+    """Backs up one dataset; compressor and the other settings left to None are read
+    from the config
+    """
+    rate_limit = parse_size(bwlimit) if bwlimit is not None else None
+    pair_manager = _dataset_pair_manager(
+        bucket, s3_prefix, filesystem, compressors or _compressors(),
+        _coordinator(bucket, s3_prefix), compressor=compressor,
+        command_executor=CommandExecutor(rate_limit=rate_limit, uploader=_uploader(bucket)),
+        replicate=replicate, parallel_uploads=parallel_uploads, send_flags=send_flags,
+        bundle=bundle, snapshot_prefix=snapshot_prefix)
     snap_name = "{}@{}".format(filesystem, snapshot) if snapshot else None
     if full is True:
         uploaded = pair_manager.backup_full(snap_name=snap_name, dry_run=dry)
+    elif cumulative is True:
+        uploaded = pair_manager.backup_cumulative(snap_name=snap_name, dry_run=dry)
     else:
         uploaded = pair_manager.backup_incremental(snap_name=snap_name, dry_run=dry)
     for meta in uploaded:
         if parseable:
             print("{snap_name}\x00{size}".format(**meta))
         else:
-            print("Successfuly backed up {}: {}.".format(
-                meta['snap_name'], _humanize(meta['size'])))
+            if meta.get('reason'):
+                print("Switched to a full backup, {}.".format(meta['reason']))
+            if len(meta.get('contains', ())) > 1:
+                print("Bundled {} snapshots up to {}.".format(
+                    len(meta['contains']), meta['snap_name']))
+            if 'etag' in meta:
+                print("Successfuly backed up {}: {}, etag {}.".format(
+                    meta['snap_name'], _humanize(meta['uploaded']), meta['etag']))
+            else:
+                print("Successfuly backed up {}: {}.".format(
+                    meta['snap_name'], _humanize(meta['size'])))
+
 
+def _uploader(bucket, concurrency=None):
+    """Runs the pput of the backups in this process, unless UPLOAD_IN_PROCESS is off"""
+    cfg = get_config()
+    if not cfg.getboolean('UPLOAD_IN_PROCESS', True):
+        return None
+    return Uploader(bucket, concurrency=concurrency or int(cfg.get('CONCURRENCY')))
+
+
+def _coordinator(bucket, s3_prefix):
+    """Coordinates the uploads with the other hosts if UPLOAD_CLAIMS or UPLOAD_SLOTS is set"""
+    cfg = get_config()
+    claims, slots = cfg.getboolean('UPLOAD_CLAIMS'), int(cfg.get('UPLOAD_SLOTS', 0))
+    if not claims and not slots:
+        return None
+    return Coordinator(
+        LeaseStore(bucket, s3_prefix, duration=float(cfg.get('LEASE_SECONDS', 900))),
+        claims=claims, slots=slots, slot_wait=float(cfg.get('UPLOAD_SLOT_WAIT', 3600)))
+
+
+def _compressors(gpg_recipient=None):
+    """The built-in compressors and those defined in the config"""
+    try:
+        return CompressorRegistry.from_config(get_config(), gpg_recipient=gpg_recipient)
+    except CompressorError as err:
+        raise SoftError(str(err))
+
+
+def _resolve_compressor(name, compressors):
+    """Returns the compressor to use, None for 'none'"""
+    if name is None or name.lower() == 'none':
+        return None
+    if name != AUTO and name not in compressors:
+        raise SoftError('Unknown compressor "{}", choose one of {}'.format(
+            name, ", ".join(['none', AUTO] + compressors.names())))
+    return name
+
+
+def _compressor_selector(compressors, cache, fs_section, rate_limit=None):
+    """Picks the compressor of the datasets set to auto, with their [fs:DATASET] settings"""
+    cfg = get_config()
+    candidates = tuple(cfg.get(
+        'AUTO_COMPRESSORS', " ".join(AUTO_CANDIDATES), section=fs_section).split())
+    if AUTO in candidates:
+        raise SoftError('AUTO_COMPRESSORS can only name compressors, not auto')
+    for name in candidates:
+        _resolve_compressor(name, compressors)
+    return CompressorSelector(
+        compressors, candidates=candidates, rate_limit=rate_limit, cache=cache,
+        bandwidth=parse_size(cfg.get('UPLOAD_BANDWIDTH', '10M')),
+        reevaluate_every=float(cfg.get('AUTO_COMPRESSOR_DAYS', 7, section=fs_section)) * 86400)
+
+
+def local_datasets():
+    """Names of all local zfs filesystems and volumes"""
+    return subprocess.check_output(
+        ['zfs', 'list', '-H', '-o', 'name', '-t', 'filesystem,volume'],
+        universal_newlines=True).split()
+
+
+def configured_datasets():
+    """Datasets that have a [fs:DATASET] section in the config"""
+    return [section[len('fs:'):] for section in get_config().sections()
+            if section.startswith('fs:')]
+
+
+def _fs_section(dataset):
+    """Returns the config section of a dataset; datasets without a [fs:DATASET] section
+    use the section of their closest ancestor that has one
+    """
+    sections = set(get_config().sections())
+    parts = dataset.split('/')
+    for end in range(len(parts), 0, -1):
+        section = "fs:{}".format('/'.join(parts[:end]))
+        if section in sections:
+            return section
+    return "fs:{}".format(dataset)
+
+
+def _dataset_pair_manager(bucket, s3_prefix, dataset, compressors, coordinator,
+                          compressor=None, command_executor=None, upload_concurrency=None,
+                          replicate=False, parallel_uploads=None, send_flags=None,
+                          bundle=None, snapshot_prefix=None, zfs_manager=ZFSSnapshotManager):
+    """The PairManager of a dataset, with the settings of its [fs:DATASET] section or of
+    its closest configured ancestor's; the arguments that aren't None override them
+    """
+    cfg = get_config()
+    fs_section = _fs_section(dataset)
+    if snapshot_prefix is None:
+        snapshot_prefix = cfg.get('SNAPSHOT_PREFIX', section=fs_section)
+    s3_mgr = _s3_manager(bucket, s3_prefix=s3_prefix,
+                         snapshot_prefix="{}@{}".format(dataset, snapshot_prefix))
+    return PairManager(
+        s3_mgr,
+        zfs_manager(fs_name=dataset, snapshot_prefix=snapshot_prefix),
+        command_executor=command_executor,
+        compressor=_resolve_compressor(
+            compressor or cfg.get('COMPRESSOR', section=fs_section), compressors),
+        compressors=compressors,
+        selector=_compressor_selector(
+            compressors, s3_mgr.cache, fs_section,
+            rate_limit=command_executor.rate_limit if command_executor else None),
+        full_policy=FullBackupPolicy.from_config(cfg, section=fs_section),
+        upload_concurrency=upload_concurrency, replicate=replicate,
+        parallel_uploads=(parallel_uploads if parallel_uploads is not None else
+                          int(cfg.get('PARALLEL_UPLOADS', 1, section=fs_section))),
+        send_flags=parse_send_flags(
+            send_flags if send_flags is not None else
+            cfg.get('SEND_FLAGS', section=fs_section)),
+        bundle=(bundle if bundle is not None else
+                cfg.getboolean('BUNDLE_CATCHUP', section=fs_section)),
+        coordinator=coordinator)
+
+
+def plan_backups(bucket, s3_prefix, datasets, full=False, dry=False, compressor=None,
+                 gpg_recipient=None, command_executor=None, upload_concurrency=None,
+                 replicate=False, parallel_uploads=None, send_flags=None, bundle=None,
+                 make_zfs_manager=ZFSSnapshotManager):
+    """Prepares the backup of every dataset, with its own [fs:DATASET] settings,
+    or those of its closest configured ancestor.
+    Returns a list of jobs, sized by the bytes they're likely to upload, a list of the
+    datasets that are already backed up and a dict of dataset -> reason for the
+    datasets that can't be backed up.
+    """
+    jobs, up_to_date, errors = [], [], {}
+    listing = SnapshotListing(datasets)
+    compressors = _compressors(gpg_recipient)
+    coordinator = _coordinator(bucket, s3_prefix)
+    for dataset in datasets:
+        pair_manager = _dataset_pair_manager(
+            bucket, s3_prefix, dataset, compressors, coordinator, compressor=compressor,
+            command_executor=command_executor, upload_concurrency=upload_concurrency,
+            replicate=replicate, parallel_uploads=parallel_uploads, send_flags=send_flags,
+            bundle=bundle, zfs_manager=functools.partial(make_zfs_manager, listing=listing))
+        try:
+            latest = pair_manager.zfs_manager.get_latest()
+            if not full and pair_manager.s3_manager.get(latest.name) is not None:
+                up_to_date.append(dataset)
+                continue
+            cost = pair_manager.pending_size(full=full)
+        except (SoftError, IntegrityError) as err:
+            errors[dataset] = str(err)
+            continue
+        backup = pair_manager.backup_full if full else pair_manager.backup_incremental
+        jobs.append(Job(name=dataset, cost=cost,
+                        func=functools.partial(backup, dry_run=dry)))
+    return jobs, up_to_date, errors
+
+
+def _with_descendants(datasets, candidates):
+    """Adds the descendants of datasets found among candidates"""
+    return sorted(set(datasets).union(
+        candidate for candidate in candidates
+        if any(candidate.startswith(dataset + '/') for dataset in datasets)))
+
+
+def backup_many(bucket, s3_prefix, patterns, full, compressor, gpg_recipient, dry,
+                concurrency, bwlimit, upload_concurrency, recursive=False, replicate=False,
+                parallel_uploads=None, send_flags=None, bundle=None):
+    """Backs up many datasets concurrently, the largest first.
+    patterns are matched against the local datasets, None means all the datasets
+    with a [fs:DATASET] section. The limits are global: the bandwidth and the upload
+    workers are shared between the datasets being backed up at the same time.
+    With recursive, the descendants of the datasets are backed up too, every one
+    as its own chain of objects.
+    """
+    if patterns:
+        datasets = _match_datasets(local_datasets(), patterns)
+    else:
+        datasets = configured_datasets()
+    if recursive:
+        datasets = _with_descendants(datasets, local_datasets())
+    if len(datasets) == 0:
+        raise SoftError('No datasets match {}'.format(" ".join(patterns or ['[fs:*]'])))
+    running = min(concurrency, len(datasets))
+    rate_limit = parse_size(bwlimit) if bwlimit is not None else None
+    # in this process, all the uploads share one pool of upload_concurrency workers
+    uploader = _uploader(bucket, upload_concurrency)
+    jobs, up_to_date, errors = plan_backups(
+        bucket, s3_prefix, datasets, full=full, dry=dry, compressor=compressor,
+        gpg_recipient=gpg_recipient,
+        command_executor=CommandExecutor(quiet=True, rate_limit=rate_limit, uploader=uploader),
+        upload_concurrency=max(1, upload_concurrency // running), replicate=replicate,
+        parallel_uploads=parallel_uploads, send_flags=send_flags, bundle=bundle)
+    for dataset in up_to_date:
+        print("{} is up to date".format(dataset))
+    for dataset, reason in sorted(errors.items()):
+        sys.stderr.write("Skipping {}: {}{}".format(dataset, reason, os.linesep))
+    results = Scheduler(concurrency=concurrency).run(jobs)
+    _print_run_summary(results)
+    if uploader is not None and uploader.uploads:
+        print("Uploaded {} objects, {}".format(
+            len(uploader.uploads), _humanize(sum(upload.bytes for upload in uploader.uploads))))
+    if errors or not all(result.success for result in results):
+        return 1
+
+
+def latest_snapshots(datasets):
+    """Returns dataset -> its latest snapshot with the SNAPSHOT_PREFIX of the dataset,
+    from one zfs list of the snapshot names of all the datasets
+    """
+    cfg = get_config()
+    prefixes = dict(
+        (dataset, "{}@{}".format(dataset, cfg.get('SNAPSHOT_PREFIX', section=_fs_section(dataset))))
+        for dataset in datasets)
+    latest = {}
+    argv = ['zfs', 'list', '-H', '-t', 'snapshot', '-d', '1', '-s', 'createtxg',
+            '-o', 'name'] + list(datasets)
+    for name in stream_lines(argv):
+        dataset = name.split('@', 1)[0]
+        if dataset in prefixes and name.startswith(prefixes[dataset]):
+            latest[dataset] = name  # sorted by creation, the last one wins
+    return latest
+
+
+class AgentBackups(object):
+    """Incremental backups of datasets for the agent, each call returns the uploaded
+    metadata. The manager of a dataset is kept for the life of the agent, so the backups
+    in S3 are only listed once: uploads are added to them as they complete. They're
+    listed again after a failed backup, S3 might have changed in ways we don't know of.
+    """
+    def __init__(self, bucket, s3_prefix, command_executor, upload_concurrency,
+                 make_pair_manager=_dataset_pair_manager):
+        self.bucket = bucket
+        self.s3_prefix = s3_prefix
+        self.command_executor = command_executor
+        self.upload_concurrency = upload_concurrency
+        self.make_pair_manager = make_pair_manager
+        self.compressors = _compressors()
+        self.coordinator = _coordinator(bucket, s3_prefix)
+        self._managers = {}  # dataset -> PairManager
+        self._lock = threading.Lock()
+
+    def _pair_manager(self, dataset):
+        with self._lock:
+            if dataset not in self._managers:
+                self._managers[dataset] = self.make_pair_manager(
+                    self.bucket, self.s3_prefix, dataset, self.compressors, self.coordinator,
+                    command_executor=self.command_executor,
+                    upload_concurrency=self.upload_concurrency)
+            return self._managers[dataset]
+
+    def __call__(self, dataset):
+        pair_manager = self._pair_manager(dataset)
+        pair_manager.zfs_manager.refresh()  # the local snapshots are listed every time
+        try:
+            return pair_manager.backup_incremental()
+        except Exception:
+            with self._lock:
+                self._managers.pop(dataset, None)
+            raise
 
-def restore(bucket, s3_prefix, filesystem, snapshot_prefix, snapshot, dry, force):
+
+def run_agent(bucket, s3_prefix, patterns, socket_path, interval, concurrency, bwlimit,
+              upload_concurrency, retry_delay=300):
+    """Backs up the datasets as soon as they have new snapshots, until SIGTERM.
+    patterns are matched against the local datasets, None means all the datasets with a
+    [fs:DATASET] section.
+    """
+    if patterns:
+        datasets = _match_datasets(local_datasets(), patterns)
+    else:
+        datasets = configured_datasets()
+    if len(datasets) == 0:
+        raise SoftError('No datasets match {}'.format(" ".join(patterns or ['[fs:*]'])))
+    rate_limit = parse_size(bwlimit) if bwlimit is not None else None
+    # kept for the life of the agent, every backup reuses the connections and the workers
+    command_executor = CommandExecutor(
+        quiet=True, rate_limit=rate_limit, uploader=_uploader(bucket, upload_concurrency))
+    the_agent = agent.Agent(
+        datasets, poll=functools.partial(latest_snapshots, datasets),
+        backup=AgentBackups(
+            bucket, s3_prefix, command_executor,
+            max(1, upload_concurrency // min(concurrency, len(datasets)))),
+        interval=interval, concurrency=concurrency, retry_delay=retry_delay)
+    try:
+        server = agent.StatusServer(socket_path, the_agent).start()
+    except agent.AgentRunning as err:
+        raise SoftError(str(err))
+    except OSError as err:
+        raise SoftError("Can't listen on {}: {}".format(socket_path, err))
+    signal.signal(signal.SIGTERM, lambda signum, frame: the_agent.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: the_agent.stop())
+    logging.info("backing up %s every %ss, status on %s", " ".join(datasets), interval,
+                 socket_path)
+    try:
+        the_agent.run()
+    finally:
+        server.close()
+
+
+def agent_status(socket_path):
+    try:
+        status = agent.read_status(socket_path)
+    except (OSError, ValueError) as err:
+        raise SoftError("No agent answered on {}: {}".format(socket_path, err))
+    print(json.dumps(status, indent=2, sort_keys=True))
+
+
+def restore(bucket, s3_prefix, filesystem, snapshot_prefix, snapshot, dry, force,
+            plan_by=RestorePlanner.BYTES):
     prefix = "{}@{}".format(filesystem, snapshot_prefix)
-    s3_mgr = S3SnapshotManager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix)
+    s3_mgr = _s3_manager(bucket, s3_prefix=s3_prefix, snapshot_prefix=prefix)
     zfs_mgr = ZFSSnapshotManager(fs_name=filesystem, snapshot_prefix=snapshot_prefix)
-    pair_manager = PairManager(s3_mgr, zfs_mgr)
+    pair_manager = PairManager(s3_mgr, zfs_mgr, plan_by=plan_by, compressors=_compressors())
     snap_name = "{}@{}".format(filesystem, snapshot)
     pair_manager.restore(snap_name, dry_run=dry, force=force)
 
 
+def sync_catalog(bucket, s3_prefix, filesystem, check=False, rebuild=False):
+    cfg = get_config()
+    s3_mgr = S3SnapshotManager(
+        bucket, s3_prefix=s3_prefix, snapshot_prefix="{}@".format(filesystem), catalog=True,
+        concurrency=int(cfg.get('METADATA_CONCURRENCY', 16)),
+        sharded=cfg.getboolean('SHARDED_KEYS', section=_fs_section(filesystem)))
+    if check:
+        exists, diff = s3_mgr.check_catalog()
+        if not exists:
+            print("catalog {} doesn't exist".format(s3_mgr.catalog.key_name))
+            return 1
+        for state in ('missing', 'changed', 'stale'):
+            for key_name in diff[state]:
+                print("{:7} | {}".format(state, key_name))
+        if any(diff.values()):
+            return 1
+        print("catalog {} is up to date".format(s3_mgr.catalog.key_name))
+        return
+    if rebuild:
+        s3_mgr.rebuild_catalog()
+    else:
+        s3_mgr.list()  # fixes the catalog as needed
+    print("catalog {} holds {} backups".format(
+        s3_mgr.catalog.key_name, len(s3_mgr.catalog.entries)))
+
+
+def list_s3_datasets(bucket, s3_prefix):
+    """Returns the names of all datasets that have backups under s3_prefix"""
+    return fleet.discover_datasets(bucket, s3_prefix)
+
+
+def _match_datasets(datasets, patterns):
+    return [dataset for dataset in datasets
+            if any(fnmatch.fnmatchcase(dataset, pattern) for pattern in patterns)]
+
+
+def _pick_restore_target(s3_mgr, dataset, snapshot=None, until=None):
+    """Returns the snapshot named `snapshot` or the latest healthy one
+    not newer than `until` (snapshot names sort by time).
+    """
+    if snapshot is not None:
+        return s3_mgr.get("{}@{}".format(dataset, snapshot))
+    candidates = [
+        s3_snap for s3_snap in s3_mgr.list()
+        if s3_snap.is_healthy and (until is None or s3_snap.name.split('@', 1)[1] <= until)]
+    return candidates[-1] if candidates else None
+
+
+def plan_restores(bucket, s3_prefix, datasets, snapshot_prefix=None, snapshot=None, until=None,
+                  dry=False, force=False, command_executor=None, plan_by=RestorePlanner.BYTES):
+    """Plans the restore chain of every dataset up front.
+    Returns a list of jobs, sized by the bytes they download, and a dict of
+    dataset -> reason for the datasets that can't be restored.
+    """
+    cfg = get_config()
+    jobs, errors = [], {}
+    listing = SnapshotListing(datasets)
+    compressors = _compressors()
+    for dataset in datasets:
+        prefix = snapshot_prefix or cfg.get('SNAPSHOT_PREFIX', section=_fs_section(dataset))
+        pair_manager = PairManager(
+            _s3_manager(bucket, s3_prefix=s3_prefix,
+                        snapshot_prefix="{}@{}".format(dataset, prefix)),
+            ZFSSnapshotManager(fs_name=dataset, snapshot_prefix=prefix, listing=listing),
+            command_executor=command_executor, plan_by=plan_by, compressors=compressors)
+        target = _pick_restore_target(
+            pair_manager.s3_manager, dataset, snapshot=snapshot, until=until)
+        if target is None:
+            errors[dataset] = 'no snapshot to restore'
+            continue
+        try:
+            plan = pair_manager.restore_plan(target.name)
+        except IntegrityError as err:
+            errors[dataset] = str(err)
+            continue
+        jobs.append(Job(
+            name=target.name,
+            cost=sum(s3_snap.size or 0 for s3_snap in plan),
+            func=functools.partial(pair_manager.restore, target.name, dry_run=dry, force=force),
+        ))
+    return jobs, errors
+
+
+def _print_run_summary(results):
+    header = ("NAME", "STATUS", "SIZE", "DURATION")
+    widths = [len(col) for col in header]
+    listing = []
+    for result in results:
+        line = (result.name,
+                'ok' if result.success else 'failed: {}'.format(result.error),
+                _humanize(result.cost),
+                "{:.0f}s".format(result.duration))
+        listing.append(line)
+        widths = _get_widths(widths, line)
+    fmt = " | ".join("{{:{w}}}".format(w=w) for w in widths)
+    print(fmt.format(*header))
+    for line in listing:
+        print(fmt.format(*line))
+
+
+def restore_many(bucket, s3_prefix, patterns, snapshot_prefix, snapshot, until, dry, force,
+                 concurrency, bwlimit, plan_by=RestorePlanner.BYTES, recursive=False):
+    """Restores many datasets concurrently, the largest first.
+    A dataset is only received once its ancestors are, so datasets are restored one
+    level of the hierarchy at a time. With recursive, the descendants of the matching
+    datasets are restored too.
+    """
+    backed_up = list_s3_datasets(bucket, s3_prefix)
+    datasets = _match_datasets(backed_up, patterns)
+    if recursive:
+        datasets = _with_descendants(datasets, backed_up)
+    if len(datasets) == 0:
+        raise SoftError('No backed up datasets match {}'.format(" ".join(patterns)))
+    rate_limit = parse_size(bwlimit) if bwlimit is not None else None
+    jobs, errors = plan_restores(
+        bucket, s3_prefix, datasets, snapshot_prefix=snapshot_prefix, snapshot=snapshot,
+        until=until, dry=dry, force=force, plan_by=plan_by,
+        command_executor=CommandExecutor(quiet=True, rate_limit=rate_limit))
+    for dataset, reason in sorted(errors.items()):
+        sys.stderr.write("Skipping {}: {}{}".format(dataset, reason, os.linesep))
+    results = Scheduler(concurrency=concurrency).run_levels(
+        jobs, level=lambda job: job.name.split('@', 1)[0].count('/'))
+    _print_run_summary(results)
+    if errors or not all(result.success for result in results):
+        return 1
+
+
+def migrate_layout(bucket, s3_prefix, patterns=None, dry=False, delete=False, concurrency=16):
+    """Copies the backups of the matching datasets to the sharded key layout.
+    The copies are made server side, many at a time.
+    """
+    datasets = list_s3_datasets(bucket, s3_prefix)
+    if patterns:
+        datasets = _match_datasets(datasets, patterns)
+    jobs = []
+    for dataset in datasets:
+        jobs.extend(layout.migration_jobs(bucket, s3_prefix, dataset, delete=delete))
+    if dry:
+        for job in Scheduler.order(jobs):
+            print("{} | {}".format(job.name, _humanize(job.cost)))
+        print("would migrate {} keys, {}".format(
+            len(jobs), _humanize(sum(job.cost for job in jobs))))
+        return
+    results = Scheduler(concurrency=concurrency).run(jobs)
+    _print_run_summary(results)
+    if not all(result.success for result in results):
+        return 1
+
+
+def prune(bucket, s3_prefix, datasets, snapshot_prefix=None, dry=False, concurrency=4,
+          keep=None):
+    """Deletes the backups the retention rules don't keep, along with their chains.
+    keep holds KEEP_* overrides, eg. {'daily': 7}; the rest are read per dataset
+    from the config.
+    """
+    cfg = get_config()
+    plans = []
+    for dataset in datasets:
+        fs_section = _fs_section(dataset)
+        policy = retention.RetentionPolicy.from_config(cfg, section=fs_section, **(keep or {}))
+        if not policy.enabled:
+            raise SoftError('No retention rules for {}, set KEEP_LAST, KEEP_DAILY, ...'.format(
+                dataset))
+        prefix = snapshot_prefix or cfg.get('SNAPSHOT_PREFIX', section=fs_section)
+        s3_mgr = _s3_manager(bucket, s3_prefix=s3_prefix,
+                             snapshot_prefix="{}@{}".format(dataset, prefix))
+        plans.append((s3_mgr, retention.prune_plan(s3_mgr, policy)))
+    header = ("NAME", "ACTION", "REASON", "SIZE")
+    widths = [len(col) for col in header]
+    listing = []
+    for s3_mgr, (keep_objs, delete_objs) in plans:
+        for s3_obj, reason in keep_objs:
+            listing.append((s3_obj.key, 'keep', reason, _humanize(s3_obj.size or 0)))
+        for s3_obj in delete_objs:
+            listing.append((s3_obj.key, 'delete', '', _humanize(s3_obj.size or 0)))
+    for line in listing:
+        widths = _get_widths(widths, line)
+    fmt = " | ".join("{{:{w}}}".format(w=w) for w in widths)
+    print(fmt.format(*header))
+    for line in sorted(listing):
+        print(fmt.format(*line))
+    if dry:
+        print("would delete {} objects, reclaiming {}".format(
+            sum(len(delete_objs) for _, (_, delete_objs) in plans),
+            _humanize(sum(s3_obj.size or 0
+                          for _, (_, delete_objs) in plans for s3_obj in delete_objs))))
+        return
+    # the keys of all datasets are deleted together, batches are filled up
+    deleted, errors = retention.delete_keys(
+        bucket, [s3_mgr.s3_prefix + s3_obj.key
+                 for s3_mgr, (_, delete_objs) in plans for s3_obj in delete_objs],
+        concurrency=concurrency)
+    deleted = set(deleted)
+    for s3_mgr, (_, delete_objs) in plans:
+        s3_mgr.record_deletes([s3_obj.key for s3_obj in delete_objs
+                               if s3_mgr.s3_prefix + s3_obj.key in deleted])
+    print("deleted {} objects, reclaimed {}".format(
+        len(deleted),
+        _humanize(sum(s3_obj.size or 0 for s3_mgr, (_, delete_objs) in plans
+                      for s3_obj in delete_objs if s3_mgr.s3_prefix + s3_obj.key in deleted))))
+    if errors:
+        for key_name, error in errors:
+            sys.stderr.write("Failed to delete {}: {}{}".format(key_name, error, os.linesep))
+        return 1
+
+
+def _max_backup_age(dataset, max_age_hours=None):
+    if max_age_hours is None:
+        max_age_hours = get_config().get(
+            'MAX_BACKUP_AGE_HOURS', 26, section=_fs_section(dataset))
+    return float(max_age_hours) * 3600
+
+
+def fleet_status(bucket, s3_prefix, patterns=None, max_age_hours=None, concurrency=4,
+                 as_json=False, now=None):
+    """Prints the state of the backups of every dataset under s3_prefix.
+    Returns 1 if any dataset needs attention, so it can be used as a monitoring check.
+    """
+    datasets = list_s3_datasets(bucket, s3_prefix)
+    if patterns:
+        datasets = _match_datasets(datasets, patterns)
+    statuses = fleet.fleet_status(
+        datasets,
+        make_manager=lambda dataset: _s3_manager(
+            bucket, s3_prefix=s3_prefix, snapshot_prefix="{}@".format(dataset)),
+        max_age=lambda dataset: _max_backup_age(dataset, max_age_hours),
+        now=time.time() if now is None else now,
+        concurrency=concurrency)
+    if as_json:
+        print(json.dumps([status._asdict() for status in statuses], indent=2, sort_keys=True))
+    else:
+        header = ("DATASET", "SNAPSHOTS", "LATEST", "AGE", "CHAIN", "BROKEN", "STATUS")
+        widths = [len(col) for col in header]
+        listing = []
+        for status in statuses:
+            line = tuple('' if value is None else value for value in (
+                status.dataset, status.snapshots, status.latest,
+                None if status.latest_age is None else _humanize_duration(status.latest_age),
+                status.chain_length, status.broken, status.error or status.status))
+            listing.append(line)
+            widths = _get_widths(widths, line)
+        fmt = " | ".join("{{:{w}}}".format(w=w) for w in widths)
+        print(fmt.format(*header))
+        for line in listing:
+            print(fmt.format(*line))
+    if not statuses or any(status.status != fleet.OK for status in statuses):
+        return 1
+
+
 def parse_args():
     cfg = get_config()
     parser = argparse.ArgumentParser(
@@ -538,6 +1928,12 @@ def parse_args():
                         default=None,
                         help=('Only operate on snapshots that start with this prefix. '
                               'Defaults to zfs-auto-snap:daily.'))
+    parser.add_argument('--plan-by',
+                        dest='plan_by',
+                        default=cfg.get('RESTORE_PLAN_BY', RestorePlanner.BYTES),
+                        choices=RestorePlanner.METRICS,
+                        help=('Restore through the chain that downloads the fewest bytes '
+                              'or applies the fewest streams. Defaults to bytes.'))
     subparsers = parser.add_subparsers(help='sub-command help', dest='subcommand')
 
     backup_parser = subparsers.add_parser(
@@ -547,22 +1943,61 @@ def parse_args():
     backup_parser.add_argument('--dry-run', dest='dry', default=False, action='store_true',
                                help='Dry run.')
     backup_parser.add_argument('--compressor', dest='compressor', default=None,
-                               choices=(['none'] + sorted(COMPRESSORS.keys())),
-                               help=('Specify the compressor. Defaults to pigz1. '
-                                     'Use "none" to disable.'))
+                               help=('Specify the compressor: none, auto, {} or one defined '
+                                     'in a [compressor:NAME] section. auto picks one by '
+                                     'compressing a sample. Defaults to COMPRESSOR.'.format(
+                                         ", ".join(CompressorRegistry().names()))))
     backup_parser.add_argument('--gpg-recipient',
                                dest='gpg_recipient',
                                default=cfg.get('GPG_RECIPIENT', 'z3_backup'),
                                help=('The gpg public key to use for encryption.'
                                      ' Defaults to z3_backup.'))
     backup_parser.add_argument('--parseable', dest='parseable', action='store_true',
-                               help='Machine readable output')
+                               help='Machine readable output, for a single dataset')
+    backup_parser.add_argument('--send-flags', dest='send_flags', default=None,
+                               help=('zfs send flags, any of {}. Defaults to SEND_FLAGS. '
+                                     'The compressor is skipped for -c and -w, unless '
+                                     'it is gpg.'.format(" ".join(sorted(SEND_FLAGS)))))
+    backup_parser.add_argument('--parallel-uploads', dest='parallel_uploads', type=int,
+                               default=None,
+                               help=('Number of missing incrementals to send at the same time. '
+                                     'Defaults to PARALLEL_UPLOADS.'))
+    backup_parser.add_argument('--bundle', dest='bundle', default=None, action='store_true',
+                               help=('Send the missing incrementals as one zfs send -I stream. '
+                                     'Defaults to BUNDLE_CATCHUP.'))
+    backup_parser.add_argument(
+        'datasets', nargs='*',
+        help=('Back up these local datasets concurrently instead of --dataset. '
+              'Shell style wildcards are accepted, eg: "tank/*".'))
+    backup_parser.add_argument('--all', dest='all', default=False, action='store_true',
+                               help='Back up every dataset with a [fs:DATASET] config section.')
+    backup_parser.add_argument('--concurrency', dest='concurrency', type=int,
+                               default=int(cfg.get('DATASET_CONCURRENCY', 4)),
+                               help='Number of datasets to back up at the same time.')
+    backup_parser.add_argument('--bwlimit', dest='bwlimit',
+                               default=cfg.get('BANDWIDTH_LIMIT'),
+                               help='Total bandwidth limit in bytes per second, eg: 100M.')
+    backup_parser.add_argument('--upload-concurrency', dest='upload_concurrency', type=int,
+                               default=int(cfg.get('CONCURRENCY', 64)),
+                               help=('Total number of upload worker threads, shared by the '
+                                     'datasets. Defaults to CONCURRENCY.'))
     incremental_group = backup_parser.add_mutually_exclusive_group()
     incremental_group.add_argument(
         '--full', dest='full', action='store_true', help='Perform full backup')
     incremental_group.add_argument(
         '--incremental', dest='incremental', default=True, action='store_true',
         help='Perform incremental backup; this is the default')
+    incremental_group.add_argument(
+        '--cumulative', dest='cumulative', action='store_true',
+        help='Perform incremental backup on top of the latest full backup')
+    hierarchy_group = backup_parser.add_mutually_exclusive_group()
+    hierarchy_group.add_argument(
+        '--recursive', dest='recursive', default=False, action='store_true',
+        help='Also back up every descendant dataset, each one on its own, concurrently.')
+    hierarchy_group.add_argument(
+        '--replicate', dest='replicate', default=False, action='store_true',
+        help=('Back up the dataset and its descendants as a single replication stream '
+              '(zfs send -R); snapshots have to be taken recursively.'))
 
     restore_parser = subparsers.add_parser('restore', help='not implemented')
     restore_parser.add_argument(
@@ -571,7 +2006,106 @@ def parse_args():
                                 help='Dry run.')
     restore_parser.add_argument('--force', dest='force', default=False, action='store_true',
                                 help='Force rollback of the filesystem (zfs recv -F).')
+
+    restore_many_parser = subparsers.add_parser(
+        'restore-many', help='restore many datasets concurrently')
+    restore_many_parser.add_argument(
+        'datasets', nargs='+',
+        help='Datasets to restore. Shell style wildcards are accepted, eg: "tank/*".')
+    target_group = restore_many_parser.add_mutually_exclusive_group()
+    target_group.add_argument('--snapshot', dest='snapshot', default=None,
+                              help='Snapshot to restore on every dataset. Defaults to latest.')
+    target_group.add_argument('--until', dest='until', default=None,
+                              help=('Restore the latest snapshot whose name sorts before or '
+                                    'equal to this one (the part after the at sign).'))
+    restore_many_parser.add_argument('--dry-run', dest='dry', default=False, action='store_true',
+                                     help='Dry run.')
+    restore_many_parser.add_argument(
+        '--recursive', dest='recursive', default=False, action='store_true',
+        help='Also restore the backed up descendants of the datasets.')
+    restore_many_parser.add_argument('--force', dest='force', default=False, action='store_true',
+                                     help='Force rollback of the filesystems (zfs recv -F).')
+    restore_many_parser.add_argument('--concurrency', dest='concurrency', type=int,
+                                     default=int(cfg.get('DATASET_CONCURRENCY', 4)),
+                                     help='Number of datasets to restore at the same time.')
+    restore_many_parser.add_argument('--bwlimit', dest='bwlimit',
+                                     default=cfg.get('BANDWIDTH_LIMIT'),
+                                     help='Total bandwidth limit in bytes per second, eg: 100M.')
     subparsers.add_parser('status', help='show status of current backups')
+
+    fleet_parser = subparsers.add_parser(
+        'fleet-status', help='show the state of the backups of every dataset')
+    fleet_parser.add_argument(
+        'datasets', nargs='*',
+        help='Only show these datasets. Shell style wildcards are accepted, eg: "tank/*".')
+    fleet_parser.add_argument('--json', dest='json', default=False, action='store_true',
+                              help='Print json instead of a table.')
+    fleet_parser.add_argument('--max-age', dest='max_age', type=float, default=None,
+                              help=('Report datasets whose latest backup is older than this '
+                                    'many hours. Defaults to MAX_BACKUP_AGE_HOURS.'))
+    fleet_parser.add_argument('--concurrency', dest='concurrency', type=int,
+                              default=int(cfg.get('DATASET_CONCURRENCY', 4)),
+                              help='Number of datasets to check at the same time.')
+
+    migrate_parser = subparsers.add_parser(
+        'migrate-layout', help='copy backups to the sharded key layout')
+    migrate_parser.add_argument(
+        'datasets', nargs='*',
+        help='Only migrate these datasets. Shell style wildcards are accepted, eg: "tank/*".')
+    migrate_parser.add_argument('--dry-run', dest='dry', default=False, action='store_true',
+                                help='Only show the keys that would be migrated.')
+    migrate_parser.add_argument('--delete', dest='delete', default=False, action='store_true',
+                                help='Delete the old keys once they have been copied.')
+    migrate_parser.add_argument('--concurrency', dest='concurrency', type=int, default=16,
+                                help='Number of keys to copy at the same time.')
+
+    prune_parser = subparsers.add_parser(
+        'prune', help='delete the backups the retention rules (KEEP_*) do not keep')
+    prune_parser.add_argument(
+        'datasets', nargs='*',
+        help=('Datasets to prune, defaults to the --dataset one. '
+              'Shell style wildcards are accepted, eg: "tank/*".'))
+    prune_parser.add_argument('--dry-run', dest='dry', default=False, action='store_true',
+                              help='Only show what would be kept and deleted.')
+    prune_parser.add_argument('--concurrency', dest='concurrency', type=int, default=4,
+                              help='Number of delete requests in flight, 1000 keys each.')
+    for rule in ('last', 'hourly', 'daily', 'weekly', 'monthly', 'yearly'):
+        prune_parser.add_argument(
+            '--keep-' + rule, dest='keep_' + rule, type=int, default=None,
+            help='Overrides KEEP_{}.'.format(rule.upper()))
+
+    agent_parser = subparsers.add_parser(
+        'agent', help='back up new snapshots as soon as they appear, until stopped')
+    agent_parser.add_argument(
+        'datasets', nargs='*',
+        help=('Local datasets to back up, defaults to every dataset with a [fs:DATASET] '
+              'config section. Shell style wildcards are accepted, eg: "tank/*".'))
+    agent_parser.add_argument('--socket', dest='socket',
+                              default=cfg.get('AGENT_SOCKET', '/run/z3/agent.sock'),
+                              help='Unix socket serving the status of the agent.')
+    agent_parser.add_argument('--status', dest='status', default=False, action='store_true',
+                              help='Print the status of the running agent and exit.')
+    agent_parser.add_argument('--interval', dest='interval', type=float,
+                              default=float(cfg.get('AGENT_POLL_INTERVAL', 60)),
+                              help='Seconds between looking for new snapshots.')
+    agent_parser.add_argument('--concurrency', dest='concurrency', type=int,
+                              default=int(cfg.get('DATASET_CONCURRENCY', 4)),
+                              help='Number of datasets to back up at the same time.')
+    agent_parser.add_argument('--bwlimit', dest='bwlimit',
+                              default=cfg.get('BANDWIDTH_LIMIT'),
+                              help='Total bandwidth limit in bytes per second, eg: 100M.')
+    agent_parser.add_argument('--upload-concurrency', dest='upload_concurrency', type=int,
+                              default=int(cfg.get('CONCURRENCY', 64)),
+                              help=('Total number of upload worker threads, shared by the '
+                                    'datasets. Defaults to CONCURRENCY.'))
+
+    catalog_parser = subparsers.add_parser(
+        'catalog', help='update, check or rebuild the catalog of backups of a dataset')
+    catalog_group = catalog_parser.add_mutually_exclusive_group()
+    catalog_group.add_argument('--check', dest='check', default=False, action='store_true',
+                               help='Only report differences between the catalog and S3.')
+    catalog_group.add_argument('--rebuild', dest='rebuild', default=False, action='store_true',
+                               help='Rebuild the catalog from scratch (one HEAD per key).')
     return parser.parse_args()
 
 
@@ -590,34 +2124,75 @@ def main():
         bucket = cfg['BUCKET']
         bucket = boto.connect_s3( **extra_config).get_bucket(bucket)
 
-    fs_section = "fs:{}".format(args.filesystem)
+    fs_section = _fs_section(args.filesystem)
     if args.snapshot_prefix is None:
         snapshot_prefix = cfg.get("SNAPSHOT_PREFIX", section=fs_section)
     else:
         snapshot_prefix = args.snapshot_prefix
     if args.subcommand == 'status':
         list_snapshots(bucket, s3_prefix=args.s3_prefix, snapshot_prefix=snapshot_prefix,
-                       filesystem=args.filesystem)
+                       filesystem=args.filesystem, plan_by=args.plan_by,
+                       restore_bandwidth=cfg.get('RESTORE_BANDWIDTH', '50M'))
+    elif args.subcommand == 'backup' and (args.all or args.datasets or args.recursive):
+        if args.snapshot is not None or args.cumulative:
+            raise SoftError('--snapshot and --cumulative only work with a single dataset')
+        if args.parseable:
+            raise SoftError('--parseable only works with a single dataset')
+        patterns = args.datasets
+        if not patterns and not args.all:
+            patterns = [args.filesystem]  # --recursive
+        return backup_many(bucket, s3_prefix=args.s3_prefix, patterns=patterns,
+                           full=args.full, compressor=args.compressor,
+                           gpg_recipient=args.gpg_recipient, dry=args.dry,
+                           concurrency=args.concurrency, bwlimit=args.bwlimit,
+                           upload_concurrency=args.upload_concurrency,
+                           recursive=args.recursive, replicate=args.replicate,
+                           parallel_uploads=args.parallel_uploads,
+                           send_flags=args.send_flags, bundle=args.bundle)
     elif args.subcommand == 'backup':
-        if args.compressor is None:
-            compressor = cfg.get('COMPRESSOR', section=fs_section)
-        else:
-            compressor = args.compressor
-        if compressor.lower() == 'none':
-            compressor = None
-        if compressor == 'gpg':
-            compressor_dict = COMPRESSORS.get(compressor)
-            if compressor_dict is not None:
-                compress_cmd = compressor_dict['compress'].format(args.gpg_recipient)
-                compressor_dict['compress'] = compress_cmd
-
         do_backup(bucket, s3_prefix=args.s3_prefix, snapshot_prefix=snapshot_prefix,
                   filesystem=args.filesystem, full=args.full, snapshot=args.snapshot,
-                  dry=args.dry, compressor=compressor, parseable=args.parseable)
+                  dry=args.dry, compressor=args.compressor, parseable=args.parseable,
+                  cumulative=args.cumulative, replicate=args.replicate,
+                  parallel_uploads=args.parallel_uploads, send_flags=args.send_flags,
+                  compressors=_compressors(args.gpg_recipient), bundle=args.bundle,
+                  bwlimit=args.bwlimit)
     elif args.subcommand == 'restore':
         restore(bucket, s3_prefix=args.s3_prefix, snapshot_prefix=snapshot_prefix,
                 filesystem=args.filesystem, snapshot=args.snapshot, dry=args.dry,
-                force=args.force)
+                force=args.force, plan_by=args.plan_by)
+    elif args.subcommand == 'fleet-status':
+        return fleet_status(bucket, s3_prefix=args.s3_prefix, patterns=args.datasets,
+                            max_age_hours=args.max_age, concurrency=args.concurrency,
+                            as_json=args.json)
+    elif args.subcommand == 'migrate-layout':
+        return migrate_layout(bucket, s3_prefix=args.s3_prefix, patterns=args.datasets,
+                              dry=args.dry, delete=args.delete, concurrency=args.concurrency)
+    elif args.subcommand == 'prune':
+        datasets = [args.filesystem]
+        if args.datasets:
+            datasets = _match_datasets(list_s3_datasets(bucket, args.s3_prefix), args.datasets)
+        keep = dict((rule, getattr(args, 'keep_' + rule)) for rule in (
+            'last', 'hourly', 'daily', 'weekly', 'monthly', 'yearly'))
+        return prune(bucket, s3_prefix=args.s3_prefix, datasets=datasets,
+                     snapshot_prefix=args.snapshot_prefix, dry=args.dry,
+                     concurrency=args.concurrency, keep=keep)
+    elif args.subcommand == 'catalog':
+        return sync_catalog(bucket, s3_prefix=args.s3_prefix, filesystem=args.filesystem,
+                            check=args.check, rebuild=args.rebuild)
+    elif args.subcommand == 'agent' and args.status:
+        return agent_status(args.socket)
+    elif args.subcommand == 'agent':
+        return run_agent(bucket, s3_prefix=args.s3_prefix, patterns=args.datasets,
+                         socket_path=args.socket, interval=args.interval,
+                         concurrency=args.concurrency, bwlimit=args.bwlimit,
+                         upload_concurrency=args.upload_concurrency)
+    elif args.subcommand == 'restore-many':
+        return restore_many(bucket, s3_prefix=args.s3_prefix, patterns=args.datasets,
+                            snapshot_prefix=args.snapshot_prefix, snapshot=args.snapshot,
+                            until=args.until, dry=args.dry, force=args.force,
+                            concurrency=args.concurrency, bwlimit=args.bwlimit,
+                            plan_by=args.plan_by, recursive=args.recursive)
 
 
 if __name__ == '__main__':
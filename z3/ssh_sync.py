@@ -1,5 +1,5 @@
 import argparse
-import subprocess
+import shlex
 import sys
 
 from z3.config import get_config
@@ -14,10 +14,10 @@ class RemoteZFSSnapshotManager(ZFSSnapshotManager):
         super(RemoteZFSSnapshotManager, self).__init__(*a, **kwa)
         self.remote_addr = remote_addr
 
-    def _list_snapshots(self):
-        return subprocess.check_output(
-            ['ssh', self.remote_addr, '-C',
-             'sudo zfs list -Ht snap -o name,used,refer,mountpoint,written'])
+    def _list_command(self, datasets):
+        remote_cmd = super(RemoteZFSSnapshotManager, self)._list_command(datasets)
+        return ['ssh', self.remote_addr, '-C',
+                'sudo ' + ' '.join(shlex.quote(arg) for arg in remote_cmd)]
 
 
 def snapshots_to_send(source_snaps, dest_snaps):
@@ -0,0 +1,229 @@
+"""Compact in-memory table of the backups in S3.
+
+A bucket can hold millions of keys, so instead of an object and a metadata dict per
+key the few fields z3 works with are kept in flat arrays indexed by row. Snapshot
+names are split in dataset and snapshot parts, both interned, so a part shared by
+many keys is stored once, and parents are kept as indices in the table of names
+rather than as strings. The rest of the metadata is read again when it's needed.
+
+A bundle, one `zfs send -I` stream of several snapshots, is named after its newest
+snapshot and lists the others in its 'contains' metadata. Each of those gets a row of its
+own, pointing at the bundle's key and with the bundle's parent, so it's looked up, checked
+and restored like any other backup.
+"""
+
+from array import array
+import sys
+
+from z3 import health
+
+
+# Separates the snapshots listed in the 'contains' metadata of a bundle
+BUNDLE_SEP = ','
+# Separates the snapshot name from the rest of the key for objects holding an alternate
+# backup of a snapshot, eg. a cumulative incremental. Not allowed in zfs names.
+ALTERNATE_SEP = '~'
+MISSING = -1  # sizes that aren't known
+NOT_AN_INT = -2  # uncompressed sizes that have to be read from the full metadata
+
+
+def _is_full(metadata):
+    # keep backwards compatibility for underscore metadata
+    return 'true' in [metadata.get('is_full'), metadata.get('isfull')]
+
+
+def _parse_size(value):
+    if value is None:
+        return MISSING
+    try:
+        return int(value)
+    except ValueError:
+        return NOT_AN_INT
+
+
+class SnapshotTable(object):
+    def __init__(self):
+        # names, of backups and of parents that aren't in S3
+        self._datasets = []
+        self._dataset_index = {}
+        self._names = {}  # dataset -> {snapshot part -> name index}
+        self._name_dataset = array('l')  # name index -> index in _datasets
+        self._name_snapshot = []  # name index -> interned part after the '@'
+        self._primary = array('l')  # name index -> row of its main object or -1
+        self._alternates = {}  # name index -> rows of the other objects holding it
+        # one row per S3 object
+        self._row_name = array('l')
+        self._row_parent = array('l')  # name index, or health.NO_PARENT
+        self._row_full = bytearray()
+        self._row_size = array('q')
+        self._row_uncompressed = array('q')  # the 'size' metadata
+        self._row_compressor = array('H')  # index in _compressors
+        self._compressors = [None]
+        self._alternate_keys = {}  # row -> key name, for keys that aren't the snapshot name
+        self._row_key_prefix = array('H')  # index in _key_prefixes, see z3.layout
+        self._key_prefixes = ['']
+        self._bundles = {}  # row -> row of the bundle whose stream holds it
+
+    def __len__(self):
+        return len(self._row_name)
+
+    def _name_index(self, name, create=True):
+        dataset, _, snapshot = name.partition('@')
+        names = self._names.get(dataset)
+        if names is None:
+            if not create:
+                return None
+            dataset = sys.intern(dataset)
+            names = self._names[dataset] = {}
+            self._dataset_index[dataset] = len(self._datasets)
+            self._datasets.append(dataset)
+        index = names.get(snapshot)
+        if index is None and create:
+            snapshot = sys.intern(snapshot)
+            index = names[snapshot] = len(self._name_snapshot)
+            self._name_dataset.append(self._dataset_index[dataset])
+            self._name_snapshot.append(snapshot)
+            self._primary.append(-1)
+        return index
+
+    def add(self, key_name, metadata, size, key_prefix=''):
+        """Adds an object; key_prefix + key_name is its name relative to the s3 prefix.
+        Returns its row, a bundle also adds a row for every other snapshot it holds.
+        """
+        metadata = metadata or {}
+        name = key_name.split(ALTERNATE_SEP, 1)[0]
+        row = self._add_row(name, key_name, metadata, size, key_prefix)
+        contains = metadata.get('contains')
+        if contains:
+            dataset = name.split('@', 1)[0]
+            for snapshot in contains.split(BUNDLE_SEP):
+                member = "{}@{}".format(dataset, snapshot)
+                if member != name:
+                    # only the main object of the snapshot if it has none of its own
+                    self._bundles[self._add_row(
+                        member, key_name, metadata, size, key_prefix)] = row
+        return row
+
+    def _add_row(self, name, key_name, metadata, size, key_prefix):
+        name_index = self._name_index(name)
+        row = len(self._row_name)
+        self._row_name.append(name_index)
+        parent = metadata.get('parent')
+        self._row_parent.append(
+            health.NO_PARENT if parent is None else self._name_index(parent))
+        self._row_full.append(_is_full(metadata))
+        self._row_size.append(MISSING if size is None else size)
+        self._row_uncompressed.append(_parse_size(metadata.get('size')))
+        compressor = metadata.get('compressor')
+        if compressor not in self._compressors:
+            self._compressors.append(compressor)
+        self._row_compressor.append(self._compressors.index(compressor))
+        if key_name != name:
+            self._alternate_keys[row] = key_name
+        if key_prefix not in self._key_prefixes:
+            self._key_prefixes.append(key_prefix)
+        self._row_key_prefix.append(self._key_prefixes.index(key_prefix))
+        # the object named after the snapshot is its main one, the first object otherwise
+        if self._primary[name_index] == -1 or key_name == name:
+            if self._primary[name_index] != -1:
+                self._alternates.setdefault(name_index, []).append(self._primary[name_index])
+            self._primary[name_index] = row
+        else:
+            self._alternates.setdefault(name_index, []).append(row)
+        return row
+
+    def _full_name(self, name_index):
+        return "{}@{}".format(
+            self._datasets[self._name_dataset[name_index]], self._name_snapshot[name_index])
+
+    def lookup(self, name):
+        """Returns the row of the main object holding snapshot `name` or None"""
+        if name is None:
+            return None
+        name_index = self._name_index(name, create=False)
+        if name_index is None or self._primary[name_index] == -1:
+            return None
+        return self._primary[name_index]
+
+    def primary_rows(self):
+        """Rows of the main object of every snapshot, sorted by name"""
+        rows = [row for row in self._primary if row != -1]
+        rows.sort(key=lambda row: (self._datasets[self._name_dataset[self._row_name[row]]],
+                                   self._name_snapshot[self._row_name[row]]))
+        return rows
+
+    def rows(self, name=None):
+        """Rows of every object holding snapshot `name`, or of all objects"""
+        if name is None:
+            return list(range(len(self)))
+        row = self.lookup(name)
+        if row is None:
+            return []
+        return [row] + self._alternates.get(self._row_name[row], [])
+
+    def is_primary(self, row):
+        return self._primary[self._row_name[row]] == row
+
+    def name(self, row):
+        return self._full_name(self._row_name[row])
+
+    def key(self, row):
+        return (self._key_prefixes[self._row_key_prefix[row]] +
+                (self._alternate_keys.get(row) or self.name(row)))
+
+    def parent_name(self, row):
+        parent = self._row_parent[row]
+        return None if parent == health.NO_PARENT else self._full_name(parent)
+
+    def parent_row(self, row):
+        parent = self._row_parent[row]
+        if parent == health.NO_PARENT or self._primary[parent] == -1:
+            return None
+        return self._primary[parent]
+
+    def is_full(self, row):
+        return bool(self._row_full[row])
+
+    def size(self, row):
+        size = self._row_size[row]
+        return None if size == MISSING else size
+
+    def uncompressed_size(self, row):
+        """The 'size' metadata as an int, None if missing or NOT_AN_INT if it isn't one"""
+        size = self._row_uncompressed[row]
+        return None if size == MISSING else size
+
+    def compressor(self, row):
+        return self._compressors[self._row_compressor[row]]
+
+    def bundle(self, row):
+        """Row of the bundle holding the snapshot of `row` in its stream, None if the
+        object only holds its own snapshot
+        """
+        return self._bundles.get(row)
+
+    def analyze(self):
+        """Runs health.analyze_indexed over the main objects, indexed by name"""
+        names = len(self._primary)
+        is_full, sizes = bytearray(names), array('q', [0]) * names
+        parents = array('l', [health.NO_PARENT]) * names
+        for name_index, row in enumerate(self._primary):
+            if row == -1:
+                continue
+            is_full[name_index] = self._row_full[row]
+            parent = self._row_parent[row]
+            if parent != health.NO_PARENT and self._primary[parent] == -1:
+                parent = health.NO_PARENT  # a parent that isn't in S3
+            parents[name_index] = parent
+            sizes[name_index] = max(self._row_size[row], 0)
+        return health.analyze_indexed(is_full, parents, sizes)
+
+    def health(self, analysis, row):
+        """Health of the object in `row` given the result of analyze()"""
+        reasons, depths, chain_sizes = analysis
+        if self.is_primary(row):
+            return health.health_at(reasons, depths, chain_sizes, self._row_name[row])
+        # alternate objects hang off the graph, they're as healthy as their parent
+        parent = self.parent_row(row)
+        parent_health = None if parent is None else self.health(analysis, parent)
+        return health.classify(self.is_full(row), parent_health, self.size(row))